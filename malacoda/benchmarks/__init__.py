@@ -0,0 +1,48 @@
+# -*- coding: utf-8 -*-
+
+"""
+Copyright 2014 Gustav Arngården 
+
+   Licensed under the Apache License, Version 2.0 (the "License");
+   you may not use this file except in compliance with the License.
+   You may obtain a copy of the License at
+
+     http://www.apache.org/licenses/LICENSE-2.0
+
+   Unless required by applicable law or agreed to in writing, software
+   distributed under the License is distributed on an "AS IS" BASIS,
+   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+   See the License for the specific language governing permissions and
+   limitations under the License.
+"""
+
+""" Benchmarks for Malacoda, run a benchmark with python -m malacoda.benchmarks.<name>.
+Each benchmark can write its results as JSON with --json, so that results of different
+releases can be compared.
+"""
+
+import sys
+import json
+import time
+import socket
+import platform
+
+
+def write_json(benchmark, results, path):
+    """ Write results of benchmark as JSON together with a description of the machine.
+
+    Args:
+     - benchmark (basestring): Name of the benchmark.
+     - results (list): The results, dicts of JSON-serializable values.
+     - path (basestring): File to write to, '-' means stdout.
+     
+    """
+    doc = {'benchmark': benchmark, 'time': time.time(), 'host': socket.gethostname(),
+           'python': platform.python_version(), 'platform': platform.platform(),
+           'results': results}
+    if path == '-':
+        json.dump(doc, sys.stdout, indent=2, sort_keys=True)
+        sys.stdout.write('\n')
+    else:
+        with open(path, 'w') as f:
+            json.dump(doc, f, indent=2, sort_keys=True)
@@ -0,0 +1,112 @@
+# -*- coding: utf-8 -*-
+
+"""
+Copyright 2014 Gustav Arngården 
+
+   Licensed under the Apache License, Version 2.0 (the "License");
+   you may not use this file except in compliance with the License.
+   You may obtain a copy of the License at
+
+     http://www.apache.org/licenses/LICENSE-2.0
+
+   Unless required by applicable law or agreed to in writing, software
+   distributed under the License is distributed on an "AS IS" BASIS,
+   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+   See the License for the specific language governing permissions and
+   limitations under the License.
+"""
+
+""" Micro-benchmark of message serialization.
+Measures bytes per call and microseconds per serialize/deserialize round trip of a
+request and its reply for each codec, and for the previous format where whole message
+objects were pickled with cloud.serialization (if cloud is installed).
+
+Usage: python -m malacoda.benchmarks.codec [iterations] [--json results.json]
+"""
+
+import time
+import argparse
+from malacoda.message import REQMessage, REPMessage, MSG_TYPES, CODECS
+from malacoda.benchmarks import write_json
+
+CALLS = {
+    'small': (('insert_message', ('hello world',), {}), 'Message received!'),
+    'list': (('update_list', (range(1000),), {}), None),
+    'bytes': (('store', ('x' * 100000,), {'key': 'a'}), 'x' * 100000),
+}
+
+
+class LegacyMessage(object):
+    """ Message with the fields that used to be pickled with cloud.serialization.
+    """
+    def __init__(self, **fields):
+        self.checksum = None
+        self.timestamp = time.time()
+        self.__dict__.update(fields)
+
+
+def bench_codec(codec, call, iterations):
+    """ Return (bytes per call, microseconds per call) for call encoded with codec.
+    """
+    (fn_name, args, kwargs), val = call
+    start = time.time()
+    for _ in xrange(iterations):
+        req = REQMessage(fn_name, args, kwargs, codec=codec).serialize()
+        REQMessage.deserialize(req)
+        rep = REPMessage(typ=MSG_TYPES.call, val=val, codec=codec).serialize()
+        REPMessage.deserialize(rep)
+    elapsed = time.time() - start
+    return len(req) + len(rep), elapsed / iterations * 1e6
+
+
+def bench_legacy(call, iterations):
+    """ Return (bytes per call, microseconds per call) for the cloud.serialization format.
+    """
+    from cloud.serialization import serialize, deserialize
+    (fn_name, args, kwargs), val = call
+    start = time.time()
+    for _ in xrange(iterations):
+        req = serialize(LegacyMessage(fn_name=fn_name, args=args, kwargs=kwargs))
+        deserialize(req)
+        rep = serialize(LegacyMessage(typ=MSG_TYPES.call, val=val))
+        deserialize(rep)
+    elapsed = time.time() - start
+    return len(req) + len(rep), elapsed / iterations * 1e6
+
+
+def run(iterations=1000):
+    """ Run benchmark and return list of results.
+    """
+    results = []
+    for call_name, call in sorted(CALLS.items()):
+        for codec in sorted(CODECS):
+            try:
+                size, usec = bench_codec(codec, call, iterations)
+            except Exception as e:
+                results.append({'call': call_name, 'codec': codec, 'error': str(e)})
+                continue
+            results.append({'call': call_name, 'codec': codec, 'bytes': size, 'usec': usec})
+        try:
+            size, usec = bench_legacy(call, iterations)
+        except ImportError:
+            continue
+        results.append({'call': call_name, 'codec': 'legacy', 'bytes': size, 'usec': usec})
+    return results
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark of message serialization.')
+    parser.add_argument('iterations', type=int, nargs='?', default=1000)
+    parser.add_argument('--json', help='Write results as JSON to this file, - for stdout.')
+    args = parser.parse_args()
+    results = run(args.iterations)
+    if args.json:
+        write_json('codec', results, args.json)
+    if args.json != '-':
+        print '%-8s %-8s %10s %10s' % ('call', 'codec', 'bytes', 'usec')
+        for result in results:
+            if 'error' in result:
+                print '%-8s %-8s %s' % (result['call'], result['codec'], result['error'])
+            else:
+                print '%-8s %-8s %10d %10.1f' % (result['call'], result['codec'],
+                                                 result['bytes'], result['usec'])
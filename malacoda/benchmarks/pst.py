@@ -0,0 +1,117 @@
+# -*- coding: utf-8 -*-
+
+"""
+Copyright 2014 Gustav Arngården 
+
+   Licensed under the Apache License, Version 2.0 (the "License");
+   you may not use this file except in compliance with the License.
+   You may obtain a copy of the License at
+
+     http://www.apache.org/licenses/LICENSE-2.0
+
+   Unless required by applicable law or agreed to in writing, software
+   distributed under the License is distributed on an "AS IS" BASIS,
+   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+   See the License for the specific language governing permissions and
+   limitations under the License.
+"""
+
+""" Benchmark of saving and loading pst-variables with each persistant storage.
+For each storage and state size the following is timed:
+ - save: saving all variables.
+ - delta_save: saving a dict-variable where one key has changed, see Malacoda.mark_dirty.
+ - fork_pause and fork_save: time until fork_save returns, which is how long the daemon
+   is paused, and until the forked child has saved all variables.
+ - load: loading all variables with a new storage instance.
+
+Usage: python -m malacoda.benchmarks.pst [--entries 1000,100000] [--storages file,log]
+           [--json results.json]
+"""
+
+import os
+import time
+import glob
+import shutil
+import argparse
+import tempfile
+from malacoda import pst_storage
+from malacoda.benchmarks import write_json
+
+ENTRIES = (1000, 100 * 1000, 1000 * 1000)
+STORAGES = ('file', 'log', 'sqlite')
+
+
+def create_storage(name, directory):
+    """ Return storage of given kind that saves its files in directory.
+    """
+    if name == 'file':
+        return pst_storage.PstFileStorage(file_path=os.path.join(directory, 'pst.p'))
+    if name == 'log':
+        return pst_storage.PstLogStorage(path=os.path.join(directory, 'pst'))
+    if name == 'sqlite':
+        return pst_storage.PstSqliteStorage(path=os.path.join(directory, 'pst.db'),
+                                            split=['pst_dict'], lazy=False)
+    raise ValueError('Unknown storage: %s' % name)
+
+
+def _timed(fn, *args):
+    start = time.time()
+    fn(*args)
+    return time.time() - start
+
+
+def bench(name, entries):
+    """ Return timings in seconds of storage name with a state of entries entries.
+    """
+    directory = tempfile.mkdtemp(prefix='malacoda_bench_')
+    try:
+        psts = [('pst_dict', dict((i, 'value %d' % i) for i in xrange(entries))),
+                ('pst_list', range(entries))]
+        storage = create_storage(name, directory)
+        result = {'storage': name, 'entries': entries}
+        result['save'] = _timed(storage.save, psts)
+        storage.wait()
+        psts[0][1][0] = 'changed'
+        result['delta_save'] = _timed(storage.save, psts[:1], {'pst_dict': set([0])})
+        storage.wait()
+        start = time.time()
+        forked_save = storage.fork_save(psts)
+        result['fork_pause'] = time.time() - start
+        while forked_save.poll() is None:
+            time.sleep(0.001)
+        result['fork_save'] = time.time() - start
+        storage.wait()
+        result['load'] = _timed(create_storage(name, directory).load)
+        result['bytes'] = sum(os.path.getsize(path)
+                              for path in glob.glob(os.path.join(directory, '*')))
+        return result
+    finally:
+        shutil.rmtree(directory)
+
+
+def run(entries=ENTRIES, storages=STORAGES):
+    """ Run benchmark and return list of results, one per storage and state size.
+    """
+    return [bench(name, n) for name in storages for n in entries]
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark of persistant storages.')
+    parser.add_argument('--entries', type=lambda value: [int(float(v)) for v in
+                                                         value.split(',')],
+                        default=ENTRIES, help='State sizes, comma separated.')
+    parser.add_argument('--storages', type=lambda value: value.split(','),
+                        default=STORAGES, help='Storages among file, log and sqlite.')
+    parser.add_argument('--json', help='Write results as JSON to this file, - for stdout.')
+    args = parser.parse_args()
+    results = run(args.entries, args.storages)
+    if args.json:
+        write_json('pst', results, args.json)
+    if args.json != '-':
+        print '%-7s %9s %12s %9s %11s %11s %10s %9s' % (
+            'storage', 'entries', 'bytes', 'save s', 'delta s', 'fork pause', 'fork s',
+            'load s')
+        for r in results:
+            print '%-7s %9d %12d %9.3f %11.4f %11.4f %10.3f %9.3f' % (
+                r['storage'], r['entries'], r['bytes'], r['save'], r['delta_save'],
+                r['fork_pause'], r['fork_save'], r['load'])
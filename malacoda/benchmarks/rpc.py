@@ -0,0 +1,182 @@
+# -*- coding: utf-8 -*-
+
+"""
+Copyright 2014 Gustav Arngården 
+
+   Licensed under the Apache License, Version 2.0 (the "License");
+   you may not use this file except in compliance with the License.
+   You may obtain a copy of the License at
+
+     http://www.apache.org/licenses/LICENSE-2.0
+
+   Unless required by applicable law or agreed to in writing, software
+   distributed under the License is distributed on an "AS IS" BASIS,
+   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+   See the License for the specific language governing permissions and
+   limitations under the License.
+"""
+
+""" Benchmark of getattr, setattr and call throughput and latency.
+A BenchMalacoda is started in a subprocess, or in this process with --in-process, and
+each operation is run for a number of seconds per payload size and number of
+concurrent clients. Clients are separate processes so that they are not limited by
+the GIL of one process.
+
+Usage: python -m malacoda.benchmarks.rpc [--sizes 10,1000,...] [--clients 1,4]
+           [--ops getattr,setattr,call] [--duration 2] [--workers N] [--in-process]
+           [--json results.json]
+"""
+
+import os
+import time
+import argparse
+import tempfile
+from datetime import timedelta
+from multiprocessing import Process, Pool
+from malacoda import malacoda
+from malacoda.stats import Histogram, PERCENTILES
+from malacoda.benchmarks import write_json
+
+PORT = 51090
+SIZES = (10, 1000, 100 * 1000, 10 * 1000 * 1000, 100 * 1000 * 1000)
+CLIENTS = (1, 4)
+OPS = ('getattr', 'setattr', 'call')
+
+
+class BenchMalacoda(malacoda.Malacoda):
+    """ Malacoda with an attribute and a method for the benchmark.
+    """
+    def __init__(self, **kwargs):
+        self.payload = None
+        pst_config = {'class_name': 'PstFileStorage', 'frequency': timedelta(hours=1),
+                      'file_path': os.path.join(tempfile.gettempdir(), 'bench_pst.p')}
+        super(BenchMalacoda, self).__init__(daemonize=False, pst_config=pst_config,
+                                            **kwargs)
+
+    def _run(self):
+        while self.running:
+            time.sleep(0.1)
+
+    def echo(self, payload):
+        return payload
+
+
+def _serve(port, workers):
+    BenchMalacoda(port=port, listener_workers=workers)
+
+
+def start(port=PORT, workers=0, in_process=False):
+    """ Start BenchMalacoda and return function that stops it.
+    """
+    if in_process:
+        daemon = BenchMalacoda(port=port, listener_workers=workers, start_worker=False)
+        daemon._start_msg_listener(None, port)
+        return daemon.stop
+    process = Process(target=_serve, args=(port, workers))
+    process.start()
+    zp = malacoda.get('BenchMalacoda:%s' % port)
+    for _ in xrange(100):
+        try:
+            zp.echo(None, timeout=1)
+            break
+        except Exception:
+            time.sleep(0.1)
+
+    def stop():
+        zp.stop()
+        process.join()
+    return stop
+
+
+def _client(args):
+    """ Run op for duration seconds and return histogram of the latencies.
+    """
+    port, op, size, duration = args
+    zp = malacoda.get('BenchMalacoda:%s' % port)
+    payload = 'x' * size
+    if op == 'getattr':
+        zp.payload = payload
+        fn = lambda: zp.payload
+    elif op == 'setattr':
+        fn = lambda: setattr(zp, 'payload', payload)
+    else:
+        fn = lambda: zp.echo(payload)
+    histogram = Histogram()
+    end = time.time() + duration
+    while True:
+        start = time.time()
+        fn()
+        now = time.time()
+        histogram.record(now - start)
+        if now >= end:
+            return histogram
+
+
+def bench(port, op, size, clients, duration):
+    """ Return result of running op with payload of size bytes from clients processes.
+    """
+    pool = Pool(clients)
+    try:
+        start = time.time()
+        histograms = pool.map(_client, [(port, op, size, duration)] * clients)
+        elapsed = time.time() - start
+    finally:
+        pool.close()
+        pool.join()
+    histogram = Histogram()
+    for client_histogram in histograms:
+        histogram.merge(client_histogram)
+    result = {'op': op, 'bytes': size, 'clients': clients, 'calls': histogram.count,
+              'seconds': elapsed, 'calls_per_sec': histogram.count / elapsed,
+              'mb_per_sec': histogram.count * size / elapsed / 1e6,
+              'mean_ms': histogram.total / histogram.count * 1000,
+              'max_ms': histogram.max * 1000}
+    for percent in PERCENTILES:
+        result['p%s_ms' % percent] = histogram.percentile(percent) * 1000
+    return result
+
+
+def run(sizes=SIZES, clients=CLIENTS, ops=OPS, duration=2, port=PORT, workers=0,
+        in_process=False):
+    """ Run benchmark and return list of results, one per op, size and number of clients.
+    """
+    stop = start(port, workers, in_process)
+    try:
+        return [bench(port, op, size, n, duration)
+                for op in ops for size in sizes for n in clients]
+    finally:
+        stop()
+
+
+def _ints(value):
+    return [int(float(v)) for v in value.split(',')]
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark of Malacoda requests.')
+    parser.add_argument('--sizes', type=_ints, default=SIZES,
+                        help='Payload sizes in bytes, comma separated.')
+    parser.add_argument('--clients', type=_ints, default=CLIENTS,
+                        help='Numbers of concurrent clients, comma separated.')
+    parser.add_argument('--ops', type=lambda value: value.split(','), default=OPS,
+                        help='Operations among getattr, setattr and call, comma separated.')
+    parser.add_argument('--duration', type=float, default=2,
+                        help='Seconds to run each combination.')
+    parser.add_argument('--workers', type=int, default=0,
+                        help='listener_workers of the Malacoda.')
+    parser.add_argument('--port', type=int, default=PORT)
+    parser.add_argument('--in-process', action='store_true',
+                        help='Run the Malacoda in this process.')
+    parser.add_argument('--json', help='Write results as JSON to this file, - for stdout.')
+    args = parser.parse_args()
+    results = run(args.sizes, args.clients, args.ops, args.duration, args.port,
+                  args.workers, args.in_process)
+    if args.json:
+        write_json('rpc', results, args.json)
+    if args.json != '-':
+        print '%-8s %10s %7s %10s %10s %9s %9s %9s' % ('op', 'bytes', 'clients', 'calls/s',
+                                                      'MB/s', 'p50 ms', 'p99 ms', 'max ms')
+        for r in results:
+            print '%-8s %10d %7d %10.1f %10.1f %9.3f %9.3f %9.3f' % (
+                r['op'], r['bytes'], r['clients'], r['calls_per_sec'], r['mb_per_sec'],
+                r['p50_ms'], r['p99_ms'], r['max_ms'])
@@ -0,0 +1,79 @@
+# -*- coding: utf-8 -*-
+
+"""
+Copyright 2014 Gustav Arngården 
+
+   Licensed under the Apache License, Version 2.0 (the "License");
+   you may not use this file except in compliance with the License.
+   You may obtain a copy of the License at
+
+     http://www.apache.org/licenses/LICENSE-2.0
+
+   Unless required by applicable law or agreed to in writing, software
+   distributed under the License is distributed on an "AS IS" BASIS,
+   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+   See the License for the specific language governing permissions and
+   limitations under the License.
+"""
+
+import time
+from threading import RLock
+from malacoda import Malacoda
+import registry
+
+
+class Discovery(Malacoda):
+    """ Discovery daemon that keeps track of Malacodas on many hosts.
+    Malacodas started with discovery='<host>:<port>' register with it, and malacoda.get
+    asks it for the address of Malacodas that are not found in the local registry.
+    Registrations are keyed by name, host and pid, and registrations that have not been
+    renewed within ENTRY_TTL seconds are removed.
+    
+    """
+    DEFAULT_PORT = 51100
+    ENTRY_TTL = 3 * registry.REGISTER_INTERVAL
+
+    def __init__(self, port=None, daemonize=True, **kwargs):
+        self.entries = {}
+        self.lock = RLock()
+        super(Discovery, self).__init__(port=port or self.DEFAULT_PORT, daemonize=daemonize,
+                                        **kwargs)
+
+    def _run(self):
+        while self.running:
+            limit = time.time() - self.ENTRY_TTL
+            with self.lock:
+                for key, entry in self.entries.items():
+                    if entry['registered'] < limit:
+                        del self.entries[key]
+            time.sleep(1)
+        self.finished = True
+
+    def register(self, name, host, port, pid):
+        """ Register Malacoda with given name running on host:port.
+        """
+        with self.lock:
+            self.entries[(name, host, pid)] = {'host': host, 'port': port, 'pid': pid,
+                                          'registered': time.time()}
+
+    def unregister(self, name, host, pid):
+        """ Remove Malacoda with given name on host that is registered by process pid.
+        """
+        with self.lock:
+            self.entries.pop((name, host, pid), None)
+
+    def lookup(self, name, host=None):
+        """ Return list of entries of Malacodas with given name, on host if given, the
+        most recently registered last.
+        """
+        with self.lock:
+            entries = sorted((entry for (entry_name, entry_host, _), entry
+                              in self.entries.iteritems()
+                              if entry_name == name and host in (None, entry_host)),
+                             key=lambda entry: entry['registered'])
+            return [{'host': entry['host'], 'port': entry['port'], 'pid': entry['pid']}
+                    for entry in entries]
+
+
+if __name__ == '__main__':
+    Discovery(daemonize=False)
@@ -18,23 +18,36 @@ Copyright 2014 Gustav Arngården
 
 import os
 import sys
+import struct
 import signal
 import daemon
 import time
+import types
+import random
+import itertools
+import copy
 import zmq
 import threading
+import multiprocessing
 import cPickle as pickle
 import socket
+import Queue
 import setproctitle
 from copy import deepcopy
+from functools import wraps
+from multiprocessing.pool import ThreadPool
 from subprocess import Popen, PIPE
 from datetime import datetime, timedelta
-from zmq_socket import Socket
+from zmq_socket import Socket, get_context
 from paramiko import SSHClient
 import proxy
+import registry
 import signal
-from message import REPMessage, REQMessage, MSG_TYPES
+from message import REPMessage, REQMessage, MSG_TYPES, MessageException, get_codec
 import pst_storage
+import util
+import stats
+import profiler
 
 
 class MalacodaException(Exception):
@@ -46,9 +59,17 @@ class Malacoda(daemon.DaemonContext):
     storage and more.
     """
     DEFAULT_PST_CONFIG = {'class_name': 'PstFileStorage', 'frequency': timedelta(minutes=1)}
+    BATCH_WORKERS = 4
+    STREAM_CHUNK_SIZE = 100
+    STREAM_TTL = 300
+    STATS_INTERVAL = 10
+    WORK_METHODS = None
     
     def __init__(self, name=None, bind_address=None, port=None, daemonize=True,
-                 pst_config=None, start_worker=True, logger=None, **kwargs):
+                 pst_config=None, start_worker=True, logger=None, listener_workers=0,
+                 codec=None, discovery=None, call_queue_size=10000, call_queue_workers=1,
+                 push_channel=False, stats_file=None, offload_processes=None,
+                 offload_threads=4, publish_channel=False, **kwargs):
         """ Init Malacoda.
         Name of Malacoda can be overridden, else class name will be used.
         It is possible to override the address and port used for communicating with the Malacoda.
@@ -61,6 +82,28 @@ class Malacoda(daemon.DaemonContext):
         loaded when Malacoda is initialized. To enable persistant storage, pst_config should be a
         dict with a key 'class_name' that is the name of a PstStorage-class, (in pst_storage.py),
         any other keys in the dict are sent into the constructor of the PstStorage-class.
+        By default incoming requests are evaluated one at a time by the message listener.
+        If listener_workers is set, requests are instead dispatched to a pool of that many
+        worker threads so that one slow call does not block other clients.
+        Replies are encoded with the same codec as the request, unless codec is set in
+        which case all replies are encoded with that codec.
+        The Malacoda registers its port in the local registry so that it can be found by
+        malacoda.get, and with the discovery daemon at discovery if given.
+        Calls made with await_reply=False are acknowledged directly and put in a queue of
+        at most call_queue_size calls, that are evaluated by call_queue_workers threads.
+        Calls are dropped if the queue is full. If push_channel is True, a PULL-socket is
+        bound for receiving such calls without acknowledgement, to a port in
+        MsgListenerThread.CHANNEL_PORT_RANGE.
+        If publish_channel is True, a PUB-socket is bound that payloads are sent to
+        subscribers with, to a port in MsgListenerThread.CHANNEL_PORT_RANGE, see publish
+        and subscribe.
+        Statistics of the requests to each method are returned by _malacoda_stats, if
+        stats_file is given they are also written to it in the Prometheus text format
+        every STATS_INTERVAL seconds.
+        Methods decorated with offload are evaluated in a pool of offload_processes
+        processes, or offload_threads threads, that is started with the Malacoda.
+        Besides _run, work-methods are called over and over in their own threads or
+        processes, see WORK_METHODS and WorkLoop.
         Any remaining keyword arguments are forwarded into daemon.DaemonContext.
         
         Args:
@@ -73,6 +116,19 @@ class Malacoda(daemon.DaemonContext):
                                            'frequency': timedelta(minutes=5)}
          - start_worker (bool): If True, the _run-method will be executed at end of init.
          - logger (Instance of logging.Logger): Logger.
+         - listener_workers (int): Number of threads evaluating requests in parallel,
+                                   0 means evaluate requests in the listener thread.
+         - codec (basestring): Name of codec for encoding replies, see message.CODECS.
+         - discovery (basestring): Address, host:port, of discovery daemon to register with,
+                                   default is registry.DISCOVERY_ADDRESS.
+         - call_queue_size (int): Max number of queued calls made with await_reply=False.
+         - call_queue_workers (int): Number of threads evaluating queued calls.
+         - push_channel (bool): If True, bind PULL-socket for calls without acknowledgement.
+         - stats_file (basestring): Optional path of Prometheus text file with statistics.
+         - offload_processes (int): Size of process pool for offloaded methods, default
+                                    is the number of CPUs.
+         - offload_threads (int): Size of thread pool for offloaded methods.
+         - publish_channel (bool): If True, bind PUB-socket for publishing to subscribers.
          - kwargs: Optional keyword arguments that are sent to daemon.DaemonContext.
          
         """
@@ -96,6 +152,35 @@ class Malacoda(daemon.DaemonContext):
         self.finished = False
         setproctitle.setproctitle(self.name)
         self.daemonize = daemonize
+        self.listener_workers = listener_workers
+        self.discovery = discovery
+        self.call_queue = CallQueue(self, call_queue_size, call_queue_workers)
+        self.push_channel = push_channel
+        self.push_port = None
+        self.publish_channel = publish_channel
+        self.pub_port = None
+        self._publisher = None
+        self.request_stats = stats.Stats()
+        self.stats_file = stats_file
+        self._profiler = None
+        self._work_loops = {}
+        self.offload_processes = offload_processes
+        self.offload_threads = offload_threads
+        self._offload_pools = {}
+        self._offload_pid = None
+        self._method_table = None
+        self._forked_save = None
+        self._batch_pool = None
+        self._streams = {}
+        self._stream_ids = itertools.count(1)
+        self._streams_lock = threading.Lock()
+        self.last_pst_report = None
+        self._methods_version = random.randint(1, 0xffffffff)
+        self._attr_epoch = random.randint(1, 0x7fffffff)
+        try:
+            self.codec = codec and get_codec(codec).name
+        except MessageException as e:
+            raise MalacodaException(str(e))
         pst_config = pst_config or deepcopy(self.DEFAULT_PST_CONFIG)
         try:
             class_name = pst_config.pop('class_name')
@@ -123,7 +208,11 @@ class Malacoda(daemon.DaemonContext):
             self.open()
         if start_worker:
             self.logger.info('Starting worker')
+            self._start_offload_pools()
+            self._init_work_loops()
+            self._start_work_loops('process')
             self._start_msg_listener(bind_address, port)
+            self._start_work_loops('thread')
             self._run()
 
     def _start_msg_listener(self, bind_address, port=None):
@@ -134,45 +223,335 @@ class Malacoda(daemon.DaemonContext):
          - port (int): Optional port to bind message listener.
 
         """
-        MsgListenerThread(self, bind_address=bind_address, port=port).start()
+        self.call_queue.start()
+        if self.push_channel:
+            pull_listener = PullListenerThread(self, bind_address=bind_address)
+            self.push_port = pull_listener.port
+            pull_listener.start()
+        if self.publish_channel:
+            self._publisher = Publisher(bind_address=bind_address, codec=self.codec)
+            self.pub_port = self._publisher.port
+        MsgListenerThread(self, bind_address=bind_address, port=port,
+                          workers=self.listener_workers, discovery=self.discovery).start()
         threading.Thread(target=self._pst_handler).start()
+        if self.stats_file:
+            thread = threading.Thread(target=self._stats_exporter)
+            thread.daemon = True
+            thread.start()
+
+    def _start_offload_pools(self):
+        """ Start the pools needed by the offloaded methods of this Malacoda.
+        The process pool is forked before any other threads are started, its processes
+        have a copy of the Malacoda as it is at start.
+        """
+        global _offload_target
+        pools = set(getattr(getattr(type(self), name, None), 'offload_pool', None)
+                    for name in dir(type(self)))
+        if 'process' in pools:
+            _offload_target = self
+            self._offload_pools['process'] = multiprocessing.Pool(self.offload_processes)
+        if 'thread' in pools:
+            self._offload_pools['thread'] = ThreadPool(self.offload_threads)
+        self._offload_pid = os.getpid()
+
+    def _offload(self, method, msg):
+        """ Evaluate call to offloaded method in its pool and return reply message.
+        Calls to the process pool are sent as serialized requests and replies, so
+        arguments and results are encoded with the codec of the request.
+        """
+        pool = self._offload_pools[method.offload_pool]
+        if method.offload_pool == 'thread':
+            return REPMessage(typ=MSG_TYPES.call,
+                              val=pool.apply(method, msg.args, msg.kwargs))
+        request = REQMessage(msg.fn_name, msg.args, msg.kwargs, codec=msg.codec)
+        return REPMessage.deserialize(pool.apply(_offload_call, (request.serialize(),)))
+
+    def _init_work_loops(self):
+        """ Create a WorkLoop for each work-method.
+        If WORK_METHODS is None, all methods with names starting with 'work_' are work-
+        methods and run in one thread each. Otherwise WORK_METHODS is a dict with the
+        names of the work-methods as keys and the number of replicas, or a dict of
+        keyword arguments to WorkLoop, as values, e.g.
+        {'work_fetch': 4, 'work_crunch': {'replicas': 2, 'mode': 'process'}}.
+
+        Raises:
+         - MalacodaException: If a work-method does not exist or has unknown mode.
+         
+        """
+        if self.WORK_METHODS is None:
+            work_methods = dict((name, {}) for name in dir(type(self))
+                                if name.startswith('work_') and callable(getattr(self, name)))
+        else:
+            work_methods = self.WORK_METHODS
+        for name, config in sorted(work_methods.iteritems()):
+            if not callable(getattr(self, name, None)):
+                raise MalacodaException('Unknown work-method: %s' % name)
+            if not isinstance(config, dict):
+                config = {'replicas': config}
+            self._work_loops[name] = WorkLoop(self, name, **config)
+
+    def _start_work_loops(self, mode):
+        """ Start the WorkLoops with given mode.
+        Loops in process mode are forked before any other threads are started, as the
+        process pool in _start_offload_pools, so that the processes do not get copies of
+        locks held by other threads or of the zmq context.
+        """
+        for work_loop in self._work_loops.itervalues():
+            if work_loop.mode == mode:
+                work_loop.start()
 
     def _run(self):
-        """ Main loop that needs to be overriden.
+        """ Main loop that needs to be overriden, unless the Malacoda has work-methods.
         This should be of form:
           while self.running:
             do work
+          self.finished = True
+        The default implementation waits for the work-methods to stop.
             
         """
-        raise NotImplemented
+        if not self._work_loops:
+            raise NotImplemented
+        while self.running:
+            time.sleep(1)
+        for work_loop in self._work_loops.itervalues():
+            work_loop.join()
+        self.finished = True
+
+    def _work_stats(self):
+        """ Return health and throughput of the work-methods.
+
+        Returns:
+         - (dict): {name of work-method: see WorkLoop.stats}
+         
+        """
+        return dict((name, work_loop.stats())
+                    for name, work_loop in self._work_loops.iteritems())
+
+    def __setattr__(self, name, value):
+        """ Set attribute, pst-variables are marked as changed so that they are saved.
+        The version of the attribute is increased and cached results that depend on it
+        are invalidated.
+        """
+        super(Malacoda, self).__setattr__(name, value)
+        if name.startswith('pst'):
+            self.mark_dirty(name)
+        else:
+            self._bump_version(name)
+            if '_method_caches' in self.__dict__:
+                self._invalidate_caches(name)
+
+    def __getattr__(self, name):
+        """ Load pst-variable from persistant storage on first access, if the storage
+        is lazy.
+        """
+        lazy = self.__dict__.get('_pst_lazy')
+        if lazy and name in lazy:
+            with self._pst_lock():
+                if name in lazy:
+                    self.__dict__[name] = self.persistant_storage.load_variable(name)
+                    lazy.discard(name)
+            return self.__dict__[name]
+        raise AttributeError("'%s' object has no attribute '%s'" % (type(self).__name__,
+                                                                    name))
+
+    def mark_dirty(self, name, *keys):
+        """ Mark pst-variable as changed so that it is saved at next save period.
+        Assigning a pst-variable marks it automatically, this needs to be called
+        after changing a variable in place, e.g. self.pst_list.append(1).
+        For dict-variables the changed keys can be given, storages that save each entry
+        separately then only save those entries, e.g. after self.pst_dict['a'] = 1,
+        call self.mark_dirty('pst_dict', 'a').
+
+        The version of the variable is increased and cached results that depend on it are
+        invalidated. This can also be called for other attributes that are changed in
+        place, for them only the version is increased and caches invalidated.
+
+        Args:
+         - name (basestring): Name of pst-variable.
+         - keys: Changed keys of dict-variable, if not given the whole variable is saved.
+         
+        """
+        self._bump_version(name)
+        if '_method_caches' in self.__dict__:
+            self._invalidate_caches(name)
+        if not name.startswith('pst'):
+            return
+        with self._pst_lock():
+            dirty = self.__dict__.setdefault('_pst_dirty', {})
+            if keys and dirty.get(name, ()) is not None:
+                dirty.setdefault(name, set()).update(keys)
+            else:
+                dirty[name] = None
+
+    def _bump_version(self, name):
+        """ Give attribute name a new version, versions are unique within the Malacoda.
+        """
+        versions = self.__dict__.get('_attr_versions')
+        if versions is None:
+            versions = self.__dict__.setdefault('_attr_versions', {})
+            self.__dict__.setdefault('_attr_version_counter', itertools.count(1))
+        versions[name] = next(self.__dict__['_attr_version_counter'])
+
+    def _attr_version(self, name):
+        """ Return version of attribute name, or None if its changes are not tracked,
+        which is the case for properties. The version includes a random epoch so that
+        versions are not reused when the Malacoda is restarted.
+        """
+        if isinstance(getattr(type(self), name, None), property):
+            return None
+        return self._attr_epoch << 32 | self.__dict__.get('_attr_versions', {}).get(name, 0)
+
+    def _method_cache(self, method):
+        """ Return cache of method decorated with cached, it is created on first use.
+        """
+        caches = self.__dict__.setdefault('_method_caches', {})
+        try:
+            return caches[method.__name__][1]
+        except KeyError:
+            cache = util.LRUCache(method.cache_maxsize, method.cache_ttl)
+            return caches.setdefault(method.__name__, (method.cache_depends, cache))[1]
+
+    def _invalidate_caches(self, name):
+        """ Clear caches of methods that depend on attribute name.
+        """
+        for depends, cache in self.__dict__['_method_caches'].values():
+            if depends is None and name.startswith('pst') or depends and name in depends:
+                cache.clear()
+
+    def _cache_stats(self):
+        """ Return statistics of the caches of methods decorated with cached.
+
+        Returns:
+         - (dict): {name of method: {'size', 'hits', 'misses'}}
+         
+        """
+        return dict((name, cache.stats()) for name, (_, cache) in
+                    self.__dict__.get('_method_caches', {}).items())
+
+    def _pst_lock(self):
+        return self.__dict__.setdefault('_pst_dirty_lock', threading.RLock())
+
+    def _pop_dirty(self):
+        """ Return changed pst-variables and clear them.
+
+        Returns:
+         - (dict): {name: set of changed keys or None if whole variable has changed}
+         
+        """
+        with self._pst_lock():
+            dirty = self.__dict__.get('_pst_dirty', {})
+            self.__dict__['_pst_dirty'] = {}
+        return dirty
+
+    def _mark_dirty_again(self, dirty):
+        """ Mark variables returned from _pop_dirty as changed again.
+        """
+        for name, keys in dirty.iteritems():
+            self.mark_dirty(name, *(keys or ()))
 
     def _load_pst(self):
-        """ Load variables from persistant storage. """
-        psts = self.persistant_storage.load()
-        if psts:
+        """ Load variables from persistant storage.
+        If the storage is lazy, variables are loaded by __getattr__ when first accessed,
+        so their default values are removed.
+        """
+        storage = self.persistant_storage
+        if storage.lazy:
+            names = storage.names()
+            with self._pst_lock():
+                for name in names:
+                    self.__dict__.pop(name, None)
+                self.__dict__['_pst_lazy'] = set(names)
+        else:
+            psts = storage.load() or []
+            names = [name for name, _ in psts]
             for name, value in psts:
                 setattr(self, name, value)
+        with self._pst_lock():
+            for name in names:
+                self.__dict__.get('_pst_dirty', {}).pop(name, None)
 
     def _pst_handler(self):
-        """ Loop that calls self.persistant_storage.save. """
+        """ Loop that calls self.persistant_storage.save with the pst-variables that have
+        changed since last save.
+        """
         self.last_pst = datetime.utcnow()
         while self.running:
+            self._check_forked_save()
             if self.last_pst + self.persistant_storage.frequency <= datetime.utcnow():
-                psts = [(name, (getattr(self, name))) for name in dir(self)
-                        if name.startswith('pst')]
-                if psts:
-                    self.persistant_storage.save(psts)
+                self._save_pst()
                 self.last_pst = datetime.utcnow()
             time.sleep(5)
 
+    def _save_pst(self):
+        """ Save changed pst-variables, they are marked as changed again if saving fails.
+        If the persistant storage has snapshot_mode 'fork', the variables are saved in a
+        child process, no new save is started until the previous one has finished.
+        """
+        if self._check_forked_save():
+            return
+        dirty = self._pop_dirty()
+        psts = [(name, getattr(self, name)) for name in sorted(dirty) if hasattr(self, name)]
+        if not psts:
+            return
+        keys = dict((name, keys) for name, keys in dirty.iteritems() if keys is not None)
+        if self.persistant_storage.snapshot_mode == 'fork':
+            self._forked_save = (self.persistant_storage.fork_save(psts, keys), dirty)
+            return
+        try:
+            self.persistant_storage.save(psts, keys)
+        except Exception as e:
+            self.logger.error('Could not save pst-variables: %s' % e)
+            self._mark_dirty_again(dirty)
+
+    def _check_forked_save(self):
+        """ Check if forked save has finished, if so log and store its report in
+        self.last_pst_report. Variables are marked as changed again if it failed.
+
+        Returns:
+         - (bool): True if a forked save is still running.
+         
+        """
+        if self._forked_save is None:
+            return False
+        forked_save, dirty = self._forked_save
+        report = forked_save.poll()
+        if report is None:
+            return True
+        self._forked_save = None
+        self.last_pst_report = report
+        if report['error']:
+            self.logger.error('Could not save pst-variables: %s' % report['error'])
+            self._mark_dirty_again(dirty)
+        else:
+            self.logger.info('Saved pst-variables in %.3f s' % report['duration'])
+        return False
+
     def evaluate(self, msg):
         """ Evaluate message and return result.
+        The correlation id of the request is copied to the reply, and the reply is
+        encoded with the codec of the request unless self.codec is set.
+        The reply also carries the version of the method table, so that proxies know
+        when their cached method table is outdated.
+        Messages that do not await reply are put in the call queue, the reply is then an
+        acknowledgement with value True, or False if the queue is full.
 
         Args:
          - msg (REQMessage): The message.
         Returns:
          - (REPMessage) The reply message.
          
+        """
+        if not msg.await_reply:
+            rep_msg = REPMessage(typ=MSG_TYPES.ack, val=self.call_queue.put(msg))
+        else:
+            rep_msg = self._evaluate(msg)
+        rep_msg.msg_id = msg.msg_id
+        rep_msg.codec = self.codec or msg.codec
+        rep_msg.methods_version = self._methods_version
+        return rep_msg
+
+    def _evaluate(self, msg):
+        """ Evaluate message as getattr, setattr or call.
         """
         if msg.is_getattr:
             return self._getattr(msg)
@@ -186,7 +565,8 @@ class Malacoda(daemon.DaemonContext):
         The reply message can contain any of the following:
          - An exception if the getattr-call failed.
          - Name of a callable method in this class.
-         - A value from the getattr-call.
+         - A value from the getattr-call, with the version of the attribute.
+         - not_modified if the version of the attribute is msg.if_version.
 
         Args:
          - msg (REQMessage): The message.
@@ -194,6 +574,11 @@ class Malacoda(daemon.DaemonContext):
          - (REPMessage): The reply message.
          
         """
+        # the version is read before the value, so a concurrent change gives a newer
+        # value with an older version and never the other way around
+        version = self._attr_version(msg.args[1]) if msg.args[0] == 'self' else None
+        if version is not None and msg.if_version == version:
+            return REPMessage(typ=MSG_TYPES.not_modified, version=version)
         try:
             val = getattr(eval(msg.args[0]), msg.args[1])
         except AttributeError as e:
@@ -202,7 +587,7 @@ class Malacoda(daemon.DaemonContext):
             if callable(val):
                 rep_msg = REPMessage(typ=MSG_TYPES.method, val=val.__name__)
             else:
-                rep_msg = REPMessage(typ=MSG_TYPES.value, val=val)
+                rep_msg = REPMessage(typ=MSG_TYPES.value, val=val, version=version)
         return rep_msg
 
     def _setattr(self, msg):
@@ -220,14 +605,193 @@ class Malacoda(daemon.DaemonContext):
         except Exception as e:
             rep_msg = REPMessage(typ=MSG_TYPES.exception, val=e)
         else:
+            if msg.args[0] == 'self' and (callable(msg.args[2]) or
+                                          msg.args[1] in (self._method_table or ())):
+                self._invalidate_method_table()
             rep_msg = REPMessage(typ=MSG_TYPES.value, val=None)
         return rep_msg
 
+    def _malacoda_describe(self):
+        """ Return the method table of this Malacoda.
+        Proxies call this to find out which attributes are methods, so that a method call
+        does not need a getattr-call first.
+
+        Returns:
+         - (dict): {'methods': list of names of callable attributes,
+                    'version': version of the method table,
+                    'push_port': port of PULL-socket for calls without acknowledgement,
+                    'pub_port': port of PUB-socket that is published to}
+         
+        """
+        if self._method_table is None:
+            methods = []
+            for name in dir(self):
+                try:
+                    if callable(getattr(self, name)):
+                        methods.append(name)
+                except Exception:
+                    pass
+            self._method_table = methods
+        return {'methods': self._method_table, 'version': self._methods_version,
+                'push_port': self.push_port, 'pub_port': self.pub_port}
+
+    def _stats_name(self, msg):
+        """ Return name that request msg is recorded as in the request statistics.
+        """
+        if msg.is_getattr or msg.is_setattr or \
+           msg.fn_name in self._malacoda_describe()['methods']:
+            return msg.fn_name
+        return stats.UNKNOWN
+
+    def publish(self, topic, payload):
+        """ Send payload to the subscribers of topic on the publish channel.
+        Subscribers match the start of topic, so subscribers of 'prices' receive payloads
+        published on both 'prices' and 'prices.EUR'. As with any PUB-socket, payloads are
+        dropped if there are no subscribers or if a subscriber does not keep up.
+
+        Args:
+         - topic (basestring): Topic of payload.
+         - payload: Value that is encoded with the codec of the Malacoda.
+        Raises:
+         - MalacodaException if the Malacoda has no publish channel.
+         
+        """
+        if not self.publish_channel:
+            raise MalacodaException('Malacoda has no publish channel')
+        if self._publisher is not None:
+            self._publisher.publish(topic, payload)
+
+    def _malacoda_batch(self, requests, parallel=False):
+        """ Evaluate many requests, used by proxy.Batch to send many requests in one message.
+
+        Args:
+         - requests (list): Serialized REQMessages.
+         - parallel (bool): If True, evaluate requests in parallel, else in order.
+        Returns:
+         - (list): Serialized REPMessages, one per request.
+         
+        """
+        if not parallel:
+            return [self._batch_item(payload) for payload in requests]
+        if self._batch_pool is None:
+            self._batch_pool = ThreadPool(self.BATCH_WORKERS)
+        return self._batch_pool.map(self._batch_item, requests)
+
+    def _batch_item(self, payload):
+        """ Evaluate serialized request of a batch and return serialized reply.
+        If the reply can not be serialized, an exception telling so is returned instead,
+        so that the other requests of the batch still get their replies.
+        """
+        rep_msg = self.evaluate(REQMessage.deserialize(payload))
+        try:
+            return rep_msg.serialize()
+        except Exception as e:
+            return REPMessage(typ=MSG_TYPES.exception, msg_id=rep_msg.msg_id,
+                              codec=rep_msg.codec,
+                              val=MalacodaException('Could not serialize reply: %s' % e)
+                              ).serialize()
+
+    def _call_queue_stats(self):
+        """ Return statistics of the queue of calls made with await_reply=False.
+
+        Returns:
+         - (dict): {'depth': number of queued calls, 'queued': total number of queued calls,
+                    'dropped': number of calls dropped because queue was full,
+                    'executed': number of evaluated calls, 'failed': number of calls
+                    that raised an exception}
+         
+        """
+        return self.call_queue.stats()
+
+    def _malacoda_stats(self):
+        """ Return statistics of the requests to this Malacoda.
+
+        Returns:
+         - (dict): {'uptime': seconds since start,
+                    'methods': {name: {'calls', 'errors', 'bytes_in', 'bytes_out',
+                                       'deserialize_time', 'execute_time',
+                                       'serialize_time', 'latency', 'queue_wait'}},
+                    'latency', 'queue_wait': histogram summaries over all methods,
+                    'call_queue': see _call_queue_stats,
+                    'streams': number of open streams,
+                    'work': see _work_stats,
+                    'caches': see _cache_stats}
+                    Histogram summaries are dicts with count, mean, max and
+                    percentiles, see stats.Histogram.summary.
+         
+        """
+        summary = self.request_stats.summary()
+        summary['call_queue'] = self.call_queue.stats()
+        summary['streams'] = len(self._streams)
+        summary['work'] = self._work_stats()
+        summary['caches'] = self._cache_stats()
+        return summary
+
+    def _profile_start(self, mode='sample', interval_ms=10, max_duration=300):
+        """ Start profiling the threads of this Malacoda, the result is returned by
+        _profile_stop.
+
+        Args:
+         - mode (basestring): Only 'sample' is supported, the stacks of all threads are
+                              sampled, see profiler.SamplingProfiler.
+         - interval_ms (float): Milliseconds between samples.
+         - max_duration (float): Seconds after which sampling stops if _profile_stop has
+                                 not been called.
+        Raises:
+         - MalacodaException: If mode is unknown or the profiler is already running.
+         
+        """
+        if mode != 'sample':
+            raise MalacodaException('Unknown profiler mode: %s' % mode)
+        if self._profiler is not None:
+            raise MalacodaException('Profiler is already running')
+        self._profiler = profiler.SamplingProfiler(interval_ms / 1000.0, max_duration)
+        self._profiler.start()
+
+    def _profile_stop(self):
+        """ Stop profiler started with _profile_start and return its result.
+
+        Returns:
+         - (dict): {'stacks': collapsed stacks for flamegraph.pl, 'samples', 'duration',
+                    'interval', 'dropped'}, see profiler.SamplingProfiler.stop.
+        Raises:
+         - MalacodaException: If the profiler is not running.
+         
+        """
+        if self._profiler is None:
+            raise MalacodaException('Profiler is not running')
+        result = self._profiler.stop()
+        self._profiler = None
+        return result
+
+    def _stats_exporter(self):
+        """ Loop that writes the statistics to self.stats_file.
+        """
+        while self.running:
+            queue_stats = self.call_queue.stats()
+            gauges = {'call_queue_depth': queue_stats['depth'],
+                      'call_queue_dropped': queue_stats['dropped'],
+                      'streams': len(self._streams)}
+            try:
+                self.request_stats.write_prometheus(self.stats_file, {'daemon': self.name},
+                                                    gauges)
+            except (IOError, OSError) as e:
+                self.logger.error('Could not write stats file: %s' % e)
+            time.sleep(self.STATS_INTERVAL)
+
+    def _invalidate_method_table(self):
+        """ Recreate method table on next describe and tell proxies that it has changed.
+        """
+        self._method_table = None
+        self._methods_version = self._methods_version % 0xffffffff + 1
+
     def _call(self, msg):
         """ Perform call on this class and return reply message with result of call.
         The reply message can contain any of the following:
          - An exception if the call failed.
          - The result of the call
+         - The first chunk of a stream if the result is a generator or iterator, see
+           _open_stream.
 
         Args:
          - msg (REQMessage): The message.
@@ -236,44 +800,333 @@ class Malacoda(daemon.DaemonContext):
          
         """
         try:
-            val = getattr(self, msg.fn_name)(*msg.args, **msg.kwargs)
+            method = getattr(self, msg.fn_name)
+            if getattr(method, 'offload_pool', None) in self._offload_pools:
+                return self._offload(method, msg)
+            val = method(*msg.args, **msg.kwargs)
+            if _is_iterator(val):
+                return REPMessage(typ=MSG_TYPES.stream, val=self._open_stream(val))
         except Exception as e:
             rep_msg = REPMessage(typ=MSG_TYPES.exception, val=e)
         else:
             rep_msg = REPMessage(typ=MSG_TYPES.call, val=val)
         return rep_msg
 
+    def _open_stream(self, iterator):
+        """ Keep iterator so that proxies can fetch its items in chunks, return the first
+        chunk. Streams that have not been read for STREAM_TTL seconds are closed.
+
+        Returns:
+         - (dict): {'id': id of stream, 'items': list of items, 'done': True if there are
+                    no more items}
+         
+        """
+        now = time.time()
+        with self._streams_lock:
+            for stream_id, stream in self._streams.items():
+                if stream[2] + self.STREAM_TTL < now:
+                    del self._streams[stream_id]
+            stream_id = next(self._stream_ids)
+            self._streams[stream_id] = [iterator, threading.Lock(), now]
+        chunk = self._malacoda_stream(stream_id, self.STREAM_CHUNK_SIZE)
+        chunk['id'] = stream_id
+        return chunk
+
+    def _malacoda_stream(self, stream_id, credit):
+        """ Return next chunk of at most credit items from stream.
+
+        Returns:
+         - (dict): {'items': list of items, 'done': True if there are no more items}
+         
+        """
+        with self._streams_lock:
+            try:
+                stream = self._streams[stream_id]
+            except KeyError:
+                raise MalacodaException('Unknown or expired stream: %s' % stream_id)
+            stream[2] = time.time()
+        with stream[1]:
+            try:
+                items = list(itertools.islice(stream[0], credit))
+            except:
+                self._malacoda_stream_close(stream_id)
+                raise
+        done = len(items) < credit
+        if done:
+            self._malacoda_stream_close(stream_id)
+        return {'items': items, 'done': done}
+
+    def _malacoda_stream_close(self, stream_id):
+        """ Close stream before all items have been read.
+        """
+        with self._streams_lock:
+            self._streams.pop(stream_id, None)
+
     def stop(self):
         """ Stop the daemon. """
         self.logger.info('Stopping')
         self.running = False
+        for work_loop in self._work_loops.itervalues():
+            work_loop.stop()
+        # stop may be called in forked processes too, only the owner closes the pools
+        if self._offload_pid == os.getpid():
+            for pool in self._offload_pools.itervalues():
+                pool.close()
+        if self._publisher is not None:
+            self._publisher.close()
         if self.daemonize:
             self.close()
 
 
+def offload(pool='process'):
+    """ Decorator for methods of a Malacoda that should be evaluated in a pool instead of
+    in the thread that handles the request.
+    With pool 'process' the method is evaluated in a pool of processes, so CPU-bound
+    methods do not hold the GIL of the daemon and can use many cores. The processes are
+    forked when the Malacoda starts, so the method should only depend on its arguments.
+    With pool 'thread' the method is evaluated in a pool of threads, which limits how
+    many calls of it are evaluated at the same time.
+
+    Args:
+     - pool (basestring): 'process' or 'thread'.
+     
+    """
+    if pool not in ('process', 'thread'):
+        raise MalacodaException('Unknown offload pool: %s' % pool)
+
+    def decorator(fn):
+        fn.offload_pool = pool
+        return fn
+    return decorator
+
+
+_missing = object()
+
+def cached(ttl=None, maxsize=1000, key=None, depends=None):
+    """ Decorator for methods of a Malacoda whose results should be cached.
+    Each Malacoda has its own cache per method, with at most maxsize results where the
+    least recently used is evicted first. The cache is cleared when an attribute that
+    the method depends on is set, or when mark_dirty is called for it.
+    Calls with arguments that can not be hashed are not cached, nor are results that are
+    generators or iterators, since they can only be iterated over once.
+
+    Args:
+     - ttl (float): Seconds that results are cached, None means until invalidated.
+     - maxsize (int): Max number of cached results.
+     - key (callable): Function of the arguments of the method that returns the cache
+                       key, by default the arguments are the key.
+     - depends (list): Names of the attributes that the results depend on, by default
+                       the results depend on all pst-variables.
+                       
+    """
+    def decorator(fn):
+        @wraps(fn)
+        def wrapper(self, *args, **kwargs):
+            if key is not None:
+                cache_key = key(*args, **kwargs)
+            else:
+                cache_key = (args, tuple(sorted(kwargs.iteritems())))
+            try:
+                hash(cache_key)
+            except TypeError:
+                return fn(self, *args, **kwargs)
+            cache = self._method_cache(wrapper)
+            value = cache.get(cache_key, _missing)
+            if value is _missing:
+                generation = cache.generation
+                value = fn(self, *args, **kwargs)
+                # do not cache result if the cache was invalidated during the call
+                if generation == cache.generation and not _is_iterator(value):
+                    cache.put(cache_key, value)
+            return value
+        wrapper.cache_ttl = ttl
+        wrapper.cache_maxsize = maxsize
+        wrapper.cache_depends = frozenset(depends) if depends is not None else None
+        return wrapper
+    return decorator
+
+
+def _is_iterator(val):
+    """ Return True if val is a generator or an iterator, which are streamed to clients.
+    """
+    return isinstance(val, types.GeneratorType) or \
+        (hasattr(val, 'next') and iter(val) is val)
+
+
+# Malacoda whose methods are evaluated by the processes of its offload pool
+_offload_target = None
+
+def _offload_call(payload):
+    """ Evaluate serialized request on _offload_target and return serialized reply,
+    this is run in the processes of the offload pool.
+    """
+    msg = REQMessage.deserialize(payload)
+    try:
+        val = getattr(_offload_target, msg.fn_name)(*msg.args, **msg.kwargs)
+        return REPMessage(typ=MSG_TYPES.call, val=val, codec=msg.codec).serialize()
+    except Exception as e:
+        return REPMessage(typ=MSG_TYPES.exception, val=e, codec=msg.codec).serialize()
+
+
+class WorkLoop(object):
+    """ Calls a work-method of a Malacoda over and over in replicas threads, or in
+    replicas processes if mode is 'process', until the Malacoda is stopped.
+    If the method returns a number, the replica waits that many seconds before the next
+    call, e.g. when there was nothing to do. If it raises an exception, the exception is
+    logged and the replica waits ERROR_DELAY seconds.
+    Processes run in a forked copy of the Malacoda, so changes they make to its
+    attributes are not seen by the daemon, they are meant for CPU-bound work. They are
+    forked when the Malacoda starts, before it starts any threads.
+    
+    """
+    MODES = ('thread', 'process')
+    ERROR_DELAY = 1
+
+    def __init__(self, malacoda_obj, name, replicas=1, mode='thread'):
+        """ Init WorkLoop.
+
+        Args:
+         - malacoda_obj (Malacoda): The Malacoda that has the work-method.
+         - name (basestring): Name of the work-method.
+         - replicas (int): Number of threads or processes calling the method.
+         - mode (basestring): 'thread' or 'process'.
+        Raises:
+         - MalacodaException: If mode is unknown.
+         
+        """
+        if mode not in self.MODES:
+            raise MalacodaException('Unknown mode of %s: %s' % (name, mode))
+        self.malacoda_obj = malacoda_obj
+        self.name = name
+        self.replicas = replicas
+        self.mode = mode
+        self.workers = []
+        self.started = None
+        # shared memory so that processes can report their progress
+        self.stop_event = multiprocessing.Event()
+        self.iterations = multiprocessing.Value('L', 0)
+        self.errors = multiprocessing.Value('L', 0)
+        self.last_iteration = multiprocessing.Value('d', 0.0)
+        self.last_error = multiprocessing.Array('c', 256)
+
+    def start(self):
+        self.started = time.time()
+        for i in xrange(self.replicas):
+            name = '%s-%s' % (self.name, i)
+            if self.mode == 'thread':
+                worker = threading.Thread(target=self._loop, name=name)
+            else:
+                worker = multiprocessing.Process(target=self._loop, name=name)
+            worker.daemon = True
+            worker.start()
+            self.workers.append(worker)
+
+    def _loop(self):
+        work = getattr(self.malacoda_obj, self.name)
+        while self.malacoda_obj.running and not self.stop_event.is_set():
+            try:
+                delay = work()
+            except Exception as e:
+                self.malacoda_obj.logger.error('%s failed: %s' % (self.name, e))
+                with self.errors.get_lock():
+                    self.errors.value += 1
+                self.last_error.value = repr(e)[:255]
+                delay = self.ERROR_DELAY
+            else:
+                with self.iterations.get_lock():
+                    self.iterations.value += 1
+                self.last_iteration.value = time.time()
+            if isinstance(delay, (int, long, float)) and not isinstance(delay, bool) \
+               and delay > 0:
+                self.stop_event.wait(delay)
+
+    def stop(self):
+        self.stop_event.set()
+
+    def join(self, timeout=None):
+        for worker in self.workers:
+            worker.join(timeout)
+
+    def stats(self):
+        """ Return health and throughput of the work-method.
+
+        Returns:
+         - (dict): {'mode': 'thread' or 'process', 'replicas': number of replicas,
+                    'alive': number of replicas that are running,
+                    'iterations': number of calls that returned,
+                    'errors': number of calls that raised an exception,
+                    'last_error': repr of last exception or None,
+                    'idle': seconds since a call last returned, None if none has,
+                    'rate': calls per second since start}
+         
+        """
+        now = time.time()
+        last_iteration = self.last_iteration.value
+        return {'mode': self.mode, 'replicas': self.replicas,
+                'alive': sum(worker.is_alive() for worker in self.workers),
+                'iterations': self.iterations.value, 'errors': self.errors.value,
+                'last_error': self.last_error.value or None,
+                'idle': now - last_iteration if last_iteration else None,
+                'rate': self.iterations.value / (now - self.started) if self.started else 0.0}
+
+
 class MsgListenerThread(threading.Thread):
     """ MsgListenerThread listens to incoming request messages, evalutes these
     and returns reply message.
+    If workers is set, the listener binds a ROUTER-socket and forwards the requests
+    to a pool of MsgWorkerThreads that evaluates them in parallel. A request is only
+    forwarded to a worker that has told the listener it is ready, so requests wait in the
+    listener, not behind a slow call in a busy worker.
+    Besides tcp, the socket is bound to an ipc-endpoint, a Unix socket under
+    registry.RUNTIME_DIR, and an inproc-endpoint, so that clients on the same host or in
+    the same process can use faster transports.
+    The port and endpoints are registered in the local registry, and the port with the
+    discovery daemon if given, as long as the Malacoda is running.
+    Requests with an idempotency key are evaluated once: a duplicate that arrives while
+    the request is evaluated waits up to ONGOING_WAIT seconds for its reply, and replies
+    are kept in a cache of RESULT_CACHE_SIZE entries and RESULT_CACHE_BYTES serialized
+    bytes for RESULT_CACHE_TTL seconds to answer later retries. Replies that are larger
+    than RESULT_CACHE_BYTES are not cached.
     
     """
     BIND_ADDRESS = '0.0.0.0'
     PORT_RANGE = (51000, 51100)
+    CHANNEL_PORT_RANGE = (51200, 51300)
+    WORKER_ADDRESS = 'inproc://malacoda-workers-%s'
+    WORKER_READY = '\x01'
+    INPROC_ADDRESS = 'inproc://malacoda-%s'
+    RESULT_CACHE_SIZE = 10000
+    RESULT_CACHE_BYTES = 64 * 1024 * 1024
+    RESULT_CACHE_TTL = 600
+    ONGOING_WAIT = 10
+    TIMESTAMP = struct.Struct('!d')
 
-    def __init__(self, malacoda_obj, bind_address=None, port=None):
+    def __init__(self, malacoda_obj, bind_address=None, port=None, workers=0,
+                 discovery=None):
         """ Init MsgListenerThread.
 
         Args:
          - malacoda_obj (Malacoda): The Malacoda-object that evaluates the requests.
          - bind_address (basestring): Address to bind listener to, host:port or just host.
          - port (int): Optional port to bind listener to.
+         - workers (int): Number of worker threads, 0 means evaluate requests in this thread.
+         - discovery (basestring): Optional address, host:port, of discovery daemon.
          
         """
         threading.Thread.__init__(self)
         self.malacoda_obj = malacoda_obj
         self.bind_address = bind_address or self.BIND_ADDRESS
         self.port = port
+        self.workers = workers
+        self.discovery = discovery
+        self.context = None
         self.socket = None
+        self.backend = None
+        self.endpoints = {}
         self.ongoing_calls = {}
+        self.ongoing_lock = threading.Lock()
+        self.results = util.LRUCache(self.RESULT_CACHE_SIZE, self.RESULT_CACHE_TTL,
+                                     maxbytes=self.RESULT_CACHE_BYTES)
         self._connect()
         
     def _connect(self):
@@ -285,37 +1138,429 @@ class MsgListenerThread(threading.Thread):
         """
         if not self.socket is None:
             self.socket.close()
-        context = zmq.Context()
-        self.socket = Socket(context, zmq.REP, default_timeout=None)
-        if self.port:
-            self.socket.bind('tcp://%s:%s' % (self.bind_address, self.port))
+        self.context = get_context()
+        stype = zmq.ROUTER if self.workers else zmq.REP
+        self.socket = Socket(self.context, stype, default_timeout=None)
+        self.port = self.bind(self.socket, self.bind_address, self.port)
+        self.endpoints = self._bind_local()
+
+    def _bind_local(self):
+        """ Bind listening socket to ipc- and inproc-endpoints, endpoints that can not
+        be bound are skipped.
+
+        Returns:
+         - (dict): {'ipc': endpoint, 'inproc': endpoint}
+         
+        """
+        name = self.malacoda_obj.name
+        endpoints = {}
+        path = registry.ipc_path(name)
+        transports = [('inproc', self.INPROC_ADDRESS % name)]
+        try:
+            registry.make_private_dir(registry.RUNTIME_DIR)
+            registry.make_private_dir(os.path.dirname(path))
+        except (OSError, registry.RegistryException) as e:
+            self.malacoda_obj.logger.warning('Could not create %s: %s' % (path, e))
+        else:
+            transports.insert(0, ('ipc', 'ipc://%s' % path))
+        for transport, endpoint in transports:
+            try:
+                self.socket.bind(endpoint)
+            except zmq.ZMQError as e:
+                self.malacoda_obj.logger.warning('Could not bind %s: %s' % (endpoint, e))
+            else:
+                endpoints[transport] = endpoint
+        return endpoints
+
+    @classmethod
+    def bind(cls, sock, bind_address, port=None, port_range=None):
+        """ Bind socket to port, or to a free port in port_range if port is not given.
+        The default port_range is PORT_RANGE, which is only used for listeners, other
+        sockets of a Malacoda use CHANNEL_PORT_RANGE so that their ports are not mistaken
+        for the port of the listener.
+
+        Returns:
+         - (int): The port.
+        Raises:
+         - MalacodaException - If no free ports can be find to connect to.
+         
+        """
+        if port:
+            sock.bind('tcp://%s:%s' % (bind_address, port))
+            return port
+        for port in xrange(*(port_range or cls.PORT_RANGE)):
+            try:
+                sock.bind('tcp://%s:%s' % (bind_address, port))
+                return port
+            except (socket.timeout, zmq.ZMQError):
+                pass
+        raise MalacodaException('Could not find free port to connect to')
+
+    def _start_workers(self):
+        """ Bind backend socket and start worker threads that connects to it.
+        """
+        self.backend = Socket(self.context, zmq.ROUTER, default_timeout=None)
+        address = self.WORKER_ADDRESS % id(self)
+        self.backend.bind(address)
+        for _ in xrange(self.workers):
+            MsgWorkerThread(self, address).start()
+
+    def handle(self, frames, queue_wait=None):
+        """ Deserialize request, evaluate it and return serialized reply.
+        The request is recorded in the statistics of the Malacoda.
+        A request that can not be deserialized is not evaluated, since the REP-sockets
+        must send a reply an exception without correlation id is returned for it.
+        If the reply can not be serialized, e.g. a value that can not be pickled, an
+        exception telling so is returned instead.
+
+        Args:
+         - frames (list): REQMessage serialized into frames.
+         - queue_wait (float): Seconds the request waited for a worker, if known.
+        Returns:
+         - (list): REPMessage serialized into frames.
+         
+        """
+        start = time.time()
+        try:
+            msg = REQMessage.deserialize_frames(frames)
+        except Exception as e:
+            self.malacoda_obj.logger.warning('Could not deserialize request: %r' % e)
+            return REPMessage(typ=MSG_TYPES.exception,
+                              val=MalacodaException('Could not deserialize request: %s' % e)
+                              ).serialize_frames()
+        deserialized = time.time()
+        rep_frames = None
+        if msg.idempotency_key is None:
+            rep_msg = self.malacoda_obj.evaluate(msg)
         else:
-            for port in xrange(self.PORT_RANGE[0], self.PORT_RANGE[1]):
+            rep_msg, rep_frames = self._evaluate_once(msg)
+        executed = time.time()
+        try:
+            if rep_frames is None:
+                rep_frames = rep_msg.serialize_frames()
+        except Exception as e:
+            rep_msg = REPMessage(typ=MSG_TYPES.exception, msg_id=msg.msg_id, codec=msg.codec,
+                                 val=MalacodaException('Could not serialize reply: %s' % e))
+            rep_frames = rep_msg.serialize_frames()
+        self.malacoda_obj.request_stats.record(
+            self.malacoda_obj._stats_name(msg), error=rep_msg.typ == MSG_TYPES.exception,
+            bytes_in=sum(len(frame) for frame in frames),
+            bytes_out=sum(len(frame) for frame in rep_frames),
+            deserialize_time=deserialized - start, execute_time=executed - deserialized,
+            serialize_time=time.time() - executed, queue_wait=queue_wait)
+        return rep_frames
+
+    def _evaluate_once(self, msg):
+        """ Evaluate request with idempotency key, unless a request with the same key
+        is being evaluated or has been evaluated, its reply is then returned.
+        The reply is serialized to find its size for the cache, the frames are returned
+        with it so that it is not serialized again. They are None for duplicates, since
+        their reply has another correlation id, and if the reply can not be serialized.
+        """
+        key = msg.idempotency_key
+        with self.ongoing_lock:
+            rep_msg = self.results.get(key)
+            ongoing = self.ongoing_calls.get(key)
+            if rep_msg is None and ongoing is None:
+                ongoing = self.ongoing_calls[key] = [threading.Event(), None]
+                owner = True
+            else:
+                owner = False
+        if owner:
+            rep_frames = None
+            try:
+                rep_msg = self.malacoda_obj.evaluate(msg)
                 try:
-                    self.socket.bind('tcp://%s:%s' % (self.bind_address, port))
-                    return
-                except (socket.timeout, zmq.ZMQError):
+                    rep_frames = rep_msg.serialize_frames()
+                except Exception:
                     pass
-            raise MalacodaException('Could not find free port to connect to')
+                else:
+                    self.results.put(key, rep_msg,
+                                     size=sum(len(frame) for frame in rep_frames))
+            finally:
+                with self.ongoing_lock:
+                    del self.ongoing_calls[key]
+                ongoing[1] = rep_msg
+                ongoing[0].set()
+            return rep_msg, rep_frames
+        if rep_msg is None:
+            if not ongoing[0].wait(self.ONGOING_WAIT):
+                return REPMessage(typ=MSG_TYPES.exception, msg_id=msg.msg_id, codec=msg.codec,
+                                  val=MalacodaException('Request with the same idempotency '
+                                                        'key is still being evaluated')), None
+            rep_msg = ongoing[1]
+            if rep_msg is None:
+                rep_msg = REPMessage(typ=MSG_TYPES.exception, codec=msg.codec,
+                                     val=MalacodaException('Evaluation of request failed'))
+        # the reply is shared with the first request, copy it to set the correlation id
+        rep_msg = copy.copy(rep_msg)
+        rep_msg.msg_id = msg.msg_id
+        return rep_msg, None
 
     def run(self):
         """ Listen to incoming messages, handle these and return response.
 
         """
+        # a daemon thread, so that an unreachable discovery daemon can not keep the
+        # process alive, it is given some time to unregister below
+        registration = threading.Thread(target=registry.keep_registered,
+                                        args=(self.malacoda_obj, self.bind_address,
+                                              self.port, self.discovery, self.endpoints))
+        registration.daemon = True
+        registration.start()
+        if self.workers:
+            self._run_router()
+        else:
+            while self.malacoda_obj.running:
+                try:
+                    frames = self.socket.recv_multipart(copy=False, timeout=1)
+                except socket.timeout:
+                    continue
+                self.socket.send_multipart(self.handle(frames), copy=False, timeout=None)
+        if 'ipc' in self.endpoints:
+            try:
+                os.unlink(self.endpoints['ipc'][len('ipc://'):])
+            except OSError:
+                pass
+        registration.join(2 * registry.DISCOVERY_TIMEOUT + 1)
+
+    def _run_router(self):
+        """ Forward requests from the ROUTER-socket to idle worker threads and
+        replies from the workers back to the clients.
+        Workers send WORKER_READY when they start and then a reply for each request, so
+        a worker is idle when a message has been received from it. Requests are only
+        received from clients while some worker is idle.
+
+        """
+        self._start_workers()
+        idle = []
+        poller = zmq.Poller()
+        poller.register(self.backend.socket, zmq.POLLIN)
+        while self.malacoda_obj.running:
+            # flags 0 unregisters the socket, so requests are left queued in zmq
+            poller.register(self.socket.socket, zmq.POLLIN if idle else 0)
+            events = dict(poller.poll(1000))
+            if events.get(self.backend.socket) == zmq.POLLIN:
+                self._forward_reply(idle)
+            if idle and events.get(self.socket.socket) == zmq.POLLIN:
+                frames = self.socket.recv_multipart(copy=False)
+                lengths = [len(frame) for frame in frames]
+                if 0 in lengths:
+                    # after the routing envelope, add the time the request was received
+                    # so that the worker can tell how long it waited
+                    frames.insert(lengths.index(0) + 1, self.TIMESTAMP.pack(time.time()))
+                    self.backend.send_multipart([idle.pop(0), ''] + frames, copy=False)
+        # forward replies of calls that finished while stopping, e.g. the stop-call itself
+        while self.backend.poll(1000, zmq.POLLIN):
+            self._forward_reply(idle)
+
+    def _forward_reply(self, idle):
+        """ Receive message from a worker, which is then idle, and forward it to the
+        client unless it is WORKER_READY.
+        """
+        frames = self.backend.recv_multipart(copy=False)
+        idle.append(frames[0].bytes)
+        # frames[1] is the empty delimiter added by the REQ-socket of the worker
+        if frames[2].bytes != self.WORKER_READY:
+            self.socket.send_multipart(frames[2:], copy=False)
+
+
+class MsgWorkerThread(threading.Thread):
+    """ MsgWorkerThread evaluates requests forwarded by a MsgListenerThread.
+    It connects a REQ-socket to the listener and tells it that it is ready, after that
+    each reply tells the listener that it is ready for another request.
+    """
+
+    def __init__(self, listener, address):
+        """ Init MsgWorkerThread.
+
+        Args:
+         - listener (MsgListenerThread): The listener that forwards requests.
+         - address (basestring): Address of the listeners backend socket.
+         
+        """
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.listener = listener
+        self.socket = Socket(listener.context, zmq.REQ, default_timeout=None)
+        self.socket.connect(address)
+
+    def run(self):
+        """ Receive requests from listener, handle these and return response.
+        Requests are the routing envelope of the client, the time the request was
+        received and the request, the reply is sent with the same envelope.
+
+        """
+        self.socket.send(self.listener.WORKER_READY)
+        while self.listener.malacoda_obj.running:
+            try:
+                frames = self.socket.recv_multipart(copy=False, timeout=1)
+            except socket.timeout:
+                continue
+            split = [len(frame) for frame in frames].index(0) + 1
+            envelope = frames[:split]
+            received, = self.listener.TIMESTAMP.unpack(frames[split].bytes)
+            rep_frames = self.listener.handle(frames[split + 1:],
+                                              queue_wait=time.time() - received)
+            self.socket.send_multipart(envelope + rep_frames, copy=False, timeout=None)
+
+
+class PullListenerThread(threading.Thread):
+    """ PullListenerThread receives requests on a PULL-socket and puts them in the
+    call queue of the Malacoda, no reply is sent.
+    
+    """
+    def __init__(self, malacoda_obj, bind_address=None, port=None):
+        threading.Thread.__init__(self)
+        self.malacoda_obj = malacoda_obj
+        self.socket = Socket(get_context(), zmq.PULL, default_timeout=None)
+        self.port = MsgListenerThread.bind(self.socket,
+                                           bind_address or MsgListenerThread.BIND_ADDRESS, port,
+                                           MsgListenerThread.CHANNEL_PORT_RANGE)
+
+    def run(self):
         while self.malacoda_obj.running:
             try:
-                payload = self.socket.recv(timeout=1)
+                msg = self.socket.recv_message(REQMessage, timeout=1)
             except socket.timeout:
                 continue
-            msg = REQMessage.deserialize(payload) 
-            rep_msg = self.malacoda_obj.evaluate(msg)
-            self.socket.send(rep_msg.serialize() or '', timeout=None)
+            except Exception as e:
+                # there is no one to reply to, so the request is dropped
+                self.malacoda_obj.logger.warning('Could not deserialize request: %r' % e)
+                continue
+            self.malacoda_obj.call_queue.put(msg)
+
+
+class Publisher(object):
+    """ PUB-socket that a Malacoda publishes payloads to its subscribers with.
+    Messages are the topic followed by the frames of a REPMessage with the payload.
+    Publish can be called from any thread of the Malacoda, but not from forked processes.
+    zmq drops messages to subscribers that have SNDHWM messages queued.
+    
+    """
+    SNDHWM = 10000
+
+    def __init__(self, bind_address=None, port=None, codec=None):
+        self.socket = Socket(get_context(), zmq.PUB, default_timeout=None)
+        self.socket.setsockopt(zmq.SNDHWM, self.SNDHWM)
+        self.port = MsgListenerThread.bind(self.socket,
+                                           bind_address or MsgListenerThread.BIND_ADDRESS, port,
+                                           MsgListenerThread.CHANNEL_PORT_RANGE)
+        self.codec = codec
+        self.lock = threading.Lock()
+        self.pid = os.getpid()
+
+    def publish(self, topic, payload):
+        if os.getpid() != self.pid:
+            raise MalacodaException('Can not publish from a forked process')
+        if isinstance(topic, unicode):
+            topic = topic.encode('utf-8')
+        msg = REPMessage(typ=MSG_TYPES.value, val=payload, codec=self.codec)
+        frames = [topic] + msg.serialize_frames()
+        with self.lock:
+            if self.socket is not None:
+                self.socket.send_multipart(frames, timeout=None)
+
+    def close(self):
+        if os.getpid() != self.pid:
+            return
+        with self.lock:
+            if self.socket is not None:
+                self.socket.close(linger=0)
+                self.socket = None
+
+
+class CallQueue(object):
+    """ Bounded queue of calls that are evaluated by worker threads, used for calls
+    made with await_reply=False. Calls are dropped if the queue is full.
+    
+    """
+    def __init__(self, malacoda_obj, maxsize=10000, workers=1):
+        """ Init CallQueue.
+
+        Args:
+         - malacoda_obj (Malacoda): The Malacoda-object that evaluates the calls.
+         - maxsize (int): Max number of queued calls.
+         - workers (int): Number of threads evaluating calls.
+         
+        """
+        self.malacoda_obj = malacoda_obj
+        self.queue = Queue.Queue(maxsize)
+        self.workers = workers
+        self.lock = threading.Lock()
+        self.queued = 0
+        self.dropped = 0
+        self.executed = 0
+        self.failed = 0
+
+    def start(self):
+        for _ in xrange(self.workers):
+            thread = threading.Thread(target=self._work)
+            thread.daemon = True
+            thread.start()
+
+    def put(self, msg):
+        """ Put call in queue.
+
+        Returns:
+         - (bool): True if call was queued, False if it was dropped.
+         
+        """
+        try:
+            self.queue.put_nowait((time.time(), msg))
+        except Queue.Full:
+            with self.lock:
+                self.dropped += 1
+            return False
+        with self.lock:
+            self.queued += 1
+        return True
+
+    def _work(self):
+        while self.malacoda_obj.running:
+            try:
+                queued, msg = self.queue.get(timeout=1)
+            except Queue.Empty:
+                continue
+            start = time.time()
+            rep_msg = self.malacoda_obj._evaluate(msg)
+            failed = rep_msg.typ == MSG_TYPES.exception
+            self.malacoda_obj.request_stats.record(self.malacoda_obj._stats_name(msg),
+                                                   error=failed,
+                                                   execute_time=time.time() - start,
+                                                   queue_wait=start - queued)
+            if failed:
+                self.malacoda_obj.logger.error('Queued call to %s failed: %s'
+                                               % (msg.fn_name, rep_msg.val))
+            with self.lock:
+                self.executed += 1
+                self.failed += failed
+
+    def stats(self):
+        return {'depth': self.queue.qsize(), 'queued': self.queued, 'dropped': self.dropped,
+                'executed': self.executed, 'failed': self.failed}
 
     
-def get(name, **ssh_args):
+TRANSPORTS = (None, 'tcp', 'ipc', 'inproc')
+
+def get(name, mode='sync', codec=None, discovery=None, transport=None, attr_cache=False,
+        max_staleness=0, **ssh_args):
     """ Return proxy for daemon with given name.
     name should be on format <name>:<host>:<port> where host and port are optional
     if daemon is on localhost or if we know the port already.
+    If mode is 'async' an AsyncProxy is returned, its calls return futures instead of
+    waiting for the reply.
+    codec is the name of the codec used for encoding requests, see message.CODECS.
+    If the port is not given it is looked up in the local registry, or with the discovery
+    daemon at discovery (host:port, default registry.DISCOVERY_ADDRESS), in which case
+    host can also be left out for daemons on other hosts. If that fails, the port is
+    found with ps and lsof, over SSH for remote hosts.
+    The proxy connects with the fastest transport that the daemon can be reached with:
+    inproc if it runs in this process, ipc if it runs on this host and otherwise tcp.
+    A transport can also be chosen with transport, one of 'tcp', 'ipc' and 'inproc'.
+    If attr_cache is True, the proxy caches attribute values and only fetches them again
+    if they have changed, values at most max_staleness seconds old are returned without
+    asking the daemon, see proxy.AttrCache.
     Raise exception if no daemon with name is found/running.
     TODO: Test proxy connection, if not working return None
     
@@ -327,29 +1572,150 @@ def get(name, **ssh_args):
                 int(split[1])
             except ValueError:
                 daemon_name, host = split
-                port = _get_port(name, **ssh_args)
+                host, port = _resolve(daemon_name, host, discovery, **ssh_args)
             else:
                 host = 'localhost'
                 daemon_name, port = split
         else:
             daemon_name, host, port = split
     else:
-        host = 'localhost'
         daemon_name = name
-        port = _get_port(name, **ssh_args)
+        host, port = _resolve(daemon_name, None, discovery, **ssh_args)
     if not port:
         raise MalacodaException('Could not find port for process with name: %s' % name)
-    address = '%s:%s' % (host, port)
-    zp = proxy.Proxy(daemon_name, address)
+    address = _address(daemon_name, host, port, transport)
+    if mode == 'async':
+        return proxy.AsyncProxy(daemon_name, address, codec=codec)
+    zp = proxy.Proxy(daemon_name, address, codec=codec,
+                     attr_cache=proxy.AttrCache(max_staleness) if attr_cache else None)
     return zp
 
 
+def get_pool(name, hosts=None, routing='least_outstanding', codec=None, discovery=None,
+             health_interval=5, timeout=proxy.Pool.REQUEST_TIMEOUT, **ssh_args):
+    """ Return proxy.Pool that spreads requests over the daemons with given name.
+    The daemons are the ones on hosts, given as host or host:port, or if hosts is not
+    given all daemons with the name in the local registry and the discovery daemon.
+    Each is connected to over the fastest transport, as in get.
+
+    Args:
+     - name (basestring): Name of daemons.
+     - hosts (list): Optional hosts of daemons, a port is looked up if not given.
+     - routing (basestring): 'least_outstanding' or 'consistent_hash', see proxy.Pool.
+     - codec (basestring): Name of the codec used for encoding requests.
+     - discovery (basestring): Optional address, host:port, of discovery daemon.
+     - health_interval (int): Seconds between health checks of the daemons.
+     - timeout (int): Default timeout of requests in seconds, None for no timeout.
+    Returns:
+     - (proxy.Pool): The pool.
+    Raises:
+     - MalacodaException if no daemons are found or the port of a host is not found.
+
+    """
+    if hosts is None:
+        try:
+            entries = registry.lookup_all(name, discovery=discovery)
+        except Exception as e:
+            raise MalacodaException('Could not look up %s: %s' % (name, e))
+        hosts = ['%s:%s' % (entry['host'], entry['port']) for entry in entries]
+    if not hosts:
+        raise MalacodaException('Could not find any process with name: %s' % name)
+    addresses = []
+    for host in hosts:
+        host, _, port = host.partition(':')
+        if not port:
+            host, port = _resolve(name, host, discovery, **ssh_args)
+        if not port:
+            raise MalacodaException('Could not find port for %s on %s' % (name, host))
+        addresses.append(_address(name, host, port))
+    return proxy.Pool(name, addresses, routing=routing, codec=codec,
+                      health_interval=health_interval, timeout=timeout)
+
+
+def subscribe(name, topics=None, callback=None, timeout=None, codec=None, discovery=None,
+              connect_timeout=10, **ssh_args):
+    """ Subscribe to the payloads that daemon with given name publishes on topics, the
+    daemon must have been started with publish_channel=True.
+    Return a proxy.Subscriber that is iterated over to get (topic, payload) tuples, or if
+    callback is given, that calls callback(topic, payload) for every payload in a
+    separate thread. The subscription is ended with close.
+    Like all zmq subscriptions it takes a moment before it is set up, payloads published
+    before that are not received.
+
+    Args:
+     - name (basestring): Name of daemon, as in get.
+     - topics (list): Topics to subscribe to, matching the start of published topics,
+                      all topics if not given.
+     - callback (callable): Optional function that is called with each payload.
+     - timeout (int): Seconds to wait for each payload when iterating, default forever.
+     - codec (basestring): Codec used for asking the daemon for its publish channel.
+     - discovery (basestring): Optional address, host:port, of discovery daemon.
+     - connect_timeout (int): Seconds to wait for the daemon to tell its publish channel.
+    Returns:
+     - (proxy.Subscriber): The subscriber.
+    Raises:
+     - MalacodaException if the daemon has no publish channel.
+     - socket.timeout if the daemon does not reply within connect_timeout.
+
+    """
+    connection = get(name, codec=codec, discovery=discovery, **ssh_args).connection
+    connection.get_methods(codec, connect_timeout)
+    if not connection.pub_port:
+        raise MalacodaException('%s has no publish channel' % name)
+    subscriber = proxy.Subscriber(connection.tcp_address(connection.pub_port), topics,
+                                  timeout=timeout)
+    if callback is not None:
+        subscriber.listen(callback)
+    return subscriber
+
+
+def _resolve(name, host=None, discovery=None, **ssh_args):
+    """ Return (host, port) of daemon with given name, use registry if possible.
+    """
+    try:
+        entry = registry.lookup(name, host, discovery=discovery)
+    except registry.RegistryException as e:
+        raise MalacodaException(str(e))
+    except Exception:
+        # discovery daemon not reachable, fall back to ps and lsof
+        entry = None
+    if entry is not None:
+        return entry['host'], entry['port']
+    if host is None:
+        return 'localhost', _get_port(name, **ssh_args)
+    return host, _get_port('%s:%s' % (name, host), **ssh_args)
+
+
+def _address(name, host, port, transport=None):
+    """ Return address of daemon for given transport, or for the fastest transport that
+    it is bound to if transport is None. Endpoints other than tcp are found in the local
+    registry.
+    """
+    if transport not in TRANSPORTS:
+        raise MalacodaException('Unknown transport: %s' % transport)
+    entry = None
+    if transport != 'tcp' and (host in ('localhost', '127.0.0.1') or
+                               host in (socket.gethostname(), socket.getfqdn())):
+        entry = next((e for e in registry.local_registry.lookup_all(name)
+                      if str(e['port']) == str(port)), None)
+    if entry is not None:
+        if transport in (None, 'inproc') and entry.get('inproc') and \
+           entry['pid'] == os.getpid():
+            return entry['inproc']
+        if transport in (None, 'ipc') and entry.get('ipc'):
+            return entry['ipc']
+    if transport in (None, 'tcp'):
+        return '%s:%s' % (host, port)
+    raise MalacodaException('%s can not be reached over %s' % (name, transport))
+
+
 # TODO: this is perhaps not the best way..
+
 FIND_PID_CMD = "ps xa | awk '/[0-9] %s/ {print $1}'"
-FIND_PORT_CMD = "lsof -a -p%s | awk '/LISTEN/ {print $9}'"
+FIND_PORT_CMD = "lsof -a -p%s -iTCP -sTCP:LISTEN -P -n -Fn"
 
 def _get_port(name, **ssh_args):
-    """ Get port that pid is listening to.
+    """ Get port that pid is listening to, or None if it is not found.
     Would have preferred to use psutil for this, but not sure if I could make it
     work over SSH..
     
@@ -361,6 +1727,9 @@ def _get_port(name, **ssh_args):
     if not host:
         # look for Malacoda on local host
         pid = Popen(FIND_PID_CMD % name, stdout=PIPE, shell=True).communicate()[0].strip()
+        pid = pid.split('\n')[0]
+        if not pid.isdigit():
+            return None
         out = Popen(FIND_PORT_CMD % pid,  stdout=PIPE,
                     shell=True).communicate()[0]
     else:
@@ -372,10 +1741,33 @@ def _get_port(name, **ssh_args):
         pid = stdout.read().strip()
         if '\n' in pid:
             pid = pid.split('\n')[0]
+        if not pid.isdigit():
+            return None
         _, stdout, _ = client.exec_command(FIND_PORT_CMD % pid)
         out = stdout.read()
-    port = out.split(':')[1].strip()
-    return port
+    return _parse_port(out)
+
+def _parse_port(out):
+    """ Return the port of the listener from the output of FIND_PORT_CMD, or None.
+    Each listening socket is a line n<address>:<port>, ports of the other sockets of the
+    Malacoda are in CHANNEL_PORT_RANGE.
+
+    >>> _parse_port('p123\\nf12\\nn*:51200\\nf13\\nn*:51000\\n')
+    '51000'
+    >>> _parse_port('p123\\nf12\\nn[::1]:51001\\n')
+    '51001'
+    >>> _parse_port('') is None
+    True
+    
+    """
+    channels = MsgListenerThread.CHANNEL_PORT_RANGE
+    for line in out.splitlines():
+        if not line.startswith('n'):
+            continue
+        port = line.rsplit(':', 1)[-1]
+        if port.isdigit() and not channels[0] <= int(port) < channels[1]:
+            return port
+    return None
 
 def stop(name):
     """ Stop daemon with given name
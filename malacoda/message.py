@@ -16,42 +16,345 @@ Copyright 2014 Gustav Arngården
    limitations under the License.
 """
 
-import time
+import sys
+import struct
+import cPickle as pickle
 import util
-from cloud.serialization import serialize, deserialize
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
 
-MSG_TYPES = util.enum(unknown=0, getattr=1, value=2, method=3, call=4, exception=5)
+MSG_TYPES = util.enum(unknown=0, getattr=1, value=2, method=3, call=4, exception=5, ack=6,
+                      stream=7, not_modified=8)
+REQ_FLAGS = util.enum(no_reply=1)
+
+
+class MessageException(Exception):
+    pass
+
+
+class Codec(object):
+    """ Abstract class for encoding values in a message.
+    A codec that can not encode a value raises MessageException, the value is then
+    encoded with the pickle codec instead.
+
+    """
+    codec_id = None
+    name = None
+
+    def dumps(self, obj):
+        raise NotImplemented
+
+    def loads(self, data):
+        raise NotImplemented
+
+
+class PickleCodec(Codec):
+    """ Encodes values with cPickle, can encode anything that is picklable.
+    """
+    codec_id = 1
+    name = 'pickle'
+    protocol = pickle.HIGHEST_PROTOCOL
+
+    def dumps(self, obj):
+        return pickle.dumps(obj, self.protocol)
+
+    def loads(self, data):
+        return pickle.loads(data)
+
+
+class MsgpackCodec(Codec):
+    """ Encodes values with msgpack, can encode numbers, strings, lists and dicts.
+    Note that tuples are decoded as lists.
+    """
+    codec_id = 2
+    name = 'msgpack'
+
+    def dumps(self, obj):
+        try:
+            return msgpack.packb(obj, use_bin_type=True)
+        except (TypeError, ValueError, OverflowError) as e:
+            raise MessageException('Can not encode with msgpack: %s' % e)
+
+    def loads(self, data):
+        return msgpack.unpackb(data, raw=False)
+
+
+class RawCodec(Codec):
+    """ Passes strings and buffers through without encoding.
+    """
+    codec_id = 3
+    name = 'raw'
+
+    def dumps(self, obj):
+        if not isinstance(obj, (str, bytearray, buffer, memoryview)):
+            raise MessageException('Raw codec can only encode strings and buffers')
+        if isinstance(obj, memoryview):
+            return obj.tobytes()
+        return str(obj)
+
+    def loads(self, data):
+        return data
+
+
+CODECS = {}
+CODEC_IDS = {}
+
+def register_codec(codec):
+    """ Make codec available for use in messages.
+
+    Args:
+     - codec (Codec): Codec instance, its codec_id must be unique.
+     
+    """
+    CODECS[codec.name] = codec
+    CODEC_IDS[codec.codec_id] = codec
+
+def get_codec(name):
+    """ Return codec with given name.
+
+    Raises:
+     - MessageException: If no codec with name is available.
+     
+    """
+    try:
+        return CODECS[name or DEFAULT_CODEC]
+    except KeyError:
+        raise MessageException('Unknown codec: %s' % name)
+
+DEFAULT_CODEC = 'pickle'
+register_codec(PickleCodec())
+register_codec(RawCodec())
+if msgpack is not None:
+    register_codec(MsgpackCodec())
+
+
+# Values at least this large are sent as separate frames by serialize_frames
+OOB_THRESHOLD = 64 * 1024
+OOB_CODEC_ID = 255
+
+def _out_of_band(value):
+    """ Return (meta, buffer) if value should be sent out-of-band, else None.
+    """
+    if isinstance(value, (str, bytearray, buffer, memoryview)):
+        if len(value) < OOB_THRESHOLD:
+            return None
+        if isinstance(value, str):
+            return 'str', value
+        if isinstance(value, bytearray):
+            return 'bytearray', value
+        return 'buffer', value
+    # numpy is only handled if the application has imported it
+    numpy = sys.modules.get('numpy')
+    if numpy is not None and isinstance(value, numpy.ndarray) \
+       and not value.dtype.hasobject and value.nbytes >= OOB_THRESHOLD:
+        return ('ndarray', value.dtype.str, value.shape), numpy.ascontiguousarray(value)
+    return None
+
+def _from_buffer(meta, frame):
+    """ Create value described by meta from a received frame.
+    Strings and bytearrays are copied, buffers and numpy arrays are read-only views
+    of the frame.
+    """
+    # frames are zmq.Frame objects when received with copy=False
+    data = getattr(frame, 'buffer', frame)
+    if meta == 'str':
+        return frame.bytes if hasattr(frame, 'bytes') else str(frame)
+    if meta == 'bytearray':
+        return bytearray(data)
+    if meta == 'buffer':
+        return data
+    import numpy
+    _, dtype, shape = meta
+    return numpy.frombuffer(data, dtype=dtype).reshape(shape)
 
 
 class Message(object):
     """ Abstract class representing a message.
-    A message contains a checksum (TODO) a timestamp and
-    methods for serializing/deserializing it.
+    A message is serialized to an envelope with the following layout:
+     - header: format version, message kind, codec id, reply type or request flags,
+               correlation id and version of the replying Malacodas method table.
+     - fields of the message kind, see _dump_fields in the subclasses.
+     - extra: a dict with the attributes in EXTRA_FIELDS that are set, if any.
+    Values are written as segments of codec id, length and the encoded value, so the
+    receiver decodes them with the codec that the sender used. A segment with codec id
+    OOB_CODEC_ID refers to a buffer sent as a separate frame, see serialize_frames.
     
     """
-    def __init__(self, checksum=None, timestamp=None):
-        self.checksum = checksum
-        self.timestamp = timestamp or time.time()
+    VERSION = 1
+    KIND = None
+    EXTRA_FIELDS = ()
+    HEADER = struct.Struct('!BBBBII')
+    SEGMENT = struct.Struct('!BI')
+    SHORT = struct.Struct('!H')
+    KINDS = {}
+
+    def __init__(self, msg_id=None, codec=None):
+        self.msg_id = msg_id
+        self.codec = codec
         
     def serialize(self):
-        return serialize(self)
+        """ Serialize message with the codec given by self.codec.
+
+        Returns:
+         - (str): The serialized message.
+         
+        """
+        return self._serialize(None)
+
+    def serialize_frames(self):
+        """ Serialize message into frames for a multipart send.
+        Large string, buffer and numpy array values are not copied into the envelope,
+        they are instead sent as separate frames after it, see OOB_THRESHOLD.
+
+        Returns:
+         - (list): The envelope followed by the out-of-band buffers.
+         
+        """
+        buffers = []
+        envelope = self._serialize(buffers)
+        return [envelope] + buffers
+
+    def _serialize(self, buffers):
+        codec = get_codec(self.codec)
+        parts = [self.HEADER.pack(self.VERSION, self.KIND, codec.codec_id,
+                                  self._typ_or_flags(), self.msg_id or 0,
+                                  getattr(self, 'methods_version', None) or 0)]
+        self._dump_fields(parts, codec, buffers)
+        extra = dict((name, getattr(self, name)) for name in self.EXTRA_FIELDS
+                     if getattr(self, name) is not None)
+        parts.append(self._dump_value(extra or None, codec))
+        return ''.join(parts)
+
+    @classmethod
+    def deserialize(cls, payload, buffers=None):
+        """ Deserialize payload into a message.
+
+        Args:
+         - payload (str): Serialized message.
+         - buffers (list): Out-of-band buffers that were sent after the envelope.
+        Returns:
+         - (Message): Message of the kind given in the header.
+        Raises:
+         - MessageException: If payload is not a message of this class.
+         
+        """
+        version, kind, codec_id, typ, msg_id, methods_version = cls.HEADER.unpack_from(payload)
+        if version != cls.VERSION or kind not in cls.KINDS:
+            raise MessageException('Unknown message format')
+        msg_class = cls.KINDS[kind]
+        if not issubclass(msg_class, cls):
+            raise MessageException('Expected %s but got %s' % (cls.__name__,
+                                                                msg_class.__name__))
+        if codec_id not in CODEC_IDS:
+            raise MessageException('Unknown codec id: %s' % codec_id)
+        msg = msg_class.__new__(msg_class)
+        Message.__init__(msg, msg_id=msg_id or None, codec=CODEC_IDS[codec_id].name)
+        offset = msg._load_fields(payload, cls.HEADER.size, typ, methods_version,
+                                  buffers or ())
+        extra, _ = cls._load_value(payload, offset)
+        for name in msg.EXTRA_FIELDS:
+            setattr(msg, name, (extra or {}).get(name))
+        return msg
+
+    @classmethod
+    def deserialize_frames(cls, frames):
+        """ Deserialize frames received with a multipart recv, see serialize_frames.
+        The frames can be strings or zmq.Frame objects, out-of-band values are then
+        created from the frame buffers without copying where the type allows it.
+
+        Args:
+         - frames (list): The envelope followed by the out-of-band buffers.
+        Returns:
+         - (Message): Message of the kind given in the header.
+        
+        """
+        payload = frames[0]
+        if not isinstance(payload, str):
+            payload = payload.bytes
+        return cls.deserialize(payload, frames[1:])
+
+    def _typ_or_flags(self):
+        raise NotImplemented
+
+    def _dump_fields(self, parts, codec, buffers=None):
+        raise NotImplemented
+
+    def _load_fields(self, payload, offset, typ, methods_version, buffers=()):
+        raise NotImplemented
 
     @classmethod
-    def deserialize(self, payload):
-        return deserialize(payload)
+    def _dump_value(cls, value, codec, buffers=None):
+        """ Encode value as a segment, falling back to pickle if codec can not encode it.
+        If buffers is a list, large buffer values are appended to it and the segment
+        only refers to them.
+        """
+        if value is None:
+            return cls.SEGMENT.pack(0, 0)
+        if buffers is not None:
+            out_of_band = _out_of_band(value)
+            if out_of_band is not None:
+                meta, buf = out_of_band
+                buffers.append(buf)
+                data = pickle.dumps((len(buffers) - 1, meta), 2)
+                return cls.SEGMENT.pack(OOB_CODEC_ID, len(data)) + data
+        try:
+            data = codec.dumps(value)
+        except MessageException:
+            codec = CODECS['pickle']
+            data = codec.dumps(value)
+        return cls.SEGMENT.pack(codec.codec_id, len(data)) + data
 
-    # TODO: __hash__
+    @classmethod
+    def _load_value(cls, payload, offset, buffers=()):
+        """ Decode segment at offset, return the value and offset of next segment.
+        """
+        codec_id, length = cls.SEGMENT.unpack_from(payload, offset)
+        offset += cls.SEGMENT.size
+        if not codec_id:
+            return None, offset
+        if codec_id == OOB_CODEC_ID:
+            index, meta = pickle.loads(payload[offset:offset + length])
+            try:
+                buf = buffers[index]
+            except IndexError:
+                raise MessageException('Missing out-of-band buffer %s' % index)
+            return _from_buffer(meta, buf), offset + length
+        try:
+            codec = CODEC_IDS[codec_id]
+        except KeyError:
+            raise MessageException('Unknown codec id: %s' % codec_id)
+        return codec.loads(payload[offset:offset + length]), offset + length
+
+    @classmethod
+    def _register(cls, msg_class):
+        cls.KINDS[msg_class.KIND] = msg_class
+        return msg_class
     
 
 class REQMessage(Message):
     """ Request message that represents a remote evaluation on a Malacoda.
+    msg_id is an optional correlation id that is echoed in the reply.
+    If await_reply is False, the Malacoda acknowledges the request directly and
+    evaluates it later.
+    Requests with the same idempotency_key are only evaluated once, retries get the
+    reply of the first request.
+    A getattr with if_version is answered with a not_modified reply if the version of
+    the attribute is still if_version.
     """
+    KIND = 1
+    EXTRA_FIELDS = ('idempotency_key', 'if_version')
     
-    def __init__(self, fn_name, args=None, kwargs=None):
+    def __init__(self, fn_name, args=None, kwargs=None, msg_id=None, codec=None,
+                 await_reply=True, idempotency_key=None, if_version=None):
         self.fn_name = fn_name
         self.args = args
         self.kwargs = kwargs
-        super(REQMessage, self).__init__()
+        self.await_reply = await_reply
+        self.idempotency_key = idempotency_key
+        self.if_version = if_version
+        super(REQMessage, self).__init__(msg_id=msg_id, codec=codec)
 
     @property
     def is_getattr(self):
@@ -60,14 +363,70 @@ class REQMessage(Message):
     @property
     def is_setattr(self):
         return self.fn_name == 'setattr'
+
+    def _dump_fields(self, parts, codec, buffers=None):
+        """ Fields are function name, number of arguments followed by one segment per
+        argument, and keyword arguments.
+        """
+        fn_name = self.fn_name.encode('utf-8') if isinstance(self.fn_name, unicode) \
+                  else self.fn_name
+        args = self.args or ()
+        parts.append(self.SHORT.pack(len(fn_name)) + fn_name + self.SHORT.pack(len(args)))
+        parts.extend(self._dump_value(arg, codec, buffers) for arg in args)
+        parts.append(self._dump_value(self.kwargs or None, codec))
+
+    def _typ_or_flags(self):
+        return 0 if self.await_reply else REQ_FLAGS.no_reply
+
+    def _load_fields(self, payload, offset, flags, methods_version, buffers=()):
+        self.await_reply = not flags & REQ_FLAGS.no_reply
+        length, = self.SHORT.unpack_from(payload, offset)
+        offset += self.SHORT.size
+        self.fn_name = payload[offset:offset + length]
+        offset += length
+        count, = self.SHORT.unpack_from(payload, offset)
+        offset += self.SHORT.size
+        self.args = []
+        for _ in xrange(count):
+            arg, offset = self._load_value(payload, offset, buffers)
+            self.args.append(arg)
+        kwargs, offset = self._load_value(payload, offset)
+        self.kwargs = kwargs or {}
+        return offset
+
+Message._register(REQMessage)
     
 
 class REPMessage(Message):
     """ Reply message representing the answer from a remote evaluation.
+    msg_id is the correlation id of the request that this is a reply to.
+    methods_version identifies the method table of the Malacoda that sent the reply,
+    it is changed when methods are added or removed.
+    version is the version of the attribute in replies to getattrs, if it is versioned.
     """
-    def __init__(self, typ=None, val=None):
+    KIND = 2
+    EXTRA_FIELDS = ('version',)
+    
+    def __init__(self, typ=None, val=None, msg_id=None, codec=None, methods_version=None,
+                 version=None):
         self.typ = typ
         self.val = val
-        super(REPMessage, self).__init__()
-        
-    
+        self.methods_version = methods_version
+        self.version = version
+        super(REPMessage, self).__init__(msg_id=msg_id, codec=codec)
+
+    def _typ_or_flags(self):
+        return self.typ or 0
+
+    def _dump_fields(self, parts, codec, buffers=None):
+        """ The only field is the value, the type is sent in the header.
+        """
+        parts.append(self._dump_value(self.val, codec, buffers))
+
+    def _load_fields(self, payload, offset, typ, methods_version, buffers=()):
+        self.typ = typ
+        self.methods_version = methods_version or None
+        self.val, offset = self._load_value(payload, offset, buffers)
+        return offset
+
+Message._register(REPMessage)
@@ -0,0 +1,107 @@
+# -*- coding: utf-8 -*-
+
+"""
+Copyright 2014 Gustav Arngården 
+
+   Licensed under the Apache License, Version 2.0 (the "License");
+   you may not use this file except in compliance with the License.
+   You may obtain a copy of the License at
+
+     http://www.apache.org/licenses/LICENSE-2.0
+
+   Unless required by applicable law or agreed to in writing, software
+   distributed under the License is distributed on an "AS IS" BASIS,
+   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+   See the License for the specific language governing permissions and
+   limitations under the License.
+"""
+
+import os
+import sys
+import time
+import threading
+
+
+class SamplingProfiler(threading.Thread):
+    """ Profiler that samples the stacks of all threads in the process at an interval.
+    The stacks are counted in the collapsed format used by flamegraph.pl, one line per
+    distinct stack with the frames from the thread name to the innermost function
+    separated by semicolons, followed by the number of samples.
+    The profiler waits at least MAX_OVERHEAD times the time a sample took between
+    samples, so it uses at most about 1 / MAX_OVERHEAD of one CPU, and it stops by
+    itself after max_duration seconds.
+    
+    """
+    MIN_INTERVAL = 0.001
+    MAX_OVERHEAD = 20
+    MAX_DEPTH = 128
+    MAX_STACKS = 10000
+
+    def __init__(self, interval=0.01, max_duration=300):
+        """ Init SamplingProfiler.
+
+        Args:
+         - interval (float): Seconds between samples, at least MIN_INTERVAL.
+         - max_duration (float): Seconds after which sampling stops.
+         
+        """
+        threading.Thread.__init__(self, name='SamplingProfiler')
+        self.daemon = True
+        self.interval = max(interval, self.MIN_INTERVAL)
+        self.max_duration = max_duration
+        self.stacks = {}
+        self.samples = 0
+        self.dropped = 0
+        self.started = None
+        self.stopped = None
+        self._stop_event = threading.Event()
+
+    def run(self):
+        self.started = time.time()
+        own_id = threading.current_thread().ident
+        while not self._stop_event.is_set():
+            start = time.time()
+            if start - self.started > self.max_duration:
+                break
+            names = dict((thread.ident, thread.name) for thread in threading.enumerate())
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id != own_id:
+                    self._add(names.get(thread_id, str(thread_id)), frame)
+            self.samples += 1
+            elapsed = time.time() - start
+            self._stop_event.wait(max(self.interval - elapsed, elapsed * self.MAX_OVERHEAD))
+        self.stopped = time.time()
+
+    def _add(self, thread_name, frame):
+        """ Count the stack of frame.
+        """
+        frames = []
+        while frame is not None and len(frames) < self.MAX_DEPTH:
+            code = frame.f_code
+            frames.append('%s:%s' % (os.path.basename(code.co_filename), code.co_name))
+            frame = frame.f_back
+        frames.append(thread_name.replace(';', '_'))
+        stack = ';'.join(reversed(frames)).replace(' ', '_')
+        if stack in self.stacks:
+            self.stacks[stack] += 1
+        elif len(self.stacks) < self.MAX_STACKS:
+            self.stacks[stack] = 1
+        else:
+            self.dropped += 1
+
+    def stop(self):
+        """ Stop sampling and return the result.
+
+        Returns:
+         - (dict): {'stacks': collapsed stacks, one 'frame;frame;... count' per line,
+                    'samples': number of samples, 'duration': seconds sampled,
+                    'interval': seconds between samples,
+                    'dropped': stacks not counted since MAX_STACKS was reached}
+         
+        """
+        self._stop_event.set()
+        self.join()
+        lines = ['%s %s' % (stack, count) for stack, count in sorted(self.stacks.iteritems())]
+        return {'stacks': '\n'.join(lines), 'samples': self.samples,
+                'duration': self.stopped - self.started, 'interval': self.interval,
+                'dropped': self.dropped}
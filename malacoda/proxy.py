@@ -16,40 +16,379 @@ Copyright 2014 Gustav Arngården
    limitations under the License.
 """
 
+import os
 import zmq
+import time
+import uuid
+import bisect
 import socket
+import hashlib
+import itertools
+import threading
+import collections
 import cPickle as pickle
-from zmq_socket import Socket
+from zmq_socket import Socket, get_context
 from message import REPMessage, REQMessage, MSG_TYPES
 
 
+def endpoint(address):
+    """ Return zmq endpoint of address, host:port is a tcp-address and other addresses,
+    e.g. ipc://path or inproc://name, are already endpoints.
+    """
+    return address if '://' in address else 'tcp://%s' % address
+
+
+class Connection(object):
+    """ Sockets to a Malacoda, shared by all proxies to the same address.
+    Each request checks out a REQ-socket, so the connection can be used from many
+    threads, but at most max_sockets sockets are opened and sockets that have been idle
+    for idle_timeout seconds are closed.
+    If the connection belongs to a ConnectionPool, the pool is told about new sockets so
+    that it can close idle sockets of all its connections.
+    Sockets created before a fork are dropped in the child process.
+    The connection also caches the method table of the Malacoda, the cache is cleared
+    when reconnecting or when a reply shows that the method table has changed.
+    """
+    def __init__(self, address, max_sockets=8, idle_timeout=60, pool=None):
+        self.address = address
+        self.max_sockets = max_sockets
+        self.idle_timeout = idle_timeout
+        self.pool = pool
+        self.condition = threading.Condition()
+        self.idle = []
+        self.num_sockets = 0
+        self.last_used = time.time()
+        self.methods = None
+        self.methods_version = None
+        self.push_port = None
+        self.pub_port = None
+        self.push_socket = None
+        self.push_pid = None
+        self.push_lock = threading.Lock()
+        self.pid = os.getpid()
+
+    def connect(self):
+        """ Close idle sockets so that the next request uses a new socket.
+        """
+        with self.condition:
+            for sock, _ in self.idle:
+                sock.close(linger=0)
+            self.num_sockets -= len(self.idle)
+            self.idle = []
+            self.methods = None
+
+    def _checkout(self, timeout=None):
+        """ Return an idle socket, or a new one if there are less than max_sockets.
+        Wait for a socket to be checked in otherwise.
+
+        Raises:
+         - socket.timeout if no socket was checked in within timeout.
+         
+        """
+        end = None if timeout is None else time.time() + timeout
+        with self.condition:
+            if self.pid != os.getpid():
+                # sockets of the parent process can not be used after fork
+                self.idle = []
+                self.num_sockets = 0
+                self.pid = os.getpid()
+            self._evict_idle()
+            while not self.idle and self.num_sockets >= self.max_sockets:
+                remaining = None if end is None else end - time.time()
+                if remaining is not None and remaining <= 0:
+                    raise socket.timeout
+                self.condition.wait(remaining)
+            if self.idle:
+                return self.idle.pop()[0]
+            self.num_sockets += 1
+        # the pool locks the conditions of its connections, so it is not called while
+        # holding the condition
+        if self.pool is not None:
+            self.pool._reserve(self)
+        sock = Socket(get_context(), zmq.REQ, default_timeout=None)
+        sock.connect(endpoint(self.address))
+        return sock
+
+    def _checkin(self, sock):
+        with self.condition:
+            self.last_used = time.time()
+            self.idle.append((sock, self.last_used))
+            self.condition.notify()
+
+    def _discard(self, sock):
+        sock.close(linger=0)
+        with self.condition:
+            self.num_sockets -= 1
+            self.condition.notify()
+
+    def _evict_idle(self):
+        """ Close sockets that have not been used for idle_timeout seconds.
+        The idle list is ordered by checkin time, so the oldest sockets are first.
+        """
+        limit = time.time() - self.idle_timeout
+        while self.idle and self.idle[0][1] < limit:
+            self.idle.pop(0)[0].close(linger=0)
+            self.num_sockets -= 1
+
+    def request(self, request, timeout=None):
+        """ Send request and return reply.
+        The socket is discarded if no reply was received within timeout, since
+        a REQ-socket can not send a new request until it has received a reply.
+
+        Args:
+         - request (REQMessage): The request.
+         - timeout (int): Socket timeout in seconds (default no timeout), used both
+                          for waiting for a free socket and for the reply.
+        Returns:
+         - (REPMessage): The reply.
+        Raises:
+         - socket.timeout if no reply was received within timeout.
+         
+        """
+        sock = self._checkout(timeout)
+        try:
+            reply = sock.request_reply(request, REPMessage, timeout=timeout)
+        except:
+            self._discard(sock)
+            self.methods = None
+            raise
+        self._checkin(sock)
+        if reply.methods_version != self.methods_version:
+            self.methods = None
+            self.methods_version = reply.methods_version
+        return reply
+
+    def get_methods(self, codec=None, timeout=None):
+        """ Return names of the methods of the Malacoda, fetch them if not cached.
+        """
+        methods = self.methods
+        if methods is None:
+            reply = self.request(REQMessage('_malacoda_describe', codec=codec),
+                                 timeout=timeout)
+            if reply.typ == MSG_TYPES.exception:
+                raise reply.val
+            self.push_port = reply.val.get('push_port')
+            self.pub_port = reply.val.get('pub_port')
+            methods = self.methods = frozenset(reply.val['methods'])
+        return methods
+
+    def push(self, request, codec=None, track=False):
+        """ Send request without waiting for acknowledgement, over the push channel
+        of the Malacoda. If the Malacoda has no push channel the request is sent as an
+        ordinary request and the acknowledgement is ignored.
+
+        Returns:
+         - (zmq.MessageTracker): If track is True and the request was pushed, the
+                                 tracker tells when zmq is done with its buffers.
+        """
+        self.get_methods(codec)
+        if not self.push_port:
+            self.request(request)
+            return None
+        with self.push_lock:
+            if self.push_socket is None or self.push_pid != os.getpid():
+                self.push_socket = Socket(get_context(), zmq.PUSH, default_timeout=None)
+                self.push_socket.connect(endpoint(self.tcp_address(self.push_port)))
+                self.push_pid = os.getpid()
+            return self.push_socket.send_message(request, track=track)
+
+    def tcp_address(self, port):
+        """ Return host:port for another port of the Malacoda, e.g. its push channel.
+        These are only bound to tcp, so for ipc- and inproc-addresses the host is localhost.
+        """
+        host = self.address.rsplit(':', 1)[0] if '://' not in self.address else 'localhost'
+        return '%s:%s' % (host, port)
+
+
+class ConnectionPool(object):
+    """ Connections keyed by address of the Malacoda.
+    Whenever a connection opens a socket, idle sockets of all connections are closed if
+    they have been idle for idle_timeout seconds, checked at most every SWEEP_INTERVAL
+    seconds, and connections without sockets that have not been used for idle_timeout
+    seconds are dropped. If more than max_total_sockets are open, the sockets that have
+    been idle the longest are closed. Sockets that are in use are never closed, so the
+    limit can be exceeded by as many sockets as are in use at the same time.
+    Connections are dropped after fork, since sockets can not be shared between processes.
+    """
+    SWEEP_INTERVAL = 1
+
+    def __init__(self, max_sockets=8, idle_timeout=60, max_total_sockets=256):
+        """ Init ConnectionPool.
+
+        Args:
+         - max_sockets (int): Max number of sockets to each address.
+         - idle_timeout (int): Close sockets that have been idle for this many seconds.
+         - max_total_sockets (int): Max number of sockets to all addresses.
+         
+        """
+        self.max_sockets = max_sockets
+        self.idle_timeout = idle_timeout
+        self.max_total_sockets = max_total_sockets
+        self.lock = threading.Lock()
+        self.connections = {}
+        self.last_sweep = 0
+        self.pid = os.getpid()
+
+    def get(self, address):
+        """ Return connection to address.
+        """
+        with self.lock:
+            if self.pid != os.getpid():
+                self.connections = {}
+                self.pid = os.getpid()
+            try:
+                return self.connections[address]
+            except KeyError:
+                connection = Connection(address, max_sockets=self.max_sockets,
+                                        idle_timeout=self.idle_timeout, pool=self)
+                self.connections[address] = connection
+                return connection
+
+    def _reserve(self, connection):
+        """ Called when connection has opened a new socket, close idle sockets and drop
+        unused connections as described in the class.
+        """
+        with self.lock:
+            if self.pid != os.getpid():
+                return
+            # a connection that was dropped while a proxy still used it is added again
+            self.connections.setdefault(connection.address, connection)
+            now = time.time()
+            if now - self.last_sweep >= self.SWEEP_INTERVAL:
+                self.last_sweep = now
+                for address, other in self.connections.items():
+                    with other.condition:
+                        other._evict_idle()
+                        unused = not other.num_sockets and other.push_socket is None and \
+                                 other.last_used < now - self.idle_timeout
+                    if unused and other is not connection:
+                        del self.connections[address]
+            total = sum(other.num_sockets for other in self.connections.itervalues())
+            while total > self.max_total_sockets:
+                oldest = None
+                for other in self.connections.itervalues():
+                    with other.condition:
+                        if other.idle and (oldest is None or other.idle[0][1] < oldest[0]):
+                            oldest = (other.idle[0][1], other)
+                if oldest is None:
+                    break
+                other = oldest[1]
+                with other.condition:
+                    if other.idle:
+                        other.idle.pop(0)[0].close(linger=0)
+                        other.num_sockets -= 1
+                        other.condition.notify()
+                        total -= 1
+
+    def clear(self):
+        """ Close all idle sockets and drop all connections.
+        """
+        with self.lock:
+            for connection in self.connections.itervalues():
+                connection.connect()
+            self.connections = {}
+
+pool = ConnectionPool()
+
+
+class AttrCache(object):
+    """ Cache of attribute values read through a Proxy.
+    Every value is stored with the version the Malacoda gave it. When a cached value is
+    older than max_staleness seconds, the attribute is read again with a conditional
+    getattr and the Malacoda only sends the value if its version has changed.
+    With max_staleness 0, every read asks the Malacoda, but unchanged values are not sent.
+    """
+    def __init__(self, max_staleness=0):
+        self.max_staleness = max_staleness
+        self.entries = {}
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.not_modified = 0
+        self.misses = 0
+
+    def getattr(self, proxy, attr, timeout=None):
+        """ Return value of attr of the Malacoda that proxy is a proxy for, from the
+        cache if it is fresh enough or has not been changed.
+
+        Args:
+         - proxy (Proxy): Proxy around the Malacoda.
+         - attr (basestring): Name of attribute.
+         - timeout (int): Socket timeout in seconds (default no timeout)
+        Returns:
+         - Value of attribute, or proxy around a method.
+        Raises:
+         - Reraises any exception from the remote evaluation.
+
+        """
+        now = time.time()
+        entry = self.entries.get(attr)
+        if entry is not None and now - entry[2] <= self.max_staleness:
+            self.hits += 1
+            return entry[0]
+        request = REQMessage('getattr', args=[proxy.attr, attr], codec=proxy.codec,
+                             if_version=entry and entry[1])
+        reply = proxy.connection.request(request, timeout=timeout)
+        if reply.typ == MSG_TYPES.not_modified:
+            self.not_modified += 1
+            with self.lock:
+                self.entries[attr] = (entry[0], entry[1], now)
+            return entry[0]
+        self.misses += 1
+        with self.lock:
+            if reply.typ == MSG_TYPES.value and reply.version is not None:
+                self.entries[attr] = (reply.val, reply.version, now)
+            else:
+                self.entries.pop(attr, None)
+        return proxy._handle_reply(reply, attr, timeout)
+
+    def invalidate(self, attr=None):
+        """ Remove attr, or all attributes if not given, from the cache.
+        """
+        with self.lock:
+            if attr is None:
+                self.entries.clear()
+            else:
+                self.entries.pop(attr, None)
+
+    def stats(self):
+        """ Return dict with number of cached attributes and hits, not_modified and
+        misses, where hits are served without asking the Malacoda.
+        """
+        return {'size': len(self.entries), 'hits': self.hits,
+                'not_modified': self.not_modified, 'misses': self.misses}
+
+
 class Proxy(object):
     """ Proxy around a Malacoda-method
     """
-    def __init__(self, name, address, attr=None):
+    def __init__(self, name, address, attr=None, codec=None, connection=None,
+                 attr_cache=None):
         """
         Init Proxy with name and address of Malacoda-daemon.
         Optional attr denotes which attribute in Malacoda this is proxy for.
         address should be host:port to Malacoda, port is optional and can be left out if
-        Malacoda is on localhost.
+        Malacoda is on localhost. It can also be an ipc- or inproc-endpoint that the
+        Malacoda is bound to.
+        codec is the name of the codec used for encoding requests, default is pickle.
+        connection is shared with the parent proxy if given, else the connection to
+        address in the connection pool is used.
+        attr_cache is an AttrCache that attribute reads are served from, if given.
         """
         self.__dict__['name'] = name
         self.__dict__['address'] = address
         self.__dict__['attr'] = attr or 'self'
-        self.__dict__['socket'] = None
-        self._connect_to_malacoda()
+        self.__dict__['codec'] = codec
+        self.__dict__['connection'] = connection or pool.get(address)
+        self.__dict__['attr_cache'] = attr_cache
 
     def _connect_to_malacoda(self):
-        """ Connect to Malacodas message socket.
+        """ Reconnect to Malacodas message socket.
         """
-        if not self.socket is None:
-            self.socket.close()
-        context = zmq.Context()
-        self.__dict__['socket'] = Socket(context, zmq.REQ, default_timeout=None)
-        self.socket.connect('tcp://%s' % self.address)
+        self.connection.connect()
 
     def __getattr__(self, attr):
-        """ Send getattr-command to Malacoda and return result of evaluation.
+        """ Return proxy around method attr, or send getattr-command to Malacoda and
+        return result of evaluation if attr is not in the method table of the Malacoda.
 
         Args:
          - attr (basestring): Name of attribute to access.
@@ -60,7 +399,11 @@ class Proxy(object):
          - Reraises any exception from the remote evalution.
          
         """
-        request = REQMessage('getattr', args=[self.attr, attr])
+        if self.attr == 'self' and attr in self.connection.get_methods(self.codec):
+            return self._method_proxy(attr)
+        if self.attr_cache is not None:
+            return self.attr_cache.getattr(self, attr)
+        request = REQMessage('getattr', args=[self.attr, attr], codec=self.codec)
         return self._remote_eval(request, attr)
 
     def __setattr__(self, attr, value):
@@ -73,17 +416,43 @@ class Proxy(object):
          - Reraises any exception from the remote evalution.
          
         """
-        request = REQMessage('setattr', args=[self.attr, attr, value])
+        if self.attr_cache is not None:
+            self.attr_cache.invalidate(attr)
+        request = REQMessage('setattr', args=[self.attr, attr, value], codec=self.codec)
         return self._remote_eval(request)
     
     def __call__(self, *args, **kwargs):
         """ Execute call on malacoda and return result.
+        If the keyword argument await_reply is False, return as soon as the Malacoda has
+        put the call in its queue, True is then returned if the call was queued and False
+        if the queue was full. If also ack is False, return directly without
+        acknowledgement, with track=True a zmq.MessageTracker is then returned that tells
+        when large arguments, that are sent without copying, may be modified again.
+        If the keyword argument retries is given, the call is sent again up to that many
+        times if no reply is received within timeout. The retries have the same
+        idempotency key, given by the keyword argument idempotency_key or generated, so
+        the Malacoda evaluates the call only once.
+        The keyword arguments timeout, await_reply, ack, track, retries and
+        idempotency_key are always taken by the proxy, they are not passed to the method.
 
         """
-        timeout = None
-        if 'timeout' in kwargs:
-            timeout = kwargs.pop('timeout')
-        request = REQMessage(self.attr, args, kwargs)
+        timeout = kwargs.pop('timeout', None)
+        await_reply = kwargs.pop('await_reply', True)
+        ack = kwargs.pop('ack', True) or await_reply
+        track = kwargs.pop('track', False) and not ack
+        retries = kwargs.pop('retries', 0)
+        idempotency_key = kwargs.pop('idempotency_key', None)
+        if retries and idempotency_key is None:
+            idempotency_key = uuid.uuid4().hex
+        request = REQMessage(self.attr, args, kwargs, codec=self.codec,
+                             await_reply=await_reply, idempotency_key=idempotency_key)
+        if not ack:
+            return self.connection.push(request, self.codec, track=track)
+        for _ in xrange(retries):
+            try:
+                return self._remote_eval(request, timeout=timeout)
+            except socket.timeout:
+                pass
         return self._remote_eval(request, timeout=timeout)
 
     def _remote_eval(self, request, attr=None, timeout=None):
@@ -92,6 +461,7 @@ class Proxy(object):
          - An exception from the remote eval is reraised
          - A value is returned, i.e a constant attribute or result of evaluation
          - A MalacodaProxy around a method is returned
+         - A RemoteIterator is returned if the result is a generator or iterator
 
         Args:
          - request (REQMessage): Message-object containing the request.
@@ -103,13 +473,677 @@ class Proxy(object):
          - Reraises any exception from the remote evaluation
          
         """
-        reply = self.socket.request_reply(request, REPMessage, timeout=timeout)
+        reply = self.connection.request(request, timeout=timeout)
+        return self._handle_reply(reply, attr, timeout)
+
+    def _handle_reply(self, reply, attr=None, timeout=None):
+        """ Return result of reply to a request, see _remote_eval.
+        """
         if reply.typ == MSG_TYPES.exception:
             raise reply.val
+        if reply.typ == MSG_TYPES.stream:
+            return RemoteIterator(self.connection, reply.val, codec=self.codec,
+                                  timeout=timeout)
         if attr and not reply.typ == MSG_TYPES.value:
-            return Proxy(self.name, self.address, attr=attr)
+            return self._method_proxy(attr)
         else:
             return reply.val
 
+    def batch(self, parallel=False):
+        """ Return Batch that sends many calls, getattrs and setattrs in one request.
+        The Batch can be used as a context manager that executes it on exit:
+
+            with d.batch() as b:
+                b.insert_message('a')
+                b.insert_message('b')
+                b.pst_counter
+            print b.results
+
+        Args:
+         - parallel (bool): If True, the requests are evaluated in parallel by the
+                            Malacoda, else in order.
+        """
+        return Batch(self, parallel=parallel)
+
+    def _method_proxy(self, attr):
+        """ Return proxy around method attr that shares connection with this proxy.
+        """
+        return Proxy(self.name, self.address, attr=attr, codec=self.codec,
+                     connection=self.connection)
+
     def __str__(self):
         return 'Proxy for %s:%s' % (self.name, self.address)
+
+
+class RemoteIterator(object):
+    """ Iterator over the items of a generator or iterator returned by a remote call.
+    Items are fetched from the Malacoda in chunks of credit items when needed, so only
+    one chunk at a time is kept in memory. Call close, or use the iterator as a context
+    manager, to release the iterator on the Malacoda if not all items are read.
+    """
+    DEFAULT_CREDIT = 100
+
+    def __init__(self, connection, chunk, codec=None, timeout=None, credit=None):
+        self.connection = connection
+        self.stream_id = chunk['id']
+        self.items = collections.deque(chunk['items'])
+        self.done = chunk['done']
+        self.codec = codec
+        self.timeout = timeout
+        self.credit = credit or self.DEFAULT_CREDIT
+
+    def __iter__(self):
+        return self
+
+    def next(self):
+        while not self.items:
+            if self.done:
+                raise StopIteration
+            reply = self.connection.request(
+                REQMessage('_malacoda_stream', args=[self.stream_id, self.credit],
+                           codec=self.codec), timeout=self.timeout)
+            if reply.typ == MSG_TYPES.exception:
+                self.done = True
+                raise reply.val
+            self.items.extend(reply.val['items'])
+            self.done = reply.val['done']
+        return self.items.popleft()
+
+    def close(self):
+        """ Release the iterator on the Malacoda.
+        """
+        if not self.done:
+            self.done = True
+            self.items.clear()
+            self.connection.request(REQMessage('_malacoda_stream_close', args=[self.stream_id],
+                                               codec=self.codec), timeout=self.timeout)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+class Subscriber(object):
+    """ Iterator over the (topic, payload) tuples that a Malacoda publishes on the topics
+    that are subscribed to, see malacoda.subscribe.
+    Payloads can instead be handed to a callback in a separate thread with listen.
+    Call close, or use the subscriber as a context manager, to end the subscription.
+    """
+    def __init__(self, address, topics=None, timeout=None):
+        """ Init Subscriber.
+
+        Args:
+         - address (basestring): host:port of the PUB-socket of the Malacoda.
+         - topics (list): Topics to subscribe to, all topics if not given.
+         - timeout (int): Seconds to wait for each payload when iterating, default forever.
+         
+        """
+        self.socket = Socket(get_context(), zmq.SUB, default_timeout=None)
+        for topic in topics or ['']:
+            if isinstance(topic, unicode):
+                topic = topic.encode('utf-8')
+            self.socket.setsockopt(zmq.SUBSCRIBE, topic)
+        self.socket.connect(endpoint(address))
+        self.timeout = timeout
+        self.closed = False
+        self.thread = None
+
+    def recv(self, timeout=None):
+        """ Return next (topic, payload).
+
+        Raises:
+         - socket.timeout if nothing was published within timeout.
+         
+        """
+        frames = self.socket.recv_multipart(copy=False, timeout=timeout)
+        return frames[0].bytes, REPMessage.deserialize_frames(frames[1:]).val
+
+    def __iter__(self):
+        return self
+
+    def next(self):
+        if self.closed:
+            raise StopIteration
+        return self.recv(timeout=self.timeout)
+
+    def listen(self, callback):
+        """ Call callback(topic, payload) for every payload in a separate thread, until
+        the subscriber is closed or callback raises an exception.
+
+        Returns:
+         - (threading.Thread): The thread.
+         
+        """
+        def run():
+            try:
+                while not self.closed:
+                    try:
+                        topic, payload = self.recv(timeout=1)
+                    except socket.timeout:
+                        continue
+                    callback(topic, payload)
+            finally:
+                self.closed = True
+                self.socket.close(linger=0)
+        self.thread = threading.Thread(target=run)
+        self.thread.daemon = True
+        self.thread.start()
+        return self.thread
+
+    def close(self):
+        """ End the subscription, a listening thread stops within a second.
+        """
+        self.closed = True
+        if self.thread is None:
+            self.socket.close(linger=0)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+class PoolException(Exception):
+    pass
+
+
+class Replica(object):
+    """ A Malacoda in a Pool, with the state that the pool routes requests by.
+    """
+    def __init__(self, proxy):
+        self.proxy = proxy
+        self.healthy = True
+        self.outstanding = 0
+        self.calls = 0
+        self.errors = 0
+        self.ping_socket = None
+
+    def ping(self, timeout, codec=None):
+        """ Send a describe request on a socket of its own and return True if the
+        Malacoda replied within timeout. The socket does not belong to the connection of
+        the proxy, so pings are not held up by requests that wait for free sockets.
+        The socket is closed if there is no reply, since a REQ-socket can not send a new
+        request until it has received a reply.
+        """
+        if self.ping_socket is None:
+            self.ping_socket = Socket(get_context(), zmq.REQ, default_timeout=None)
+            self.ping_socket.connect(endpoint(self.proxy.address))
+        try:
+            self.ping_socket.request_reply(REQMessage('_malacoda_describe', codec=codec),
+                                           REPMessage, timeout=timeout)
+            return True
+        except (socket.timeout, zmq.ZMQError):
+            self.close()
+            return False
+
+    def close(self):
+        if self.ping_socket is not None:
+            self.ping_socket.close(linger=0)
+            self.ping_socket = None
+
+
+def _hash(key):
+    if isinstance(key, unicode):
+        key = key.encode('utf-8')
+    return int(hashlib.md5(str(key)).hexdigest()[:16], 16)
+
+
+class Pool(object):
+    """ Proxy that spreads calls and getattrs over identical Malacodas, its replicas.
+    Requests are routed in one of these ways:
+     - least_outstanding: To the replica with fewest requests in flight from this pool,
+                          idle replicas are used in turn.
+     - consistent_hash: By the keyword argument route_key of the call, calls with the same
+                        key go to the same replica as long as it is healthy. The keys of an
+                        ejected replica move to the other replicas, and back when it is
+                        healthy again. Calls without route_key are routed as in
+                        least_outstanding.
+    Requests time out after timeout seconds, unless another timeout is given to the call.
+    A replica is ejected when a request to it times out or fails in zmq. Every
+    health_interval seconds all replicas are pinged, on sockets used only for pings, and
+    they are readmitted or ejected depending on if they reply within HEALTH_TIMEOUT
+    seconds. A replica whose requests are
+    evaluated one at a time can be ejected while it evaluates a slow call, so replicas
+    should use listener_workers. Failed calls are not retried on another replica, since
+    they may already have been evaluated, the exception is raised instead.
+    Call close to stop the health checks.
+    """
+    ROUTINGS = ('least_outstanding', 'consistent_hash')
+    VIRTUAL_NODES = 100
+    HEALTH_TIMEOUT = 2
+    REQUEST_TIMEOUT = 30
+
+    def __init__(self, name, addresses, routing='least_outstanding', codec=None,
+                 health_interval=5, timeout=REQUEST_TIMEOUT):
+        """ Init Pool.
+
+        Args:
+         - name (basestring): Name of the Malacodas.
+         - addresses (list): Addresses of the replicas, as for Proxy.
+         - routing (basestring): One of ROUTINGS.
+         - codec (basestring): Name of the codec used for encoding requests.
+         - health_interval (int): Seconds between health checks, None for no checks.
+         - timeout (int): Default timeout of requests in seconds, None for no timeout.
+        Raises:
+         - PoolException if routing is unknown or there are no addresses.
+         
+        """
+        if routing not in self.ROUTINGS:
+            raise PoolException('Unknown routing: %s' % routing)
+        if not addresses:
+            raise PoolException('Pool of %s has no replicas' % name)
+        self.__dict__['name'] = name
+        self.__dict__['routing'] = routing
+        self.__dict__['codec'] = codec
+        self.__dict__['timeout'] = timeout
+        self.__dict__['replicas'] = [Replica(Proxy(name, address, codec=codec))
+                                     for address in addresses]
+        ring = sorted((_hash('%s-%s' % (address, i)), index)
+                      for index, address in enumerate(addresses)
+                      for i in xrange(self.VIRTUAL_NODES))
+        self.__dict__['ring'] = [index for _, index in ring]
+        self.__dict__['ring_hashes'] = [key_hash for key_hash, _ in ring]
+        self.__dict__['lock'] = threading.Lock()
+        self.__dict__['health_lock'] = threading.Lock()
+        self.__dict__['stopped'] = threading.Event()
+        if health_interval:
+            thread = threading.Thread(target=self._check_health_loop, args=(health_interval,))
+            thread.daemon = True
+            thread.start()
+
+    def __getattr__(self, attr):
+        """ Return PoolMethod for method attr, or the value of attr in one of the replicas.
+        """
+        methods = self._evaluate(
+            None, lambda proxy: proxy.connection.get_methods(self.codec, self.timeout))
+        if attr in methods:
+            return PoolMethod(self, attr)
+        request = REQMessage('getattr', args=['self', attr], codec=self.codec)
+        return self._evaluate(
+            None, lambda proxy: proxy._remote_eval(request, attr, timeout=self.timeout))
+
+    def __setattr__(self, attr, value):
+        raise PoolException('Attributes can not be set through a pool')
+
+    def _choose(self, route_key=None):
+        """ Return the healthy replica that a request with route_key should be sent to.
+        """
+        with self.lock:
+            replica = None
+            if route_key is not None and self.routing == 'consistent_hash':
+                start = bisect.bisect(self.ring_hashes, _hash(route_key))
+                for i in xrange(len(self.ring)):
+                    candidate = self.replicas[self.ring[(start + i) % len(self.ring)]]
+                    if candidate.healthy:
+                        replica = candidate
+                        break
+            else:
+                healthy = [r for r in self.replicas if r.healthy]
+                if healthy:
+                    replica = min(healthy, key=lambda r: (r.outstanding, r.calls))
+            if replica is None:
+                raise PoolException('No healthy replica of %s' % self.name)
+            replica.outstanding += 1
+            replica.calls += 1
+            return replica
+
+    def _evaluate(self, route_key, fn):
+        """ Return fn(proxy) for the proxy of the replica that route_key is routed to,
+        eject the replica if the request fails.
+        """
+        replica = self._choose(route_key)
+        try:
+            return fn(replica.proxy)
+        except (socket.timeout, zmq.ZMQError):
+            with self.lock:
+                replica.errors += 1
+                replica.healthy = False
+            raise
+        finally:
+            with self.lock:
+                replica.outstanding -= 1
+
+    def check_health(self, timeout=None):
+        """ Ping all replicas, readmit the ones that reply and eject the others.
+
+        Args:
+         - timeout (int): Seconds to wait for reply, default HEALTH_TIMEOUT.
+         
+        """
+        with self.health_lock:
+            if self.stopped.is_set():
+                return
+            for replica in self.replicas:
+                healthy = replica.ping(timeout or self.HEALTH_TIMEOUT, self.codec)
+                with self.lock:
+                    replica.healthy = healthy
+
+    def _check_health_loop(self, interval):
+        while not self.stopped.wait(interval):
+            self.check_health()
+
+    def stats(self):
+        """ Return list with a dict for each replica with its address, if it is healthy,
+        and its number of outstanding requests, calls and errors.
+        """
+        with self.lock:
+            return [{'address': r.proxy.address, 'healthy': r.healthy,
+                     'outstanding': r.outstanding, 'calls': r.calls, 'errors': r.errors}
+                    for r in self.replicas]
+
+    def close(self):
+        """ Stop the health checks and close the sockets used for pings.
+        """
+        self.stopped.set()
+        with self.health_lock:
+            for replica in self.replicas:
+                replica.close()
+
+
+class PoolMethod(object):
+    """ Method of the Malacodas in a Pool, each call is sent to one replica.
+    The keyword argument route_key is used for routing calls in consistent_hash pools,
+    other arguments are as for calls through a Proxy, timeout defaults to the timeout of
+    the pool.
+    """
+    def __init__(self, pool, attr):
+        self.pool = pool
+        self.attr = attr
+
+    def __call__(self, *args, **kwargs):
+        route_key = kwargs.pop('route_key', None)
+        kwargs.setdefault('timeout', self.pool.timeout)
+        return self.pool._evaluate(
+            route_key, lambda proxy: proxy._method_proxy(self.attr)(*args, **kwargs))
+
+
+class Batch(object):
+    """ Collects calls, getattrs and setattrs on a Malacoda and sends them in one request.
+    Methods of the Malacoda are called on the batch as on a proxy, and other attributes
+    are read and written in the same way. Each of these returns the index of its result
+    in the list returned by execute, which is also kept in results. Exceptions raised by
+    the remote evaluations are returned in the list instead of being raised.
+    Names that are not in the method table of the Malacoda are read as attributes, so
+    they can not be called on the batch. Call them, and methods that collide with the
+    names of Batch-methods, with call. Use getattr and setattr for attributes that collide
+    with the names of Batch-methods.
+    """
+    def __init__(self, proxy, parallel=False):
+        self.__dict__['proxy'] = proxy
+        self.__dict__['parallel'] = parallel
+        self.__dict__['requests'] = []
+        self.__dict__['results'] = None
+
+    def call(self, fn_name, *args, **kwargs):
+        """ Add call of method fn_name, return index of its result.
+        """
+        return self._add(REQMessage(fn_name, args, kwargs))
+
+    def getattr(self, attr):
+        """ Add getattr of attr, return index of its result.
+        """
+        return self._add(REQMessage('getattr', args=[self.proxy.attr, attr]))
+
+    def setattr(self, attr, value):
+        """ Add setattr of attr, return index of its result.
+        """
+        return self._add(REQMessage('setattr', args=[self.proxy.attr, attr, value]))
+
+    def _add(self, request):
+        request.codec = self.proxy.codec
+        self.requests.append(request)
+        return len(self.requests) - 1
+
+    def __getattr__(self, attr):
+        if attr.startswith('__'):
+            raise AttributeError(attr)
+        if attr in self.proxy.connection.get_methods(self.proxy.codec):
+            return lambda *args, **kwargs: self.call(attr, *args, **kwargs)
+        return self.getattr(attr)
+
+    def __setattr__(self, attr, value):
+        self.setattr(attr, value)
+
+    def execute(self, timeout=None):
+        """ Send the collected requests and return their results.
+
+        Args:
+         - timeout (int): Socket timeout in seconds (default no timeout)
+        Returns:
+         - (list): Result of each request, or the exception it raised.
+         
+        """
+        request = REQMessage('_malacoda_batch', args=[[r.serialize() for r in self.requests]],
+                             kwargs={'parallel': self.parallel}, codec=self.proxy.codec)
+        reply = self.proxy.connection.request(request, timeout=timeout)
+        if reply.typ == MSG_TYPES.exception:
+            raise reply.val
+        results = []
+        for request, payload in zip(self.requests, reply.val):
+            item = REPMessage.deserialize(payload)
+            if item.typ == MSG_TYPES.method and request.is_getattr:
+                results.append(self.proxy._method_proxy(request.args[1]))
+            else:
+                results.append(item.val)
+        self.__dict__['requests'] = []
+        self.__dict__['results'] = results
+        return results
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.execute()
+
+
+class Future(object):
+    """ Result of an asynchronous remote evaluation.
+    The reply is received by the first thread that asks for a result, so a
+    Future is only completed when result, exception or done is called on it or on
+    another Future from the same AsyncProxy.
+    timeout is the default number of seconds that result and exception wait.
+    """
+    def __init__(self, connection, msg_id, timeout=None):
+        self.connection = connection
+        self.msg_id = msg_id
+        self.timeout = timeout
+        self._event = threading.Event()
+        self._value = None
+        self._exception = None
+
+    def done(self):
+        """ Return True if reply has been received.
+        """
+        if not self._event.is_set():
+            self.connection.receive(timeout=0)
+        return self._event.is_set()
+
+    def result(self, timeout=None):
+        """ Wait for reply and return result of the remote evaluation.
+
+        Args:
+         - timeout (int): Seconds to wait for reply (default self.timeout, which is
+                          None for wait forever).
+        Returns:
+         - Result of the remote evaluation.
+        Raises:
+         - socket.timeout if no reply was received within timeout.
+         - Reraises any exception from the remote evaluation.
+         
+        """
+        self._wait(timeout)
+        if self._exception is not None:
+            raise self._exception
+        return self._value
+
+    def exception(self, timeout=None):
+        """ Wait for reply and return the exception raised by the remote evaluation, or
+        None if it succeeded.
+        """
+        self._wait(timeout)
+        return self._exception
+
+    def _wait(self, timeout):
+        if timeout is None:
+            timeout = self.timeout
+        end = None if timeout is None else time.time() + timeout
+        while not self._event.is_set():
+            remaining = None if end is None else end - time.time()
+            if remaining is not None and remaining <= 0:
+                raise socket.timeout
+            self.connection.receive(timeout=remaining)
+
+    def _set_reply(self, reply):
+        if reply.typ == MSG_TYPES.exception:
+            self._exception = reply.val
+        else:
+            self._value = reply.val
+        self._event.set()
+
+    def _set_exception(self, exception):
+        self._exception = exception
+        self._event.set()
+
+
+class AsyncConnection(object):
+    """ DEALER-socket to a Malacoda that allows many requests in flight.
+    Each request is tagged with a correlation id that is used for matching the
+    reply to its Future.
+    """
+    POLL_INTERVAL = 0.05
+    
+    def __init__(self, address):
+        self.address = address
+        self.lock = threading.Lock()
+        self.pending = {}
+        self.ids = itertools.count(1)
+        self.socket = Socket(get_context(), zmq.DEALER, default_timeout=None)
+        self.socket.connect(endpoint(address))
+
+    def send(self, request, timeout=None):
+        """ Send request and return Future for its reply.
+
+        Args:
+         - request (REQMessage): The request.
+         - timeout (int): Default seconds that the Future waits for the reply.
+        Returns:
+         - (Future): Future for the result of the request.
+        Raises:
+         - socket.error if the connection is closed.
+         
+        """
+        with self.lock:
+            if self.socket is None:
+                raise socket.error('Connection to %s is closed' % self.address)
+            # correlation ids are sent as unsigned 32 bit ints and 0 means no id
+            request.msg_id = next(self.ids) % 0xffffffff + 1
+            future = Future(self, request.msg_id, timeout=timeout)
+            self.pending[request.msg_id] = future
+            self.socket.send_multipart([''] + request.serialize_frames(), copy=False)
+        return future
+
+    def receive(self, timeout=None):
+        """ Receive available replies and complete their futures.
+        The lock is only held for POLL_INTERVAL at a time so that other threads
+        waiting for their replies can check them in between.
+
+        Args:
+         - timeout (int): Max seconds to wait for a reply, None means POLL_INTERVAL.
+         
+        """
+        if timeout is None or timeout > self.POLL_INTERVAL:
+            timeout = self.POLL_INTERVAL
+        with self.lock:
+            if self.socket is None:
+                return
+            wait = int(timeout * 1000)
+            while self.socket.poll(wait, zmq.POLLIN):
+                # first frame is the empty delimiter added by the DEALER-socket
+                frames = self.socket.recv_multipart(copy=False)
+                reply = REPMessage.deserialize_frames(frames[1:])
+                future = self.pending.pop(reply.msg_id, None)
+                if future is not None:
+                    future._set_reply(reply)
+                wait = 0
+
+    def close(self):
+        """ Close the socket, Futures that have not got their reply fail with
+        socket.error.
+        """
+        with self.lock:
+            if self.socket is None:
+                return
+            self.socket.close(linger=0)
+            self.socket = None
+            pending, self.pending = self.pending, {}
+        for future in pending.itervalues():
+            future._set_exception(socket.error('Connection to %s is closed' % self.address))
+
+
+class AsyncProxy(object):
+    """ Proxy around a Malacoda that returns Futures instead of waiting for replies.
+    Calls are pipelined over one connection, so many requests can be sent before
+    collecting the results:
+
+        futures = [d.echo(i) for i in xrange(100)]
+        results = [f.result() for f in futures]
+
+    Attributes are read and written with getattr and setattr, which also return Futures.
+    Each AsyncProxy from get has its own socket, call close when done with it.
+    """
+    def __init__(self, name, address, attr=None, connection=None, codec=None):
+        """
+        Init AsyncProxy with name and address of Malacoda-daemon.
+        Optional attr denotes which method in Malacoda this is proxy for, connection
+        is shared with the parent proxy if given.
+        codec is the name of the codec used for encoding requests, default is pickle.
+        """
+        self.name = name
+        self.address = address
+        self.attr = attr or 'self'
+        self.codec = codec
+        self.connection = connection or AsyncConnection(address)
+
+    def __getattr__(self, attr):
+        """ Return proxy for calling method attr on Malacoda.
+        """
+        if attr.startswith('__'):
+            raise AttributeError(attr)
+        return AsyncProxy(self.name, self.address, attr=attr, connection=self.connection,
+                          codec=self.codec)
+
+    def getattr(self, attr):
+        """ Return Future for value of attr on Malacoda.
+        """
+        return self.connection.send(REQMessage('getattr', args=[self.attr, attr],
+                                               codec=self.codec))
+
+    def setattr(self, attr, value):
+        """ Set attr on Malacoda, return Future that is completed when done.
+        """
+        return self.connection.send(REQMessage('setattr', args=[self.attr, attr, value],
+                                               codec=self.codec))
+
+    def __call__(self, *args, **kwargs):
+        """ Send call to Malacoda and return Future for the result.
+        The keyword arguments timeout, await_reply and idempotency_key are handled as
+        by Proxy, timeout is the default time that the Future waits for the reply.
+        """
+        timeout = kwargs.pop('timeout', None)
+        await_reply = kwargs.pop('await_reply', True)
+        idempotency_key = kwargs.pop('idempotency_key', None)
+        request = REQMessage(self.attr, args, kwargs, codec=self.codec,
+                             await_reply=await_reply, idempotency_key=idempotency_key)
+        return self.connection.send(request, timeout=timeout)
+
+    def close(self):
+        """ Close the connection of this proxy, which is shared with its method proxies.
+        """
+        self.connection.close()
+
+    def __str__(self):
+        return 'AsyncProxy for %s:%s' % (self.name, self.address)
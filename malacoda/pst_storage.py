@@ -17,6 +17,13 @@ Copyright 2014 Gustav Arngården
 """
 
 import os
+import time
+import signal
+import zlib
+import struct
+import sqlite3
+import threading
+from collections import OrderedDict
 from datetime import timedelta
 import cPickle as pickle
 
@@ -27,23 +34,45 @@ class PstStorageException(Exception):
 
 class PstStorage(object):
     """ Base class for persistant storage.
+    If snapshot_mode is 'fork', Malacoda calls fork_save instead of save. This saves
+    the variables in a child process that has a copy-on-write image of the daemon, so
+    the daemon can keep serving requests while the variables are pickled.
+    If lazy is True, Malacoda only asks for the names of the saved variables at startup,
+    and loads each variable with load_variable when it is first accessed.
+    Storages that are used from many threads guard their state with lock, which is held
+    while forking so that the child does not get a copy of it that is never released.
+    A forked save that has not finished within fork_timeout seconds is killed.
     """
+    SNAPSHOT_MODES = (None, 'fork')
+    lazy = False
+    lock = None
+    fork_timeout = 600
     
-    def __init__(self, frequency=None):
+    def __init__(self, frequency=None, snapshot_mode=None):
         """ Init PstStorage.
 
         Args:
          - frequency (timedelta): Call method save with this frequency.
                                   For example timedelta(minutes=1) will save persistant
                                   variables once a minute.
+         - snapshot_mode (basestring): None to save in the calling thread, or 'fork' to
+                                       save in a forked child process.
         """
+        if snapshot_mode not in self.SNAPSHOT_MODES:
+            raise PstStorageException('Unknown snapshot mode: %s' % snapshot_mode)
         self.frequency = frequency
+        self.snapshot_mode = snapshot_mode
 
-    def save(self, psts):
+    def save(self, psts, keys=None):
         """ Persist given variables.
+        psts only contains the variables that have changed since last save, these
+        should be merged with the previously saved variables.
+        For dict-variables that have only been changed with mark_dirty(name, *keys),
+        keys holds the changed keys, storages may use this to only save those entries.
 
         Args:
-         - psts (list): Variables to be persisted, [(variable name, value)]
+         - psts (list): Changed variables to be persisted, [(variable name, value)]
+         - keys (dict): Changed keys of dict-variables, {variable name: set of keys}
         Raises:
          PstStorageException: If persisting failed.
          
@@ -59,13 +88,115 @@ class PstStorage(object):
         """
         raise NotImplemented
 
+    def names(self):
+        """ Return names of saved variables, used if lazy is True.
+        """
+        raise NotImplemented
+
+    def load_variable(self, name):
+        """ Load and return saved variable with given name, used if lazy is True.
+        """
+        raise NotImplemented
+
+    def fork_save(self, psts, keys=None):
+        """ Fork a child process that saves given variables and then exits.
+        If the report of the ForkedSave has an error, e.g. the child was killed while
+        writing, psts must be saved again. The storage repairs what the child left
+        incomplete before the next save.
+
+        Args:
+         - psts (list): Changed variables to be persisted, [(variable name, value)]
+         - keys (dict): Changed keys of dict-variables, see save.
+        Returns:
+         (ForkedSave): Handle for checking if the child has finished.
+         
+        """
+        read_fd, write_fd = os.pipe()
+        started = time.time()
+        if self.lock is not None:
+            self.lock.acquire()
+        try:
+            pid = os.fork()
+        finally:
+            # the child releases its copy of the lock, which the forking thread held
+            if self.lock is not None:
+                self.lock.release()
+        if pid == 0:
+            os.close(read_fd)
+            error = None
+            try:
+                self.save(psts, keys)
+                self.wait()
+            except BaseException as e:
+                error = str(e) or repr(e)
+            os.write(write_fd, pickle.dumps((time.time() - started, error), 2))
+            os._exit(1 if error else 0)
+        os.close(write_fd)
+        self.forked(psts)
+        return ForkedSave(pid, read_fd, started, timeout=self.fork_timeout)
+
+    def forked(self, psts):
+        """ Called in the parent process after forking a child that saves psts.
+        Storages that keep state about saved variables should update it here.
+        """
+        pass
+
+    def wait(self):
+        """ Wait for any background work started by save to finish.
+        """
+        pass
+
+
+class ForkedSave(object):
+    """ Child process started by PstStorage.fork_save.
+    The child is killed if it has not finished within timeout seconds.
+    """
+    def __init__(self, pid, fd, started, timeout=None):
+        self.pid = pid
+        self.fd = fd
+        self.started = started
+        self.timeout = timeout
+        self.report = None
+
+    def poll(self):
+        """ Return None if child is still running, else a report of the save.
+
+        Returns:
+         (dict): {'duration': seconds it took to save, 'error': error message or None}
+         
+        """
+        if self.report is None:
+            pid, status = os.waitpid(self.pid, os.WNOHANG)
+            if not pid:
+                if self.timeout is None or time.time() - self.started < self.timeout:
+                    return None
+                os.kill(self.pid, signal.SIGKILL)
+                os.waitpid(self.pid, 0)
+                os.close(self.fd)
+                self.report = {'duration': time.time() - self.started,
+                               'error': 'Killed after %s seconds' % self.timeout}
+                return self.report
+            data = os.read(self.fd, 65536)
+            os.close(self.fd)
+            if data:
+                duration, error = pickle.loads(data)
+            else:
+                duration = time.time() - self.started
+                error = 'Child exited with status %s' % status
+            self.report = {'duration': duration, 'error': error}
+        return self.report
+
 
 class PstFileStorage(PstStorage):
     """ Saves variables to pickle file.
+    The file holds a pickled list of (name, value). The pickled bytes of each variable are
+    kept in memory, so a save only pickles the changed variables and writes the list from
+    the pickled bytes. The file is written to a temporary file that is renamed over the
+    old one, so a crash while saving leaves the previous save intact.
     """
     DEFAULT_PST_FILE = '/tmp/pst.p'
     
-    def __init__(self, file_path=None, frequency=None):
+    def __init__(self, file_path=None, frequency=None, snapshot_mode=None):
         """ Init PstFileStorage.
 
         Args:
@@ -73,27 +204,379 @@ class PstFileStorage(PstStorage):
          - frequency (timedelta): Call method save with this frequency.
                                   For example timedelta(minutes=1) will save persistant
                                   variables once a minute.
+         - snapshot_mode (basestring): See PstStorage.
         """
         self.file_path = file_path or self.DEFAULT_PST_FILE
+        # pickled (name, value) of saved variables without protocol header and stop
+        # opcode, None until loaded or if only the file has the latest value
+        self.records = None
         frequency = frequency or timedelta(minutes=1)
-        super(PstFileStorage, self).__init__(frequency)
+        super(PstFileStorage, self).__init__(frequency, snapshot_mode)
         
-    def save(self, psts):
-        """ Save variables to pickle file.
+    def save(self, psts, keys=None):
+        """ Merge changed variables with the saved variables and write them to the file.
         """
         try:
-            pickle.dump(psts, open(self.file_path, 'wb'))
+            if self.records is None or None in self.records.itervalues():
+                self.load()
+            for name, value in psts:
+                self.records[name] = self._pickle_record(name, value)
+            tmp_path = '%s.%s' % (self.file_path, os.getpid())
+            with open(tmp_path, 'wb') as f:
+                # a protocol 2 pickle of a list: the records are appended to an empty list
+                # and each record only refers to the memo entries it has put itself
+                f.write('\x80\x02](')
+                for record in self.records.itervalues():
+                    f.write(record)
+                f.write('e.')
+                f.flush()
+                os.fsync(f.fileno())
+            os.rename(tmp_path, self.file_path)
         except Exception as e:
             raise PstStorageException('Could not save variable to file: %s' % e)
+
+    def _pickle_record(self, name, value):
+        return pickle.dumps((name, value), 2)[2:-1]
             
     def load(self):
         """ Load variables from pickle file.
         """
         if not os.path.isfile(self.file_path):
+            self.records = OrderedDict()
             return []
         try:
-            psts = pickle.load(open(self.file_path, 'rb'))
+            with open(self.file_path, 'rb') as f:
+                psts = pickle.load(f)
+            self.records = OrderedDict((name, self._pickle_record(name, value))
+                                       for name, value in psts)
             return psts
         except Exception as e:
             raise PstStorageException('Could not load variables from file: %s' % e)
+
+    def forked(self, psts):
+        """ The child pickles the changed variables, so they are only marked as saved in
+        the file. The next save, in the next child, loads them from the file.
+        """
+        if self.records is not None:
+            for name, _ in psts:
+                self.records[name] = None
         
+
+
+class PstLogStorage(PstStorage):
+    """ Saves variables as records appended to a log file.
+    Each record holds name, version and pickled value of a variable together with a
+    checksum, so a save only writes the changed variables and a crash while writing only
+    loses the last, incomplete, record. The records of each save are fsynced together.
+    The storage keeps the size of the log up to its last complete record, and truncates
+    the log to it before appending, so that records are never written after an incomplete
+    one, which would hide them when loading.
+    When the log grows larger than compact_size it is compacted in a background thread
+    into a snapshot file holding the latest version of each variable. Loading replays
+    the log on top of the snapshot.
+    
+    """
+    DEFAULT_PATH = '/tmp/pst'
+    RECORD = struct.Struct('!IHQI')
+
+    def __init__(self, path=None, frequency=None, compact_size=64 * 1024 * 1024, fsync=True,
+                 snapshot_mode=None):
+        """ Init PstLogStorage.
+
+        Args:
+         - path (basestring): Path and prefix of files, the files are <path>.log and
+                              <path>.snapshot.
+         - frequency (timedelta): Call method save with this frequency.
+                                  For example timedelta(minutes=1) will save persistant
+                                  variables once a minute.
+         - compact_size (int): Compact log when it is larger than this many bytes.
+         - fsync (bool): If True, fsync the log after each save.
+         - snapshot_mode (basestring): See PstStorage.
+        """
+        path = path or self.DEFAULT_PATH
+        self.log_path = path + '.log'
+        self.old_log_path = path + '.log.old'
+        self.snapshot_path = path + '.snapshot'
+        self.compact_size = compact_size
+        self.fsync = fsync
+        self.versions = {}
+        # size of the log up to its last complete record, None if not known
+        self.log_size = None
+        self.lock = threading.Lock()
+        self.compactor = None
+        frequency = frequency or timedelta(minutes=1)
+        super(PstLogStorage, self).__init__(frequency, snapshot_mode)
+
+    def save(self, psts, keys=None):
+        """ Append changed variables to log, compact log if it has grown too large.
+        """
+        with self.lock:
+            try:
+                with open(self.log_path, 'ab') as f:
+                    if self.log_size is None:
+                        self.log_size = self._complete_size(self.log_path)
+                    f.seek(0, os.SEEK_END)
+                    if f.tell() != self.log_size:
+                        f.truncate(self.log_size)
+                    versions = {}
+                    try:
+                        for name, value in psts:
+                            versions[name] = self.versions.get(name, 0) + 1
+                            f.write(self._pack(name, versions[name], pickle.dumps(value, 2)))
+                        f.flush()
+                        if self.fsync:
+                            os.fsync(f.fileno())
+                    except Exception:
+                        f.truncate(self.log_size)
+                        raise
+                    f.seek(0, os.SEEK_END)
+                    size = self.log_size = f.tell()
+                    self.versions.update(versions)
+            except Exception as e:
+                self.log_size = None
+                raise PstStorageException('Could not append variables to log: %s' % e)
+            if self.compactor is not None and self.compactor.is_alive():
+                return
+            if os.path.exists(self.old_log_path):
+                # left by a compaction that was interrupted
+                self._start_compaction()
+            elif size > self.compact_size:
+                os.rename(self.log_path, self.old_log_path)
+                self.log_size = 0
+                self._start_compaction()
+
+    def _start_compaction(self):
+        self.compactor = threading.Thread(target=self.compact)
+        self.compactor.start()
+
+    def forked(self, psts):
+        """ Update versions in the same way as the child does when saving psts.
+        The versions are kept if the child fails, since it may have written complete
+        records with them and a record is only replayed if its version is newer.
+        The child appends to the log, so its size is found again at the next save and a
+        record that a killed child left incomplete is truncated then.
+        """
+        with self.lock:
+            for name, _ in psts:
+                self.versions[name] = self.versions.get(name, 0) + 1
+            self.log_size = None
+
+    def wait(self):
+        """ Wait for compaction to finish.
+        """
+        if self.compactor is not None:
+            self.compactor.join()
+
+    def load(self):
+        """ Load snapshot and replay log on top of it.
+        """
+        with self.lock:
+            try:
+                state = self._load_snapshot()
+                self._replay(self.old_log_path, state)
+                self.log_size = self._replay(self.log_path, state, truncate=True)
+            except Exception as e:
+                raise PstStorageException('Could not load variables from log: %s' % e)
+            self.versions = dict((name, version) for name, (version, _) in state.iteritems())
+        return [(name, value) for name, (_, value) in sorted(state.iteritems())]
+
+    def compact(self):
+        """ Write snapshot of the old log on top of the current snapshot, then remove the
+        old log. Saves during compaction are appended to a new log.
+        """
+        if not os.path.exists(self.old_log_path):
+            return
+        state = self._load_snapshot()
+        self._replay(self.old_log_path, state)
+        tmp_path = self.snapshot_path + '.tmp'
+        with open(tmp_path, 'wb') as f:
+            pickle.dump(state, f, 2)
+            f.flush()
+            os.fsync(f.fileno())
+        os.rename(tmp_path, self.snapshot_path)
+        os.remove(self.old_log_path)
+
+    def _pack(self, name, version, data):
+        header = self.RECORD.pack(0, len(name), version, len(data))[4:]
+        checksum = zlib.crc32(header + name + data) & 0xffffffff
+        return struct.pack('!I', checksum) + header + name + data
+
+    def _load_snapshot(self):
+        if not os.path.isfile(self.snapshot_path):
+            return {}
+        with open(self.snapshot_path, 'rb') as f:
+            return pickle.load(f)
+
+    def _records(self, data):
+        """ Yield (name, version, pickled value, end offset) of the records in data, up
+        to the first incomplete or corrupt record.
+        """
+        offset = 0
+        while offset + self.RECORD.size <= len(data):
+            checksum, name_len, version, data_len = self.RECORD.unpack_from(data, offset)
+            start = offset + self.RECORD.size
+            end = start + name_len + data_len
+            if end > len(data) or \
+               zlib.crc32(data[offset + 4:end]) & 0xffffffff != checksum:
+                return
+            yield data[start:start + name_len], version, data[start + name_len:end], end
+            offset = end
+
+    def _complete_size(self, path):
+        """ Return size of log at path up to its last complete record.
+        """
+        if not os.path.isfile(path):
+            return 0
+        with open(path, 'rb') as f:
+            data = f.read()
+        size = 0
+        for _, _, _, size in self._records(data):
+            pass
+        return size
+
+    def _replay(self, path, state, truncate=False):
+        """ Apply records in log at path to state, {name: (version, value)}.
+        Records with older versions than in state are skipped, reading stops at the first
+        incomplete or corrupt record. If truncate is True, the log is truncated there so
+        that new records are not appended after it.
+
+        Returns:
+         - (int): Size of the log up to its last complete record.
+         
+        """
+        if not os.path.isfile(path):
+            return 0
+        with open(path, 'rb') as f:
+            data = f.read()
+        offset = 0
+        for name, version, value, offset in self._records(data):
+            if version > state.get(name, (0, None))[0]:
+                state[name] = (version, pickle.loads(value))
+        if truncate and offset < len(data):
+            with open(path, 'r+b') as f:
+                f.truncate(offset)
+        return offset
+
+
+class PstSqliteStorage(PstStorage):
+    """ Saves variables in a SQLite database, one row per variable.
+    Dict-variables named in split are saved with one row per entry, so that a save of a
+    variable marked with mark_dirty(name, *keys) only writes the changed entries.
+    If lazy is True, variables are loaded from the database when they are first accessed,
+    which makes startup fast for daemons with much state.
+    Each save is written in one transaction, the database uses write-ahead logging.
+    
+    """
+    DEFAULT_PATH = '/tmp/pst.db'
+    
+    def __init__(self, path=None, frequency=None, split=None, lazy=True, snapshot_mode=None):
+        """ Init PstSqliteStorage.
+
+        Args:
+         - path (basestring): Path to database file.
+         - frequency (timedelta): Call method save with this frequency.
+                                  For example timedelta(minutes=1) will save persistant
+                                  variables once a minute.
+         - split (list): Names of dict-variables to save with one row per entry.
+         - lazy (bool): If True, load variables on first access.
+         - snapshot_mode (basestring): See PstStorage.
+        """
+        self.path = path or self.DEFAULT_PATH
+        self.split = set(split or ())
+        self.lazy = lazy
+        self.lock = threading.Lock()
+        self._connection = None
+        self._pid = None
+        frequency = frequency or timedelta(minutes=1)
+        super(PstSqliteStorage, self).__init__(frequency, snapshot_mode)
+
+    @property
+    def connection(self):
+        """ Connection to the database, a new connection is opened after fork.
+        """
+        if self._connection is None or self._pid != os.getpid():
+            connection = sqlite3.connect(self.path, check_same_thread=False)
+            connection.text_factory = str
+            connection.execute('PRAGMA journal_mode=WAL')
+            connection.execute('PRAGMA synchronous=NORMAL')
+            connection.execute('CREATE TABLE IF NOT EXISTS pst_variables '
+                               '(name TEXT PRIMARY KEY, value BLOB, split INTEGER)')
+            connection.execute('CREATE TABLE IF NOT EXISTS pst_entries '
+                               '(name TEXT, key BLOB, value BLOB, PRIMARY KEY (name, key))')
+            connection.commit()
+            self._connection = connection
+            self._pid = os.getpid()
+        return self._connection
+
+    def save(self, psts, keys=None):
+        """ Save changed variables, or only the changed entries of split dict-variables.
+        """
+        keys = keys or {}
+        with self.lock:
+            try:
+                with self.connection as connection:
+                    for name, value in psts:
+                        if name in self.split and isinstance(value, dict):
+                            self._save_entries(connection, name, value, keys.get(name))
+                        else:
+                            connection.execute('DELETE FROM pst_entries WHERE name = ?',
+                                               (name,))
+                            connection.execute('INSERT OR REPLACE INTO pst_variables '
+                                               'VALUES (?, ?, 0)', (name, _dumps(value)))
+            except Exception as e:
+                raise PstStorageException('Could not save variables to database: %s' % e)
+
+    def _save_entries(self, connection, name, value, keys=None):
+        """ Save entries of dict-variable, only entries with given keys if keys is set.
+        """
+        connection.execute('INSERT OR REPLACE INTO pst_variables VALUES (?, NULL, 1)', (name,))
+        if keys is None:
+            connection.execute('DELETE FROM pst_entries WHERE name = ?', (name,))
+            keys = value.iterkeys()
+        for key in keys:
+            if key in value:
+                connection.execute('INSERT OR REPLACE INTO pst_entries VALUES (?, ?, ?)',
+                                   (name, _dumps(key), _dumps(value[key])))
+            else:
+                connection.execute('DELETE FROM pst_entries WHERE name = ? AND key = ?',
+                                   (name, _dumps(key)))
+
+    def load(self):
+        """ Load all variables from database.
+        """
+        return [(name, self.load_variable(name)) for name in self.names()]
+
+    def names(self):
+        """ Return names of saved variables.
+        """
+        with self.lock:
+            try:
+                rows = self.connection.execute('SELECT name FROM pst_variables').fetchall()
+            except Exception as e:
+                raise PstStorageException('Could not load variables from database: %s' % e)
+        return sorted(name for name, in rows)
+
+    def load_variable(self, name):
+        """ Load variable with given name from database.
+        """
+        with self.lock:
+            try:
+                row = self.connection.execute('SELECT value, split FROM pst_variables '
+                                              'WHERE name = ?', (name,)).fetchone()
+                if row is None:
+                    raise KeyError(name)
+                if not row[1]:
+                    return _loads(row[0])
+                rows = self.connection.execute('SELECT key, value FROM pst_entries '
+                                               'WHERE name = ?', (name,))
+                return dict((_loads(key), _loads(value)) for key, value in rows)
+            except Exception as e:
+                raise PstStorageException('Could not load variable %s from database: %s'
+                                          % (name, e))
+
+
+def _dumps(value):
+    return sqlite3.Binary(pickle.dumps(value, 2))
+
+def _loads(data):
+    return pickle.loads(str(data))
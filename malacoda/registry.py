@@ -0,0 +1,289 @@
+# -*- coding: utf-8 -*-
+
+"""
+Copyright 2014 Gustav Arngården 
+
+   Licensed under the Apache License, Version 2.0 (the "License");
+   you may not use this file except in compliance with the License.
+   You may obtain a copy of the License at
+
+     http://www.apache.org/licenses/LICENSE-2.0
+
+   Unless required by applicable law or agreed to in writing, software
+   distributed under the License is distributed on an "AS IS" BASIS,
+   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+   See the License for the specific language governing permissions and
+   limitations under the License.
+"""
+
+import os
+import time
+import json
+import errno
+import fcntl
+import socket
+import tempfile
+import threading
+from contextlib import contextmanager
+import proxy
+from message import REQMessage, MSG_TYPES
+
+DISCOVERY_ADDRESS = os.environ.get('MALACODA_DISCOVERY')
+DISCOVERY_TIMEOUT = 2
+REGISTER_INTERVAL = 30
+CACHE_TTL = 10
+RUNTIME_DIR = os.environ.get('MALACODA_RUNTIME_DIR') or \
+              (os.path.join(os.environ['XDG_RUNTIME_DIR'], 'malacoda')
+               if os.environ.get('XDG_RUNTIME_DIR') else
+               os.path.join(tempfile.gettempdir(), 'malacoda-%s' % os.getuid()))
+REGISTRY_PATH = os.environ.get('MALACODA_REGISTRY') or os.path.join(RUNTIME_DIR,
+                                                                    'registry.json')
+
+
+class RegistryException(Exception):
+    pass
+
+
+class LocalRegistry(object):
+    """ Registry of the Malacodas running on this host, saved in a JSON file.
+    By default the file is in RUNTIME_DIR, which only this user can access, so each user
+    has a registry of their own. A file that can not be parsed is read as an empty
+    registry.
+    The file is locked while reading and writing so that many processes can use it.
+    Entries are dicts with keys host, port, pid and registered, and the ipc- and
+    inproc-endpoints of the Malacoda if they could be bound. Entries are keyed by name and
+    pid, so several Malacodas with the same name can be registered.
+    
+    """
+    def __init__(self, path=None):
+        self.path = path or REGISTRY_PATH
+
+    @contextmanager
+    def _locked(self, exclusive=False):
+        directory = os.path.dirname(self.path)
+        if directory == RUNTIME_DIR or not os.path.isdir(directory):
+            make_private_dir(directory)
+        with open(self.path + '.lock', 'a') as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def _read(self):
+        try:
+            with open(self.path, 'rb') as f:
+                return dict(((entry.pop('name'), entry['pid']), entry)
+                            for entry in json.load(f))
+        except Exception:
+            return {}
+
+    def _write(self, entries):
+        tmp_path = '%s.%s' % (self.path, os.getpid())
+        with os.fdopen(os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0600),
+                       'wb') as f:
+            json.dump([dict(entry, name=name) for (name, _), entry in entries.iteritems()], f)
+        os.rename(tmp_path, self.path)
+
+    def register(self, name, entry):
+        """ Register Malacoda with given name.
+
+        Args:
+         - name (basestring): Name of Malacoda.
+         - entry (dict): Address of Malacoda, {'host': host, 'port': port, 'pid': pid,
+                                               'ipc': endpoint, 'inproc': endpoint}.
+         
+        """
+        with self._locked(exclusive=True):
+            entries = dict((key, e) for key, e in self._read().iteritems()
+                           if _pid_exists(e['pid']))
+            entries[(name, entry['pid'])] = dict(entry, registered=time.time())
+            self._write(entries)
+
+    def unregister(self, name, pid):
+        """ Remove Malacoda with given name that is registered by process pid.
+        """
+        with self._locked(exclusive=True):
+            entries = self._read()
+            if entries.pop((name, pid), None) is not None:
+                self._write(entries)
+
+    def lookup_all(self, name):
+        """ Return list of entries of the running Malacodas with given name, the most
+        recently registered last.
+        """
+        with self._locked():
+            entries = [entry for (entry_name, _), entry in self._read().iteritems()
+                       if entry_name == name]
+        return sorted((entry for entry in entries if _pid_exists(entry['pid'])),
+                      key=lambda entry: entry['registered'])
+
+    def lookup(self, name):
+        """ Return entry of Malacoda with given name, or None if it is not running.
+        If several Malacodas with the name are running, the most recently registered
+        one is returned.
+        """
+        entries = self.lookup_all(name)
+        return entries[-1] if entries else None
+
+local_registry = LocalRegistry()
+
+
+def make_private_dir(path):
+    """ Create directory path, and its parents, with access only for this user if it does
+    not exist.
+
+    Raises:
+     - RegistryException if the directory is owned by another user.
+     
+    """
+    try:
+        os.makedirs(path, 0700)
+    except OSError as e:
+        if e.errno != errno.EEXIST:
+            raise
+    if os.stat(path).st_uid != os.getuid():
+        raise RegistryException('%s is owned by another user' % path)
+
+
+def ipc_path(name, pid=None):
+    """ Return path of the Unix socket that Malacoda with given name and pid binds.
+    """
+    return os.path.join(RUNTIME_DIR, name, '%s.sock' % (pid or os.getpid()))
+
+
+def _pid_exists(pid):
+    try:
+        os.kill(pid, 0)
+    except OSError as e:
+        return e.errno == errno.EPERM
+    return True
+
+
+def _discovery_call(discovery, method, *args):
+    """ Call method on the discovery daemon and return the result.
+    The request is sent directly on the connection, since a Proxy would first ask for the
+    method table without timeout.
+
+    Raises:
+     - socket.timeout if the discovery daemon does not reply within DISCOVERY_TIMEOUT.
+     - Reraises any exception from the remote evaluation.
+     
+    """
+    reply = proxy.pool.get(discovery).request(REQMessage(method, list(args), {}),
+                                              timeout=DISCOVERY_TIMEOUT)
+    if reply.typ == MSG_TYPES.exception:
+        raise reply.val
+    return reply.val
+
+_cache = {}
+_cache_lock = threading.Lock()
+
+def lookup(name, host=None, discovery=None):
+    """ Return entry of Malacoda with given name, or None if it can not be found.
+    Entries are looked up in a client side cache, in the local registry if host is
+    None or this host, and with the discovery daemon if one is given or configured
+    in DISCOVERY_ADDRESS. Found entries are cached for CACHE_TTL seconds.
+
+    Args:
+     - name (basestring): Name of Malacoda.
+     - host (basestring): Optional host that Malacoda runs on.
+     - discovery (basestring): Optional address, host:port, of discovery daemon.
+    Returns:
+     - (dict): {'host': host, 'port': port, 'pid': pid} or None, entries from the local
+               registry can also have the ipc- and inproc-endpoints of the Malacoda.
+    Raises:
+     - RegistryException if host is None and more than one host runs a Malacoda with name.
+                         If several Malacodas with the name run on one host, the most
+                         recently registered one is returned.
+     
+    """
+    key = (name, host)
+    now = time.time()
+    with _cache_lock:
+        cached = _cache.get(key)
+    if cached and cached[1] > now:
+        return cached[0]
+    entry = None
+    if host in (None, 'localhost', socket.gethostname(), socket.getfqdn()):
+        entry = local_registry.lookup(name)
+    discovery = discovery or DISCOVERY_ADDRESS
+    if entry is None and discovery:
+        entries = _discovery_call(discovery, 'lookup', name, host)
+        if len(set(e['host'] for e in entries)) > 1:
+            raise RegistryException('More than one Malacoda with name %s: %s' % (
+                name, ', '.join('%s:%s' % (e['host'], e['port']) for e in entries)))
+        entry = entries[-1] if entries else None
+    if entry is not None:
+        with _cache_lock:
+            _cache[key] = (entry, now + CACHE_TTL)
+    return entry
+
+
+def lookup_all(name, discovery=None):
+    """ Return entries of all Malacodas with given name, the ones on this host from the
+    local registry and the ones registered with the discovery daemon if one is given or
+    configured in DISCOVERY_ADDRESS. Entries are not cached.
+
+    Args:
+     - name (basestring): Name of Malacoda.
+     - discovery (basestring): Optional address, host:port, of discovery daemon.
+    Returns:
+     - (list): Entries, see lookup.
+     
+    """
+    entries = local_registry.lookup_all(name)
+    local_pids = set(entry['pid'] for entry in entries)
+    discovery = discovery or DISCOVERY_ADDRESS
+    if discovery:
+        local_hosts = ('localhost', socket.gethostname(), socket.getfqdn())
+        for entry in _discovery_call(discovery, 'lookup', name, None):
+            if entry['host'] in local_hosts and entry['pid'] in local_pids:
+                continue
+            entries.append(entry)
+    return entries
+
+
+def invalidate(name, host=None):
+    """ Remove cached entry for Malacoda with given name.
+    """
+    with _cache_lock:
+        _cache.pop((name, host), None)
+
+
+def keep_registered(malacoda_obj, host, port, discovery=None, endpoints=None):
+    """ Register Malacoda in the local registry and with the discovery daemon, and
+    unregister it when it stops. The registration with the discovery daemon is renewed
+    every REGISTER_INTERVAL seconds. This is meant to be run in a separate thread.
+
+    Args:
+     - malacoda_obj (Malacoda): The Malacoda to register.
+     - host (basestring): Host that Malacoda is listening to.
+     - port (int): Port that Malacoda is listening to.
+     - discovery (basestring): Optional address, host:port, of discovery daemon.
+     - endpoints (dict): ipc- and inproc-endpoints of Malacoda, {transport: endpoint},
+                         these are only registered in the local registry.
+     
+    """
+    name = malacoda_obj.name
+    pid = os.getpid()
+    discovery = discovery or DISCOVERY_ADDRESS
+    entry = dict(endpoints or {}, host='localhost', port=port, pid=pid)
+    local_registry.register(name, entry)
+    if host in ('0.0.0.0', '*'):
+        host = socket.getfqdn()
+    last_register = 0
+    while malacoda_obj.running:
+        if discovery and last_register + REGISTER_INTERVAL <= time.time():
+            try:
+                _discovery_call(discovery, 'register', name, host, port, pid)
+            except Exception as e:
+                malacoda_obj.logger.warning('Could not register with discovery: %s' % e)
+            last_register = time.time()
+        time.sleep(1)
+    local_registry.unregister(name, pid)
+    if discovery:
+        try:
+            _discovery_call(discovery, 'unregister', name, host, pid)
+        except Exception as e:
+            malacoda_obj.logger.warning('Could not unregister with discovery: %s' % e)
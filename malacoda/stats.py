@@ -0,0 +1,229 @@
+# -*- coding: utf-8 -*-
+
+"""
+Copyright 2014 Gustav Arngården 
+
+   Licensed under the Apache License, Version 2.0 (the "License");
+   you may not use this file except in compliance with the License.
+   You may obtain a copy of the License at
+
+     http://www.apache.org/licenses/LICENSE-2.0
+
+   Unless required by applicable law or agreed to in writing, software
+   distributed under the License is distributed on an "AS IS" BASIS,
+   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+   See the License for the specific language governing permissions and
+   limitations under the License.
+"""
+
+import os
+import time
+import threading
+
+PERCENTILES = (50, 90, 99, 99.9)
+UNKNOWN = '(unknown)'
+
+
+class Histogram(object):
+    """ Histogram of durations with logarithmic buckets, in the style of HdrHistogram.
+    Durations are counted in microseconds, below 2 ** SUB_BUCKET_BITS microseconds each
+    value has its own bucket, above that each power of two is divided into
+    2 ** (SUB_BUCKET_BITS - 1) buckets. Percentiles therefore have a relative error of
+    at most 2 ** (1 - SUB_BUCKET_BITS), while a histogram only has one counter per
+    bucket that has been used.
+    
+    """
+    SUB_BUCKET_BITS = 5
+
+    def __init__(self):
+        self.counts = {}
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def record(self, duration):
+        """ Count duration.
+
+        Args:
+         - duration (float): Duration in seconds.
+         
+        """
+        micros = int(duration * 1000000)
+        shift = max(micros.bit_length() - self.SUB_BUCKET_BITS, 0)
+        bucket = micros >> shift << shift
+        self.counts[bucket] = self.counts.get(bucket, 0) + 1
+        self.count += 1
+        self.total += duration
+        if duration > self.max:
+            self.max = duration
+
+    def merge(self, other):
+        """ Add the counts of other histogram to this one.
+        """
+        for bucket, count in other.counts.iteritems():
+            self.counts[bucket] = self.counts.get(bucket, 0) + count
+        self.count += other.count
+        self.total += other.total
+        self.max = max(self.max, other.max)
+
+    def percentile(self, percent):
+        """ Return duration in seconds that percent of the durations are less than or
+        equal to, the middle of its bucket is returned.
+        """
+        if not self.count:
+            return 0.0
+        limit = self.count * percent / 100.0
+        seen = 0
+        for bucket in sorted(self.counts):
+            seen += self.counts[bucket]
+            if seen >= limit:
+                break
+        width = 1 << max(bucket.bit_length() - self.SUB_BUCKET_BITS, 0)
+        return min((bucket + width / 2.0) / 1000000, self.max)
+
+    def summary(self):
+        """ Return summary of histogram.
+
+        Returns:
+         - (dict): {'count', 'mean', 'max' and 'p<percentile>' for each of PERCENTILES},
+                   durations are in seconds.
+         
+        """
+        summary = {'count': self.count, 'max': self.max,
+                   'mean': self.total / self.count if self.count else 0.0}
+        for percent in PERCENTILES:
+            summary['p%s' % percent] = self.percentile(percent)
+        return summary
+
+
+class MethodStats(object):
+    """ Counters and histograms of the requests to one method.
+    """
+    COUNTERS = ('calls', 'errors', 'bytes_in', 'bytes_out', 'deserialize_time',
+                'execute_time', 'serialize_time')
+
+    def __init__(self):
+        for name in self.COUNTERS:
+            setattr(self, name, 0)
+        self.latency = Histogram()
+        self.queue_wait = Histogram()
+
+    def summary(self):
+        summary = dict((name, getattr(self, name)) for name in self.COUNTERS)
+        summary['latency'] = self.latency.summary()
+        summary['queue_wait'] = self.queue_wait.summary()
+        return summary
+
+
+class Stats(object):
+    """ Request statistics of a Malacoda, recorded per method.
+    Getattrs and setattrs are recorded as the methods 'getattr' and 'setattr', and
+    calls of names that are not methods of the Malacoda as UNKNOWN, so that clients can
+    not add names to the statistics without bound.
+    
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.methods = {}
+        self.started = time.time()
+
+    def record(self, name, error=False, bytes_in=0, bytes_out=0, deserialize_time=0.0,
+               execute_time=0.0, serialize_time=0.0, queue_wait=None):
+        """ Record a request.
+
+        Args:
+         - name (basestring): Name of the method.
+         - error (bool): True if the request raised an exception.
+         - bytes_in (int): Size of the request.
+         - bytes_out (int): Size of the reply.
+         - deserialize_time (float): Seconds spent deserializing the request.
+         - execute_time (float): Seconds spent evaluating the request.
+         - serialize_time (float): Seconds spent serializing the reply.
+         - queue_wait (float): Seconds the request waited before it was evaluated,
+                               None if not known.
+                               
+        """
+        with self.lock:
+            method = self.methods.get(name)
+            if method is None:
+                method = self.methods[name] = MethodStats()
+            method.calls += 1
+            method.errors += bool(error)
+            method.bytes_in += bytes_in
+            method.bytes_out += bytes_out
+            method.deserialize_time += deserialize_time
+            method.execute_time += execute_time
+            method.serialize_time += serialize_time
+            method.latency.record(deserialize_time + execute_time + serialize_time)
+            if queue_wait is not None:
+                method.queue_wait.record(queue_wait)
+
+    def summary(self):
+        """ Return summary of the statistics.
+
+        Returns:
+         - (dict): {'uptime': seconds since start,
+                    'methods': {name: counters and summaries of the latency and queue wait
+                                histograms, see Histogram.summary},
+                    'latency', 'queue_wait': summaries over all methods}
+         
+        """
+        latency = Histogram()
+        queue_wait = Histogram()
+        with self.lock:
+            methods = {}
+            for name, method in self.methods.iteritems():
+                methods[name] = method.summary()
+                latency.merge(method.latency)
+                queue_wait.merge(method.queue_wait)
+        return {'uptime': time.time() - self.started, 'methods': methods,
+                'latency': latency.summary(), 'queue_wait': queue_wait.summary()}
+
+    def prometheus(self, labels=None, gauges=None):
+        """ Return the statistics in the Prometheus text format.
+
+        Args:
+         - labels (dict): Labels added to every sample, e.g. {'daemon': name}.
+         - gauges (dict): Extra values to export, {metric name: value}.
+        Returns:
+         - (str): The metrics.
+         
+        """
+        summary = self.summary()
+        lines = []
+
+        def sample(metric, extra, value):
+            all_labels = dict(labels or {}, **extra)
+            label_str = ','.join('%s="%s"' % (key, all_labels[key])
+                                 for key in sorted(all_labels))
+            lines.append('malacoda_%s{%s} %r' % (metric, label_str, value))
+
+        methods = sorted(summary['methods'].iteritems())
+        for counter in MethodStats.COUNTERS:
+            metric = counter.replace('_time', '_seconds') + '_total'
+            lines.append('# TYPE malacoda_%s counter' % metric)
+            for name, method in methods:
+                sample(metric, {'method': name}, method[counter])
+        for histogram in ('latency', 'queue_wait'):
+            metric = '%s_seconds' % histogram
+            lines.append('# TYPE malacoda_%s summary' % metric)
+            for name, method in methods:
+                values = method[histogram]
+                for percent in PERCENTILES:
+                    sample(metric, {'method': name, 'quantile': str(percent / 100.0)},
+                           values['p%s' % percent])
+                sample(metric + '_sum', {'method': name}, values['mean'] * values['count'])
+                sample(metric + '_count', {'method': name}, values['count'])
+        for name, value in sorted((gauges or {}).iteritems()):
+            lines.append('# TYPE malacoda_%s gauge' % name)
+            sample(name, {}, value)
+        return '\n'.join(lines) + '\n'
+
+    def write_prometheus(self, path, labels=None, gauges=None):
+        """ Write the statistics in the Prometheus text format to path, for the textfile
+        collector of the Prometheus node exporter. The file is replaced atomically.
+        """
+        tmp_path = '%s.%s' % (path, os.getpid())
+        with open(tmp_path, 'w') as f:
+            f.write(self.prometheus(labels, gauges))
+        os.rename(tmp_path, path)
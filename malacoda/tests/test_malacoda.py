@@ -6,8 +6,14 @@ import os
 import unittest
 import time
 import socket
+import threading
+import zmq
 import malacoda
 import pst_storage
+import message
+import registry
+import zmq_socket
+import stats
 
 PST_FILE = '/tmp/pst_test.p'
 
@@ -30,6 +36,8 @@ class TestMalacoda(unittest.TestCase):
         self.assertEqual(zp.constant, 10)
         self.assertTrue(callable(zp.echo))
         self.assertEqual(zp.echo('hello'), 'hello')
+        self.assertIn('echo', zp._malacoda_describe()['methods'])
+        self.assertNotIn('constant', zp._malacoda_describe()['methods'])
         with self.assertRaises(AttributeError):
             zp.unknown()
         with self.assertRaises(socket.timeout):
@@ -51,14 +59,405 @@ class TestMalacoda(unittest.TestCase):
         with open(PST_FILE, 'rb') as f:
             self.assertEqual(pickle.load(f), [('pst_list', [1, 2, 3])])
         p.join()
+
+    def test_listener_workers(self):
+        p = Process(target=start_malacoda, kwargs={'port': 51002, 'listener_workers': 2})
+        p.start()
+        slow = malacoda.get('SimpleMalacoda:51002')
+        zp = malacoda.get('SimpleMalacoda:51002')
+        t = threading.Thread(target=slow.timeout, args=(3,))
+        t.start()
+        time.sleep(0.5)
+        self.assertEqual(zp.echo('hello', timeout=1), 'hello')
+        t.join()
+        zp.stop()
+        p.join()
+
+    def test_async_proxy(self):
+        p = Process(target=start_malacoda, kwargs={'port': 51003, 'listener_workers': 2})
+        p.start()
+        zp = malacoda.get('SimpleMalacoda:51003', mode='async')
+        slow = zp.timeout(2)
+        futures = [zp.echo(i) for i in xrange(50)]
+        self.assertEqual([f.result(timeout=1) for f in futures], range(50))
+        self.assertFalse(slow.done())
+        self.assertEqual(zp.getattr('constant').result(), 5)
+        with self.assertRaises(AttributeError):
+            zp.unknown().result()
+        self.assertEqual(zp.echo('hello', timeout=1).result(), 'hello')
+        slow.result()
+        zp.stop().result()
+        zp.close()
+        p.join()
+
+    def test_bad_messages(self):
+        p = Process(target=start_malacoda, kwargs={'port': 51018})
+        p.start()
+        zp = malacoda.get('SimpleMalacoda:51018')
+        sock = zmq_socket.Socket(zmq_socket.get_context(), zmq.REQ)
+        sock.connect('tcp://localhost:51018')
+        sock.send('not a message')
+        rep = sock.recv_message(message.REPMessage, timeout=5)
+        self.assertEqual(rep.typ, message.MSG_TYPES.exception)
+        sock.close()
+        with self.assertRaises(malacoda.MalacodaException):
+            zp.fn()
+        self.assertEqual(zp.echo('hello'), 'hello')
+        zp.stop()
+        p.join()
+
+    def test_codecs(self):
+        for codec in message.CODECS:
+            req = message.REQMessage('echo', ('hello', [1, 2]), {'a': 1}, msg_id=3, codec=codec)
+            msg = message.REQMessage.deserialize(req.serialize())
+            self.assertEqual((msg.fn_name, msg.args, msg.kwargs, msg.msg_id, msg.codec),
+                             ('echo', ['hello', [1, 2]], {'a': 1}, 3, codec))
+            rep = message.REPMessage(typ=message.MSG_TYPES.exception, val=KeyError('a'),
+                                     codec=codec)
+            msg = message.REPMessage.deserialize(rep.serialize())
+            self.assertEqual(msg.typ, message.MSG_TYPES.exception)
+            self.assertIsInstance(msg.val, KeyError)
+        with self.assertRaises(message.MessageException):
+            message.REPMessage.deserialize(req.serialize())
+
+    def test_out_of_band_frames(self):
+        big = 'x' * message.OOB_THRESHOLD
+        req = message.REQMessage('echo', (big, bytearray(big), 'small'), {'a': 1})
+        frames = req.serialize_frames()
+        self.assertEqual(len(frames), 3)
+        self.assertIs(frames[1], big)
+        msg = message.REQMessage.deserialize_frames(frames)
+        self.assertEqual(msg.args, [big, bytearray(big), 'small'])
+        self.assertIsInstance(msg.args[1], bytearray)
+        self.assertLess(len(frames[0]), 200)
+        self.assertEqual(message.REQMessage.deserialize(req.serialize()).args, msg.args)
+
+    def test_local_registry(self):
+        reg = registry.LocalRegistry('/tmp/registry_test.json')
+        reg.register('A', {'host': 'localhost', 'port': 51000, 'pid': os.getpid()})
+        reg.register('B', {'host': 'localhost', 'port': 51001, 'pid': 2 ** 22 + 1})
+        self.assertEqual(reg.lookup('A')['port'], 51000)
+        self.assertIsNone(reg.lookup('B'))
+        reg.register('A', {'host': 'localhost', 'port': 51002, 'pid': os.getppid()})
+        self.assertEqual([e['port'] for e in reg.lookup_all('A')], [51000, 51002])
+        self.assertEqual(reg.lookup('A')['port'], 51002)
+        reg.unregister('A', os.getppid())
+        reg.unregister('A', os.getpid() + 1)
+        self.assertEqual(reg.lookup('A')['port'], 51000)
+        reg.unregister('A', os.getpid())
+        self.assertIsNone(reg.lookup('A'))
+        with open('/tmp/registry_test.json', 'wb') as f:
+            f.write('not json')
+        self.assertIsNone(reg.lookup('A'))
+        os.system('rm /tmp/registry_test.json*')
+
+    def test_pst_file_storage_merge(self):
+        storage = pst_storage.PstFileStorage(file_path=PST_FILE)
+        storage.save([('pst_dict', {'a': 1})])
+        storage.save([('pst_list', [2])])
+        self.assertEqual(storage.load(), [('pst_list', [2]), ('pst_dict', {'a': 1})])
+
+    def test_pst_log_storage(self):
+        os.system('rm -f /tmp/pst_log_test.*')
+        storage = pst_storage.PstLogStorage(path='/tmp/pst_log_test', compact_size=100)
+        storage.save([('pst_a', 1), ('pst_b', 'x' * 100)])
+        storage.compactor.join()
+        storage.save([('pst_a', 2)])
+        with open('/tmp/pst_log_test.log', 'ab') as f:
+            f.write('incomplete record')
+        storage = pst_storage.PstLogStorage(path='/tmp/pst_log_test')
+        self.assertEqual(storage.load(), [('pst_a', 2), ('pst_b', 'x' * 100)])
+        storage.save([('pst_b', 'y')])
+        storage = pst_storage.PstLogStorage(path='/tmp/pst_log_test')
+        self.assertEqual(storage.load(), [('pst_a', 2), ('pst_b', 'y')])
+        # a record torn while the storage is running is not followed by later saves
+        record = storage._pack('pst_a', 5, pickle.dumps(5, 2))
+        with open('/tmp/pst_log_test.log', 'ab') as f:
+            f.write(record[:len(record) // 2])
+        storage.save([('pst_a', 3), ('pst_c', 4)])
+        storage = pst_storage.PstLogStorage(path='/tmp/pst_log_test')
+        self.assertEqual(storage.load(), [('pst_a', 3), ('pst_b', 'y'), ('pst_c', 4)])
+        os.system('rm -f /tmp/pst_log_test.*')
+
+    def test_pst_fork_save(self):
+        storage = pst_storage.PstFileStorage(file_path=PST_FILE, snapshot_mode='fork')
+        forked_save = storage.fork_save([('pst_list', [1, 2])])
+        while forked_save.poll() is None:
+            time.sleep(0.01)
+        self.assertIsNone(forked_save.poll()['error'])
+        self.assertEqual(storage.load(), [('pst_list', [1, 2])])
+        storage = SlowFileStorage(file_path=PST_FILE, snapshot_mode='fork')
+        storage.fork_timeout = 0.5
+        forked_save = storage.fork_save([('pst_list', [3])])
+        while forked_save.poll() is None:
+            time.sleep(0.01)
+        self.assertIn('Killed', forked_save.poll()['error'])
+        self.assertEqual(storage.load(), [('pst_list', [1, 2])])
+        os.system('rm -f /tmp/pst_log_test.*')
+        storage = SlowLogStorage(path='/tmp/pst_log_test', snapshot_mode='fork')
+        storage.fork_timeout = 0.5
+        pst_storage.PstLogStorage.save(storage, [('pst_a', 1)])
+        forked_save = storage.fork_save([('pst_a', 2)])
+        while forked_save.poll() is None:
+            time.sleep(0.01)
+        self.assertIn('Killed', forked_save.poll()['error'])
+        pst_storage.PstLogStorage.save(storage, [('pst_a', 2)])
+        storage = pst_storage.PstLogStorage(path='/tmp/pst_log_test')
+        self.assertEqual(storage.load(), [('pst_a', 2)])
+        os.system('rm -f /tmp/pst_log_test.*')
+
+    def test_pst_sqlite_storage(self):
+        os.system('rm -f /tmp/pst_test.db*')
+        storage = pst_storage.PstSqliteStorage(path='/tmp/pst_test.db', split=['pst_dict'])
+        storage.save([('pst_list', [1]), ('pst_dict', {'a': 1, 'b': 2})])
+        storage.save([('pst_dict', {'a': 3, 'c': 4})], keys={'pst_dict': set(['a', 'b'])})
+        self.assertEqual(storage.names(), ['pst_dict', 'pst_list'])
+        self.assertEqual(storage.load_variable('pst_dict'), {'a': 3})
+        self.assertEqual(storage.load(), [('pst_dict', {'a': 3}), ('pst_list', [1])])
+        os.system('rm -f /tmp/pst_test.db*')
+
+    def test_await_reply(self):
+        p = Process(target=start_malacoda, kwargs={'port': 51004, 'push_channel': True})
+        p.start()
+        zp = malacoda.get('SimpleMalacoda:51004')
+        self.assertTrue(zp.update_pst_list([4], await_reply=False))
+        zp.update_pst_list([5], await_reply=False, ack=False)
+        self.assertEqual(zp.echo('hello', ack=False, track=True), 'hello')
+        time.sleep(1)
+        self.assertEqual(zp.pst_list, [5])
+        stats = zp._call_queue_stats()
+        self.assertEqual((stats['depth'], stats['executed'], stats['dropped']), (0, 2, 0))
+        zp.stop()
+        p.join()
+
+    def test_batch(self):
+        p = Process(target=start_malacoda, kwargs={'port': 51005})
+        p.start()
+        zp = malacoda.get('SimpleMalacoda:51005')
+        for parallel in (False, True):
+            with zp.batch(parallel=parallel) as b:
+                b.echo('hello')
+                b.constant = 7
+                b.constant
+                b.call('unknown')
+                b.fn()
+                b.echo('world')
+            self.assertEqual(b.results[:3], ['hello', None, 7])
+            self.assertIsInstance(b.results[3], AttributeError)
+            self.assertIsInstance(b.results[4], malacoda.MalacodaException)
+            self.assertEqual(b.results[5], 'world')
+        zp.stop()
+        p.join()
+
+    def test_stream(self):
+        p = Process(target=start_malacoda, kwargs={'port': 51006})
+        p.start()
+        zp = malacoda.get('SimpleMalacoda:51006')
+        self.assertEqual(list(zp.count(250)), range(250))
+        with zp.count(1000) as items:
+            self.assertEqual(items.next(), 0)
+        self.assertEqual(zp._streams, {})
+        zp.stop()
+        p.join()
+
+    def test_stats(self):
+        histogram = stats.Histogram()
+        for micros in xrange(1, 1001):
+            histogram.record(micros / 1000000.0)
+        self.assertEqual(histogram.count, 1000)
+        self.assertAlmostEqual(histogram.percentile(50), 0.0005, delta=0.00002)
+        self.assertAlmostEqual(histogram.percentile(99), 0.00099, delta=0.00004)
+        p = Process(target=start_malacoda, kwargs={'port': 51007, 'listener_workers': 2})
+        p.start()
+        zp = malacoda.get('SimpleMalacoda:51007')
+        zp.echo('hello')
+        with self.assertRaises(AttributeError):
+            zp.unknown()
+        with self.assertRaises(AttributeError):
+            zp._method_proxy('missing')()
+        summary = zp._malacoda_stats()
+        self.assertEqual(summary['methods']['echo']['calls'], 1)
+        self.assertEqual(summary['methods']['echo']['queue_wait']['count'], 1)
+        self.assertEqual(summary['methods']['getattr']['errors'], 1)
+        self.assertEqual(summary['methods'][stats.UNKNOWN]['errors'], 1)
+        self.assertNotIn('missing', summary['methods'])
+        zp.stop()
+        p.join()
+
+    def test_profiler(self):
+        p = Process(target=start_malacoda, kwargs={'port': 51008})
+        p.start()
+        zp = malacoda.get('SimpleMalacoda:51008')
+        zp._profile_start(interval_ms=5)
+        with self.assertRaises(malacoda.MalacodaException):
+            zp._profile_start()
+        time.sleep(0.5)
+        result = zp._profile_stop()
+        self.assertGreater(result['samples'], 10)
+        self.assertIn('test_malacoda.py:_run', result['stacks'])
+        with self.assertRaises(malacoda.MalacodaException):
+            zp._profile_stop()
+        zp.stop()
+        p.join()
+
+    def test_transports(self):
+        p = Process(target=start_malacoda, kwargs={'port': 51009})
+        p.start()
+        time.sleep(1)
+        zp = malacoda.get('SimpleMalacoda')
+        self.assertTrue(zp.address.startswith('ipc://'))
+        self.assertEqual(zp.echo('hello'), 'hello')
+        zp = malacoda.get('SimpleMalacoda:51009', transport='tcp')
+        self.assertEqual(zp.address, 'localhost:51009')
+        self.assertEqual(zp.echo('hello'), 'hello')
+        with self.assertRaises(malacoda.MalacodaException):
+            malacoda.get('SimpleMalacoda', transport='inproc')
+        zp.stop()
+        p.join()
+
+    def test_work_loops(self):
+        p = Process(target=WorkMalacoda, kwargs={'port': 51010})
+        p.start()
+        zp = malacoda.get('WorkMalacoda:51010')
+        time.sleep(1)
+        stats = zp._work_stats()
+        self.assertEqual(sorted(stats), ['work_count', 'work_fail', 'work_pid'])
+        self.assertEqual(stats['work_count']['alive'], 2)
+        self.assertEqual(stats['work_pid']['mode'], 'process')
+        self.assertEqual(stats['work_pid']['alive'], 1)
+        self.assertGreater(stats['work_pid']['iterations'], 2)
+        self.assertGreater(stats['work_count']['iterations'], 2)
+        self.assertGreater(zp.counter, 2)
+        self.assertGreaterEqual(stats['work_fail']['errors'], 1)
+        self.assertIn('ValueError', stats['work_fail']['last_error'])
+        zp.stop()
+        p.join()
+
+    def test_offload(self):
+        p = Process(target=OffloadMalacoda, kwargs={'port': 51011, 'offload_processes': 2})
+        p.start()
+        zp = malacoda.get('OffloadMalacoda:51011')
+        self.assertNotEqual(zp.pid(), zp.daemon_pid())
+        self.assertEqual(zp.square(3), 9)
+        self.assertEqual(zp.square_in_thread(4), 16)
+        with self.assertRaises(TypeError):
+            zp.square('a')
+        zp.stop()
+        p.join()
+
+    def test_idempotent_retries(self):
+        p = Process(target=start_malacoda, kwargs={'port': 51012, 'listener_workers': 2})
+        p.start()
+        zp = malacoda.get('SimpleMalacoda:51012')
+        self.assertEqual(zp.slow_increment(1, timeout=0.4, retries=5), 1)
+        self.assertEqual(zp.increments, 1)
+        self.assertEqual(zp.slow_increment(0, idempotency_key='a'), 2)
+        self.assertEqual(zp.slow_increment(0, idempotency_key='a'), 2)
+        self.assertEqual(zp.increments, 2)
+        zp.stop()
+        p.join()
+
+    def test_cached(self):
+        p = Process(target=start_malacoda, kwargs={'port': 51013})
+        p.start()
+        zp = malacoda.get('SimpleMalacoda:51013')
+        zp.update_pst_list([1, 2])
+        self.assertEqual(zp.pst_list_length(), 2)
+        self.assertEqual(zp.pst_list_length(), 2)
+        zp.update_pst_list([1])
+        self.assertEqual(zp.pst_list_length(), 1)
+        self.assertEqual(zp._cache_stats()['pst_list_length'],
+                         {'size': 1, 'hits': 1, 'misses': 2})
+        self.assertEqual(list(zp.cached_count(3)), [0, 1, 2])
+        self.assertEqual(list(zp.cached_count(3)), [0, 1, 2])
+        self.assertEqual(zp._cache_stats()['cached_count']['size'], 0)
+        zp.stop()
+        p.join()
+
+    def test_attr_cache(self):
+        p = Process(target=start_malacoda, kwargs={'port': 51014})
+        p.start()
+        zp = malacoda.get('SimpleMalacoda:51014', attr_cache=True)
+        self.assertEqual(zp.constant, 5)
+        self.assertEqual(zp.constant, 5)
+        zp.constant = 6
+        self.assertEqual(zp.constant, 6)
+        zp.slow_increment(0)
+        self.assertEqual(zp.increments, 1)
+        self.assertEqual(zp.attr_cache.stats(),
+                         {'size': 2, 'hits': 0, 'not_modified': 1, 'misses': 3})
+        zp.stop()
+        p.join()
+
+    def test_subscribe(self):
+        p = Process(target=start_malacoda, kwargs={'port': 51015, 'publish_channel': True})
+        p.start()
+        zp = malacoda.get('SimpleMalacoda:51015')
+        with malacoda.subscribe('SimpleMalacoda:51015', topics=['a']) as subscriber:
+            # the subscription takes a moment to be set up, publish until it is
+            for _ in xrange(50):
+                zp.notify('b', 0)
+                zp.notify('a.1', {'x': 1})
+                try:
+                    received = subscriber.recv(timeout=0.1)
+                    break
+                except socket.timeout:
+                    pass
+            self.assertEqual(received, ('a.1', {'x': 1}))
+        self.assertGreaterEqual(zp._malacoda_describe()['pub_port'],
+                                malacoda.MsgListenerThread.CHANNEL_PORT_RANGE[0])
+        with self.assertRaises(socket.timeout):
+            malacoda.subscribe('SimpleMalacoda:51099', connect_timeout=0.5)
+        zp.stop()
+        p.join()
+
+    def test_pool(self):
+        processes = [Process(target=start_malacoda, kwargs={'port': port})
+                     for port in (51016, 51017)]
+        for p in processes:
+            p.start()
+        time.sleep(1)
+        hosts = ['localhost:51016', 'localhost:51017']
+        pool = malacoda.get_pool('SimpleMalacoda', hosts=hosts, health_interval=None)
+        for _ in xrange(4):
+            self.assertEqual(pool.echo('hello'), 'hello')
+        self.assertEqual(pool.constant, 5)
+        self.assertTrue(all(s['calls'] >= 2 for s in pool.stats()))
+        hash_pool = malacoda.get_pool('SimpleMalacoda', hosts=hosts, health_interval=None,
+                                      routing='consistent_hash')
+        self.assertEqual([hash_pool.slow_increment(0, route_key='a') for _ in xrange(3)],
+                         [1, 2, 3])
+        malacoda.get('SimpleMalacoda:51017').stop()
+        processes[1].join()
+        pool.check_health(timeout=0.5)
+        self.assertEqual([s['healthy'] for s in pool.stats()], [True, False])
+        self.assertEqual(pool.echo('hello'), 'hello')
+        malacoda.get('SimpleMalacoda:51016').stop()
+        processes[0].join()
+
             
-def start_malacoda(port=None):
-    SimpleMalacoda(daemonize=False, port=port)
+class SlowFileStorage(pst_storage.PstFileStorage):
+    def save(self, psts, keys=None):
+        time.sleep(10)
+        super(SlowFileStorage, self).save(psts, keys)
+
+
+class SlowLogStorage(pst_storage.PstLogStorage):
+    def save(self, psts, keys=None):
+        record = self._pack('pst_a', 10, pickle.dumps(10, 2))
+        with open(self.log_path, 'ab') as f:
+            f.write(record[:len(record) // 2])
+        time.sleep(10)
+
+
+def start_malacoda(port=None, **kwargs):
+    SimpleMalacoda(daemonize=False, port=port, **kwargs)
 
 
 class SimpleMalacoda(malacoda.Malacoda):
-    def __init__(self, daemonize=False, port=None):
+    def __init__(self, daemonize=False, port=None, **kwargs):
         self.constant = 5
+        self.increments = 0
         self.pst_list = None
         stdout = open('/tmp/stdout', 'w+')
         pst_config = {'class_name': 'PstFileStorage', 'frequency': timedelta(seconds=2),
@@ -66,7 +465,7 @@ class SimpleMalacoda(malacoda.Malacoda):
         super(SimpleMalacoda, self).__init__(pst_config=pst_config,
                                              daemonize=daemonize, stdout=stdout,
                                              stderr=stdout, files_preserve=[stdout],
-                                             port=port)
+                                             port=port, **kwargs)
 
     def _run(self):
         while self.running:
@@ -84,6 +483,66 @@ class SimpleMalacoda(malacoda.Malacoda):
     def fn(self):
         return self.echo
 
+    def count(self, n):
+        for i in xrange(n):
+            yield i
+
+    def notify(self, topic, payload):
+        self.publish(topic, payload)
+
+    def slow_increment(self, t):
+        time.sleep(t)
+        self.increments += 1
+        return self.increments
+
+    @malacoda.cached(maxsize=10)
+    def pst_list_length(self):
+        return len(self.pst_list)
+
+    @malacoda.cached()
+    def cached_count(self, n):
+        return self.count(n)
+
+
+class WorkMalacoda(malacoda.Malacoda):
+    WORK_METHODS = {'work_count': 2, 'work_fail': 1, 'work_pid': {'mode': 'process'}}
+
+    def __init__(self, port=None):
+        self.counter = 0
+        self.pid = os.getpid()
+        pst_config = {'class_name': 'PstFileStorage', 'frequency': timedelta(seconds=2),
+                      'file_path': PST_FILE}
+        super(WorkMalacoda, self).__init__(pst_config=pst_config, daemonize=False, port=port)
+
+    def work_count(self):
+        self.counter += 1
+        return 0.1
+
+    def work_fail(self):
+        raise ValueError('failed')
+
+    def work_pid(self):
+        if os.getpid() == self.pid:
+            raise ValueError('not in a process of its own')
+        return 0.1
+
+
+class OffloadMalacoda(SimpleMalacoda):
+    @malacoda.offload()
+    def pid(self):
+        return os.getpid()
+
+    def daemon_pid(self):
+        return os.getpid()
+
+    @malacoda.offload(pool='process')
+    def square(self, x):
+        return x * x
+
+    @malacoda.offload(pool='thread')
+    def square_in_thread(self, x):
+        return x * x
+
 
 if __name__ == '__main__':
     unittest.main()
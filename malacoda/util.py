@@ -1,4 +1,9 @@
 
+import time
+import threading
+from collections import OrderedDict
+
+
 def enum(*sequential, **named):
     """
     Usage:
@@ -18,3 +23,86 @@ def enum(*sequential, **named):
     reverse = dict((value, key) for key, value in enums.iteritems())
     enums['reverse_mapping'] = reverse
     return type('Enum', (), enums)
+
+
+
+class LRUCache(object):
+    """ Cache of at most maxsize entries, the least recently used entry is evicted when
+    it is full. Entries expire ttl seconds after they were put, if ttl is given.
+    If maxbytes is given, entries are also evicted while the sum of the sizes given to
+    put is larger than maxbytes, and values larger than maxbytes are not cached.
+    generation is increased each time the cache is cleared.
+    The cache can be used from many threads.
+
+    Usage:
+    >>> cache = LRUCache(maxsize=2)
+    >>> cache.put('a', 1)
+    >>> cache.put('b', 2)
+    >>> cache.get('a')
+    1
+    >>> cache.put('c', 3)
+    >>> cache.get('b') is None
+    True
+    """
+    def __init__(self, maxsize=1000, ttl=None, maxbytes=None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.maxbytes = maxbytes
+        self.bytes = 0
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.generation = 0
+
+    def get(self, key, default=None):
+        """ Return value of key, or default if key is not in cache or has expired.
+        """
+        with self.lock:
+            try:
+                entry = self.entries.pop(key)
+            except KeyError:
+                self.misses += 1
+                return default
+            if entry[1] is not None and entry[1] < time.time():
+                self.bytes -= entry[2]
+                self.misses += 1
+                return default
+            self.entries[key] = entry
+            self.hits += 1
+            return entry[0]
+
+    def put(self, key, value, ttl=None, size=0):
+        """ Put value in cache, ttl overrides the ttl of the cache.
+        size is the size of value in bytes, only used if maxbytes is given.
+        """
+        ttl = self.ttl if ttl is None else ttl
+        with self.lock:
+            old = self.entries.pop(key, None)
+            if old is not None:
+                self.bytes -= old[2]
+            if self.maxbytes is not None and size > self.maxbytes:
+                return
+            self.entries[key] = (value, time.time() + ttl if ttl else None, size)
+            self.bytes += size
+            while len(self.entries) > self.maxsize or \
+                  (self.maxbytes is not None and self.bytes > self.maxbytes):
+                self.bytes -= self.entries.popitem(last=False)[1][2]
+
+    def pop(self, key, default=None):
+        with self.lock:
+            entry = self.entries.pop(key, (default, None, 0))
+            self.bytes -= entry[2]
+            return entry[0]
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.bytes = 0
+            self.generation += 1
+
+    def __len__(self):
+        return len(self.entries)
+
+    def stats(self):
+        return {'size': len(self.entries), 'hits': self.hits, 'misses': self.misses}
@@ -16,11 +16,31 @@ Copyright 2014 Gustav Arngården
    limitations under the License.
 """
 
+import os
 import zmq
 import socket
+import threading
 from functools import wraps
 from message import REPMessage, REQMessage
 
+_context = None
+_context_pid = None
+_context_lock = threading.Lock()
+
+def get_context():
+    """ Return the process-wide zmq.Context.
+    A context can not be used after fork, so a new one is created if the pid has changed.
+    
+    """
+    global _context, _context_pid
+    pid = os.getpid()
+    if _context is None or _context_pid != pid:
+        with _context_lock:
+            if _context is None or _context_pid != pid:
+                _context = zmq.Context()
+                _context_pid = pid
+    return _context
+
 
 class Socket(object):
     """ Proxy for ZMQ socket that adds timeout.
@@ -44,9 +64,25 @@ class Socket(object):
         return wrapper
 
     def request_reply(self, msg, msg_class, timeout=None):
-        self.send(msg.serialize(), timeout=timeout)
-        payload = self.recv(timeout=timeout)
-        return msg_class.deserialize(payload)
+        self.send_message(msg, timeout=timeout)
+        return self.recv_message(msg_class, timeout=timeout)
+
+    def send_message(self, msg, track=False, timeout=None):
+        """ Send msg as a multipart message.
+        Out-of-band buffers are sent without copying, they must not be modified until
+        zmq is done with them, use track to get a zmq.MessageTracker for this.
+
+        Returns:
+         - (zmq.MessageTracker): If track is True, otherwise None.
+         
+        """
+        frames = msg.serialize_frames()
+        copy = len(frames) == 1 and not track
+        return self.send_multipart(frames, copy=copy, track=track, timeout=timeout)
+
+    def recv_message(self, msg_class, timeout=None):
+        frames = self.recv_multipart(copy=False, timeout=timeout)
+        return msg_class.deserialize_frames(frames)
                     
     @_timeout_wrapper
     def send(self, *args, **kwargs):
@@ -56,5 +92,13 @@ class Socket(object):
     def recv(self, *args, **kwargs):
         return self.socket.recv(*args, **kwargs)
 
+    @_timeout_wrapper
+    def send_multipart(self, *args, **kwargs):
+        return self.socket.send_multipart(*args, **kwargs)
+
+    @_timeout_wrapper
+    def recv_multipart(self, *args, **kwargs):
+        return self.socket.recv_multipart(*args, **kwargs)
+
     def __getattr__(self, attr):
         return getattr(self.socket, attr)
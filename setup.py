@@ -9,7 +9,7 @@ and save persistant data on disc.
 
 setup(
     name = 'malacoda',
-    packages = ['malacoda'],
+    packages = ['malacoda', 'malacoda.benchmarks'],
     version = '0.1',
     description = 'Daemon framework with communication and persistant storage capabilities',
     author='Gustav Arngården',